@@ -0,0 +1,512 @@
+#!/usr/bin/python3
+import os
+import sys
+import json
+import shutil
+import signal
+import socket
+import asyncio
+import tempfile
+import subprocess
+import multiprocessing
+import websockets
+from random import Random
+from time import sleep, monotonic, perf_counter
+from argparse import ArgumentParser
+from utilities.high_level_listener import HighLevelListener
+from utilities.gsc_trading_strings import GSCTradingStrings
+from utilities.gsc_trading_data_utils import GSCUtilsMisc
+from utilities.rby_trading import RBYTradingClient
+from utilities.gsc_trading import GSCTradingClient
+from utilities.rse_sp_trading import RSESPTradingClient
+from utilities.rse_sp_trading_data_utils import RSESPUtils
+
+class BenchmarkStats:
+    """
+    Class which collects the results of the simulated clients
+    of a single process. Times are in seconds.
+    """
+    counters = ["connections", "connection_errors", "messages", "relayed_frames", "relayed_bytes", "link_pairs", "pool_trades", "pool_empty", "retransmits", "errors"]
+
+    def __init__(self):
+        self.values = {}
+        for counter in self.counters:
+            self.values[counter] = 0
+        self.round_trips = {"link": [], "pool": []}
+        self.connect_start = None
+        self.connect_end = None
+
+    def add(self, counter, value=1):
+        self.values[counter] += value
+
+    def add_round_trip(self, kind, value):
+        self.round_trips[kind] += [value]
+
+    def add_connection(self, start, end):
+        self.values["connections"] += 1
+        if (self.connect_start is None) or (start < self.connect_start):
+            self.connect_start = start
+        if (self.connect_end is None) or (end > self.connect_end):
+            self.connect_end = end
+
+    def to_dict(self):
+        return {"values": self.values, "round_trips": self.round_trips, "connect_start": self.connect_start, "connect_end": self.connect_end}
+
+    def merge(self, data):
+        for counter in self.counters:
+            self.values[counter] += data["values"][counter]
+        for kind in self.round_trips.keys():
+            self.round_trips[kind] += data["round_trips"][kind]
+        if data["connect_start"] is not None:
+            self.add_connection(data["connect_start"], data["connect_end"])
+            self.values["connections"] -= 1
+
+def get_percentile(values, percentile):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile / 100))]
+
+class BenchmarkClient:
+    """
+    Base class of the simulated clients.
+    """
+    MAX_RETRANSMITS = 5
+    RECV_TIMEOUT = 30
+
+    def __init__(self, url, stats, connect_semaphore, binary_framing):
+        self.url = url
+        self.stats = stats
+        self.connect_semaphore = connect_semaphore
+        self.binary_framing = binary_framing
+
+    def prepare_hll(self, trading_client_class):
+        hll = HighLevelListener()
+        hll.set_valid_transfers(trading_client_class.possible_transfers, trading_client_class.binary_opcodes)
+        hll.set_binary_framing(self.binary_framing)
+        return hll
+
+    async def connect(self, path):
+        async with self.connect_semaphore:
+            start = monotonic()
+            try:
+                ws = await websockets.connect(self.url + path, ping_interval=None, max_size=None)
+            except Exception as e:
+                self.stats.add("connection_errors")
+                return None
+            self.stats.add_connection(start, monotonic())
+        return ws
+
+    async def send(self, ws, data):
+        self.stats.add("messages")
+        await ws.send(bytes(data))
+
+    async def recv(self, ws):
+        return await asyncio.wait_for(ws.recv(), self.RECV_TIMEOUT)
+
+class LinkPairClient(BenchmarkClient):
+    """
+    Class which simulates two players trading in the same room.
+    Each exchange is started by the first player, and it's timed
+    until the other player's answer is relayed back.
+    The stream is made of synchronous mode bytes, then of the
+    buffered mode data and of the trade menu's choice.
+    """
+    trading_client_class = GSCTradingClient
+    gen = 2
+    single_len = 32
+    full_len = 0x40C
+    choice_len = 1 + 1 + 0x75 + 1
+
+    def get_random_data(rnd, length):
+        return bytes(rnd.getrandbits(8) for i in range(length))
+
+    def prepare_stream(self, sync_exchanges):
+        hll = self.prepare_hll(self.trading_client_class)
+        rnd = Random()
+        stream = []
+        for i in range(sync_exchanges):
+            stream += [hll.prepare_send_data(self.trading_client_class.single_transfer, LinkPairClient.get_random_data(rnd, self.single_len))]
+        stream += [hll.prepare_send_data(self.trading_client_class.full_transfer, LinkPairClient.get_random_data(rnd, self.full_len))]
+        stream += [hll.prepare_send_data(self.trading_client_class.choice_transfer, LinkPairClient.get_random_data(rnd, self.choice_len))]
+        return [bytes(frame) for frame in stream]
+
+    async def run(self, room, sync_exchanges):
+        path = "/link" + str(self.gen) + "/" + str(room).zfill(5)
+        clients = []
+        try:
+            for i in range(2):
+                ws = await self.connect(path)
+                if ws is None:
+                    return
+                clients += [ws]
+                # Join the room
+                await ws.send("")
+            for ws in clients:
+                await self.recv(ws)
+            stream = self.prepare_stream(sync_exchanges)
+            for frame in stream:
+                start = perf_counter()
+                await self.send(clients[0], frame)
+                await self.recv(clients[1])
+                await self.send(clients[1], frame)
+                await self.recv(clients[0])
+                self.stats.add_round_trip("link", perf_counter() - start)
+                self.stats.add("relayed_frames", 2)
+                self.stats.add("relayed_bytes", 2 * len(frame))
+            self.stats.add("link_pairs")
+        except Exception as e:
+            self.stats.add("errors")
+        finally:
+            for ws in clients:
+                await ws.close()
+
+class PoolTradeClient(BenchmarkClient):
+    """
+    Class which simulates a player trading with the Pool,
+    through the whole handshake.
+    The values must match the ones in serving.py's PoolTradeServer.
+    """
+    trading_client_classes = [RBYTradingClient, GSCTradingClient, RSESPTradingClient]
+    choice_value = [0x60, 0x70, None]
+    accept_trade = [0x62, 0x72, [0xA20000, 0xB20000]]
+    success_value = [0x91, 0x91, [0x900000, 0x910000, 0x920000, 0x930000, 0x940000, 0x950000, 0x9C0000]]
+    records_path = "pool_default_data/pool_mons"
+    bin_eop = ".bin"
+    loaded_records = {}
+
+    def __init__(self, url, stats, connect_semaphore, binary_framing, gen):
+        super(PoolTradeClient, self).__init__(url, stats, connect_semaphore, binary_framing)
+        self.gen = gen
+        self.trading_client_class = self.trading_client_classes[gen]
+        self.hll = self.prepare_hll(self.trading_client_class)
+        self.records = PoolTradeClient.get_records(gen, self.trading_client_class)
+        self.rnd = Random()
+        self.own_id = self.rnd.randint(0, 255)
+        self.sent = {}
+
+    def get_records(gen, trading_client_class):
+        """
+        Returns the records the clients put into the Pool.
+        For gen 3, the Pokémon's data is parsed as well.
+        """
+        records = PoolTradeClient.loaded_records.get(gen, None)
+        if records is None:
+            data = GSCUtilsMisc.read_data(PoolTradeClient.records_path + str(gen + 1) + PoolTradeClient.bin_eop)
+            record_len = max(trading_client_class.possible_transfers[trading_client_class.pool_transfer]) - 1
+            records = []
+            for i in range(int(len(data) / record_len)):
+                record = data[i * record_len:(i + 1) * record_len]
+                mon = None
+                if gen == 2:
+                    mon = RSESPUtils.single_mon_from_data(None, record)
+                    if mon is None:
+                        continue
+                records += [[record, mon]]
+            PoolTradeClient.loaded_records[gen] = records
+        return records
+
+    async def send_with_counter(self, ws, transfer, data):
+        self.own_id = GSCUtilsMisc.inc_byte(self.own_id)
+        frame = self.hll.prepare_send_data(transfer, [self.own_id] + list(data))
+        self.sent[transfer] = frame
+        await self.send(ws, frame)
+
+    async def get(self, ws, transfer):
+        """
+        Requests the transfer, answering the server's
+        requests for retransmission. Returns its data.
+        """
+        for i in range(self.MAX_RETRANSMITS):
+            start = perf_counter()
+            await self.send(ws, self.hll.prepare_get_data(transfer))
+            response = await self.recv(ws)
+            self.stats.add_round_trip("pool", perf_counter() - start)
+            request = self.hll.is_received_valid(response)
+            if request is None:
+                break
+            if (request[0] == GSCTradingStrings.send_request) and (request[1] == transfer):
+                return list(response[request[3]:request[3] + request[2]])
+            if (request[0] == GSCTradingStrings.get_request) and (request[1] in self.sent.keys()):
+                self.stats.add("retransmits")
+                await self.send(ws, self.sent[request[1]])
+            else:
+                break
+        raise ValueError("Unexpected answer to " + transfer)
+
+    def expected_gen3_success_value(self, index, out_mon, in_mon):
+        if index == 0:
+            return out_mon.get_species()
+        if index == 1:
+            return out_mon.pid & 0xFFFF
+        if index == 2:
+            return out_mon.pid >> 16
+        if index == 3:
+            return in_mon.get_species()
+        if index == 4:
+            return in_mon.pid & 0xFFFF
+        if index == 5:
+            return in_mon.pid >> 16
+        return 0
+
+    def check_value(self, data, expected):
+        if data[1:] != expected:
+            self.stats.add("errors")
+
+    async def trade(self, ws, offered):
+        record, own_mon = self.rnd.choice(self.records)
+        if self.gen != 2:
+            await self.send_with_counter(ws, self.trading_client_class.choice_transfer, [self.choice_value[self.gen]] + list(record))
+            await self.send_with_counter(ws, self.trading_client_class.accept_transfer, [self.accept_trade[self.gen]])
+            self.check_value(await self.get(ws, self.trading_client_class.accept_transfer), [self.accept_trade[self.gen]])
+            await self.send_with_counter(ws, self.trading_client_class.success_transfer, [self.success_value[self.gen]])
+            self.check_value(await self.get(ws, self.trading_client_class.success_transfer), [self.success_value[self.gen]])
+            return
+        offered_mon = RSESPUtils.single_mon_from_data(None, offered[1:])[0]
+        own_mon = own_mon[0]
+        await self.send_with_counter(ws, self.trading_client_class.pool_transfer_out, record)
+        for i in range(len(self.accept_trade[self.gen])):
+            await self.send_with_counter(ws, self.trading_client_class.accept_transfer[i], GSCUtilsMisc.to_n_bytes_le(self.accept_trade[self.gen][i] | own_mon.get_species(), 3))
+            self.check_value(await self.get(ws, self.trading_client_class.accept_transfer[i]), GSCUtilsMisc.to_n_bytes_le(self.accept_trade[self.gen][i] | offered_mon.get_species(), 3))
+        for i in range(len(self.success_value[self.gen])):
+            await self.send_with_counter(ws, self.trading_client_class.success_transfer[i], GSCUtilsMisc.to_n_bytes_le(self.success_value[self.gen][i] | self.expected_gen3_success_value(i, own_mon, offered_mon), 3))
+            self.check_value(await self.get(ws, self.trading_client_class.success_transfer[i]), GSCUtilsMisc.to_n_bytes_le(self.success_value[self.gen][i] | self.expected_gen3_success_value(i, offered_mon, own_mon), 3))
+
+    async def run(self, rounds):
+        ws = await self.connect("/pool" + str(self.gen + 1))
+        if ws is None:
+            return
+        try:
+            for i in range(rounds):
+                offered = await self.get(ws, self.trading_client_class.pool_transfer)
+                if len(offered) <= 2:
+                    self.stats.add("pool_empty")
+                    continue
+                await self.trade(ws, offered)
+                self.stats.add("pool_trades")
+        except Exception as e:
+            self.stats.add("errors")
+        finally:
+            await ws.close()
+
+async def run_clients(options, link_rooms, pool_gens):
+    stats = BenchmarkStats()
+    connect_semaphore = asyncio.Semaphore(options["connect_concurrency"])
+    url = "ws://" + options["host"] + ":" + str(options["port"])
+    tasks = []
+    for room in link_rooms:
+        tasks += [LinkPairClient(url, stats, connect_semaphore, options["binary_framing"]).run(room, options["sync_exchanges"])]
+    for gen in pool_gens:
+        tasks += [PoolTradeClient(url, stats, connect_semaphore, options["binary_framing"], gen).run(options["rounds"])]
+    await asyncio.gather(*tasks)
+    return stats
+
+def run_process(options, link_rooms, pool_gens, results):
+    results.put(asyncio.run(run_clients(options, link_rooms, pool_gens)).to_dict())
+
+class BenchmarkServer:
+    """
+    Class which runs serving.py in a scratch directory,
+    so the real Pool's files are left untouched.
+    """
+    START_TIMEOUT = 60
+    STOP_TIMEOUT = 90
+    shared_dirs = ["pool_default_data", "useful_data"]
+
+    def __init__(self, port, metrics_port, workers, verbose):
+        self.port = port
+        self.metrics_port = metrics_port
+        self.workers = workers
+        self.verbose = verbose
+        self.process = None
+        self.work_dir = None
+
+    def start(self):
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+        self.work_dir = tempfile.mkdtemp(prefix="server_benchmark_")
+        for shared_dir in self.shared_dirs:
+            try:
+                os.symlink(os.path.join(base_dir, shared_dir), os.path.join(self.work_dir, shared_dir))
+            except OSError:
+                shutil.copytree(os.path.join(base_dir, shared_dir), os.path.join(self.work_dir, shared_dir))
+        env = dict(os.environ)
+        env["PORT"] = str(self.port)
+        env["METRICS_PORT"] = str(self.metrics_port)
+        env["WORKERS"] = str(self.workers)
+        env["POOL_STORAGE_DIR"] = os.path.join(self.work_dir, "storage")
+        output = None
+        if not self.verbose:
+            output = subprocess.DEVNULL
+        self.process = subprocess.Popen([sys.executable, os.path.join(base_dir, "serving.py")], cwd=self.work_dir, env=env, stdout=output, stderr=output)
+        BenchmarkServer.wait_for_port("localhost", self.port, self.START_TIMEOUT)
+
+    def wait_for_port(host, port, timeout):
+        deadline = monotonic() + timeout
+        while True:
+            try:
+                socket.create_connection((host, port), timeout=1).close()
+                return
+            except OSError:
+                if monotonic() > deadline:
+                    raise
+                sleep(0.1)
+
+    def get_cpu_time(self):
+        """
+        Returns the CPU time used so far by the server and its workers,
+        in seconds. Only available on Linux.
+        """
+        if self.process is None:
+            return None
+        try:
+            clock_ticks = os.sysconf("SC_CLK_TCK")
+            total = 0
+            for entry in os.listdir("/proc"):
+                if not entry.isdigit():
+                    continue
+                try:
+                    with open("/proc/" + entry + "/stat", "r") as f:
+                        fields = f.read().rsplit(")", 1)[1].split()
+                except OSError:
+                    continue
+                if (int(entry) == self.process.pid) or (int(fields[1]) == self.process.pid):
+                    total += int(fields[11]) + int(fields[12])
+            return total / clock_ticks
+        except Exception as e:
+            return None
+
+    def stop(self):
+        if self.process is not None:
+            self.process.send_signal(signal.SIGINT)
+            try:
+                self.process.wait(self.STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        if self.work_dir is not None:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+def prepare_report(stats, duration, cpu_time):
+    values = stats.values
+    report = dict(values)
+    report["duration_s"] = duration
+    report["connection_rate"] = None
+    if (stats.connect_start is not None) and (stats.connect_end > stats.connect_start):
+        report["connection_rate"] = values["connections"] / (stats.connect_end - stats.connect_start)
+    for kind in stats.round_trips.keys():
+        for percentile in [50, 99]:
+            value = get_percentile(stats.round_trips[kind], percentile)
+            if value is not None:
+                value *= 1000
+            report[kind + "_rtt_p" + str(percentile) + "_ms"] = value
+    report["relay_frames_per_s"] = values["relayed_frames"] / duration
+    report["relay_mb_per_s"] = values["relayed_bytes"] / duration / 1000000
+    report["server_cpu_s"] = cpu_time
+    report["server_cpu_per_message_us"] = None
+    if (cpu_time is not None) and (values["messages"] > 0):
+        report["server_cpu_per_message_us"] = cpu_time * 1000000 / values["messages"]
+    return report
+
+def print_report(report):
+    for key in report.keys():
+        value = report[key]
+        if isinstance(value, float):
+            value = round(value, 3)
+        print(key + ": " + str(value))
+
+def handle_args():
+    parser = ArgumentParser(description="Runs simulated clients against serving.py.")
+    parser.add_argument("-c", "--clients", dest="clients", default=1000,
+                        help="number of simulated clients, half of which pair up in link rooms", type=int)
+    parser.add_argument("-p", "--processes", dest="processes", default=2,
+                        help="processes the clients are spread across", type=int)
+    parser.add_argument("-r", "--rounds", dest="rounds", default=3,
+                        help="Pool trades done by each Pool client", type=int)
+    parser.add_argument("-se", "--sync_exchanges", dest="sync_exchanges", default=64,
+                        help="synchronous mode exchanges done by each link room", type=int)
+    parser.add_argument("-pg", "--pool_gens", dest="pool_gens", default="1,2,3",
+                        help="comma separated generations the Pool clients cycle through")
+    parser.add_argument("-cc", "--connect_concurrency", dest="connect_concurrency", default=100,
+                        help="maximum connections being opened at the same time, per process", type=int)
+    parser.add_argument("-bf", "--binary_framing",
+                        action="store_true", dest="binary_framing", default=False,
+                        help="use the binary framing instead of the ASCII one")
+    parser.add_argument("-sh", "--server_host", dest="host", default="localhost",
+                        help="server's host")
+    parser.add_argument("-sp", "--server_port", dest="port", default=11211,
+                        help="server's port", type=int)
+    parser.add_argument("-mp", "--metrics_port", dest="metrics_port", default=11212,
+                        help="port of the started server's metrics", type=int)
+    parser.add_argument("-w", "--workers", dest="workers", default=1,
+                        help="worker processes of the started server", type=int)
+    parser.add_argument("-ns", "--no_server",
+                        action="store_true", dest="no_server", default=False,
+                        help="use an already running server instead of starting one")
+    parser.add_argument("-j", "--json",
+                        action="store_true", dest="json", default=False,
+                        help="print the report as JSON")
+    parser.add_argument("-v", "--verbose",
+                        action="store_true", dest="verbose", default=False,
+                        help="show the started server's output")
+    return parser.parse_args()
+
+def raise_open_files_limit():
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except:
+        pass
+
+def main():
+    args = handle_args()
+    raise_open_files_limit()
+    num_pairs = int(args.clients / 4)
+    num_pool_clients = args.clients - (num_pairs * 2)
+    gens = [int(gen) - 1 for gen in args.pool_gens.split(",")]
+    if 2 in gens:
+        RSESPUtils()
+    room_base = Random().randint(0, 99999 - num_pairs)
+    rooms = [room_base + i for i in range(num_pairs)]
+    pool_gens = [gens[i % len(gens)] for i in range(num_pool_clients)]
+    options = {"host": args.host, "port": args.port, "binary_framing": args.binary_framing, "connect_concurrency": args.connect_concurrency, "sync_exchanges": args.sync_exchanges, "rounds": args.rounds}
+
+    server = None
+    if not args.no_server:
+        server = BenchmarkServer(args.port, args.metrics_port, args.workers, args.verbose)
+    try:
+        if server is not None:
+            server.start()
+        cpu_start = None
+        if server is not None:
+            cpu_start = server.get_cpu_time()
+        results = multiprocessing.Queue()
+        processes = []
+        start = monotonic()
+        for i in range(args.processes):
+            process = multiprocessing.Process(target=run_process, args=(options, rooms[i::args.processes], pool_gens[i::args.processes], results))
+            process.start()
+            processes += [process]
+        stats = BenchmarkStats()
+        for process in processes:
+            stats.merge(results.get())
+        duration = monotonic() - start
+        for process in processes:
+            process.join()
+        cpu_time = None
+        if cpu_start is not None:
+            cpu_end = server.get_cpu_time()
+            if cpu_end is not None:
+                cpu_time = cpu_end - cpu_start
+    finally:
+        if server is not None:
+            server.stop()
+
+    report = prepare_report(stats, duration, cpu_time)
+    if args.json:
+        print(json.dumps(report, indent=4))
+    else:
+        print_report(report)
+
+if __name__ == "__main__":
+    main()
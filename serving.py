@@ -4,12 +4,17 @@ import datetime
 import asyncio
 import websockets
 import threading
+import multiprocessing
 import signal
 import os
-import boto3
-import botocore
+import tempfile
+import struct
+import secrets
+import hashlib
 from random import Random
-from time import sleep
+from urllib.parse import urlsplit, parse_qs
+from collections import deque
+from time import monotonic, perf_counter
 from utilities.trading_version import TradingVersion
 from utilities.high_level_listener import HighLevelListener
 from utilities.gsc_trading import GSCTradingClient
@@ -19,101 +24,753 @@ from utilities.gsc_trading_strings import GSCTradingStrings
 from utilities.gsc_trading_data_utils import *
 from utilities.rby_trading_data_utils import *
 from utilities.rse_sp_trading_data_utils import *
+from utilities.pool_storage import PoolJournal, PoolRecordStore, PoolSnapshotCache, PoolJournalCompactor
+from utilities.pool_snapshots import S3PoolStorage, LocalPoolStorage, PoolSnapshotFlusher
+from utilities.server_metrics import ServerMetrics, MetricsHTTPServer
 
-s3 = boto3.client("s3")
-uploader = None
+flusher = None
+storage_backend = None
 
 total_rooms = 100000
-link_rooms = [[set()]*total_rooms,[set()]*total_rooms,[set()]*total_rooms]
-mons = [[],[],[]]
-in_use_mons = [set(),set(),set()]
+mons = [None,None,None]
+mons_journals = [None,None,None]
+mons_checks = [None,None,None]
+mons_caches = [None,None,None]
+mons_stored_hashes = [None,None,None]
+mons_indexes = [None,None,None]
 upload_after = 24
 
+class PoolSlotAllocator:
+    """
+    Class which keeps track of the Pool's free slots.
+    The free slots are kept in the first part of an array, so that
+    a random one can be taken, and a taken one can be given back,
+    in constant time, no matter how full the Pool is.
+    A listener can be told when this process takes or gives back a slot.
+    """
+    
+    def __init__(self, num_slots=0):
+        self.rnd = Random()
+        self.rnd.seed()
+        self.listener = None
+        self.reset(num_slots)
+    
+    def set_listener(self, listener):
+        """
+        The listener's mark_in_use and mark_free are called
+        with the slot's index.
+        """
+        self.listener = listener
+    
+    def reset(self, num_slots):
+        """
+        Marks all the slots as free.
+        """
+        self.num_slots = num_slots
+        self.free_slots = list(range(num_slots))
+        self.slots_pos = list(range(num_slots))
+        self.set_num_free(num_slots)
+    
+    def get_num_free(self):
+        return self.num_free
+    
+    def set_num_free(self, num_free):
+        self.num_free = num_free
+    
+    def __len__(self):
+        """
+        Returns how many slots are currently in use.
+        """
+        return self.num_slots - self.get_num_free()
+    
+    def __contains__(self, index):
+        """
+        Returns whether the slot is currently in use.
+        """
+        return self.slots_pos[index] >= self.get_num_free()
+    
+    def swap_slots(self, pos_a, pos_b):
+        slot_a = self.free_slots[pos_a]
+        slot_b = self.free_slots[pos_b]
+        self.free_slots[pos_a] = slot_b
+        self.free_slots[pos_b] = slot_a
+        self.slots_pos[slot_a] = pos_b
+        self.slots_pos[slot_b] = pos_a
+    
+    def acquire(self):
+        """
+        Takes a random free slot. Returns None if there are none.
+        """
+        num_free = self.get_num_free()
+        if num_free == 0:
+            return None
+        self.swap_slots(self.rnd.randrange(num_free), num_free - 1)
+        self.set_num_free(num_free - 1)
+        index = self.free_slots[num_free - 1]
+        if self.listener is not None:
+            self.listener.mark_in_use(index)
+        return index
+    
+    def reserve(self, index):
+        """
+        Takes a specific slot, if it's free.
+        Returns whether it was free.
+        """
+        if index in self:
+            return False
+        num_free = self.get_num_free()
+        self.swap_slots(self.slots_pos[index], num_free - 1)
+        self.set_num_free(num_free - 1)
+        if self.listener is not None:
+            self.listener.mark_in_use(index)
+        return True
+    
+    def release(self, index):
+        """
+        Gives a slot back, if it's in use.
+        """
+        if index in self:
+            num_free = self.get_num_free()
+            self.swap_slots(self.slots_pos[index], num_free)
+            self.set_num_free(num_free + 1)
+            if self.listener is not None:
+                self.listener.mark_free(index)
+
+class SharedPoolSlotAllocator(PoolSlotAllocator):
+    """
+    Version of PoolSlotAllocator which keeps its state in shared memory,
+    so that all the worker processes forked after it's reset use it.
+    A worker killed while holding the lock leaves the state
+    inconsistent, so the lock isn't recovered. Waiting for it
+    times out instead, and the supervisor stops all the workers
+    as soon as one of them dies, so the whole group is restarted.
+    """
+    LOCK_TIMEOUT = 10
+    
+    def __init__(self, num_slots=0):
+        self.lock = multiprocessing.Lock()
+        self.shared_num_free = multiprocessing.RawValue('i', 0)
+        super(SharedPoolSlotAllocator, self).__init__(num_slots)
+    
+    def reset(self, num_slots):
+        with self.lock:
+            self.num_slots = num_slots
+            self.free_slots = multiprocessing.RawArray('i', range(num_slots))
+            self.slots_pos = multiprocessing.RawArray('i', range(num_slots))
+            self.set_num_free(num_slots)
+    
+    def reseed(self):
+        """
+        Makes sure each worker process has its own random sequence.
+        """
+        self.rnd.seed()
+    
+    def get_num_free(self):
+        return self.shared_num_free.value
+    
+    def set_num_free(self, num_free):
+        self.shared_num_free.value = num_free
+    
+    def lock_state(self):
+        if not self.lock.acquire(timeout=SharedPoolSlotAllocator.LOCK_TIMEOUT):
+            raise TimeoutError("The Pool's slots are locked by a worker which is not responding!")
+    
+    def acquire(self):
+        self.lock_state()
+        try:
+            return super(SharedPoolSlotAllocator, self).acquire()
+        finally:
+            self.lock.release()
+    
+    def reserve(self, index):
+        self.lock_state()
+        try:
+            return super(SharedPoolSlotAllocator, self).reserve(index)
+        finally:
+            self.lock.release()
+    
+    def release(self, index):
+        self.lock_state()
+        try:
+            super(SharedPoolSlotAllocator, self).release(index)
+        finally:
+            self.lock.release()
+
+in_use_mons = [PoolSlotAllocator(),PoolSlotAllocator(),PoolSlotAllocator()]
+
+class PoolQueryGroup:
+    """
+    Class which holds the Pool slots matching a query's species,
+    egg flag and origin game, grouped by level.
+    A Fenwick tree counts the slots up to each level, so the slots
+    in a level range are counted, and the one at a given position
+    is found, in time logarithmic in the number of levels.
+    """
+    NUM_LEVELS = 0x100
+    
+    def __init__(self):
+        self.tree = [0] * (self.NUM_LEVELS + 1)
+        self.levels = {}
+        self.slot_pos = {}
+    
+    def update_tree(self, level, amount):
+        pos = level + 1
+        while pos <= self.NUM_LEVELS:
+            self.tree[pos] += amount
+            pos += pos & (-pos)
+    
+    def count_below(self, level):
+        """
+        Returns how many slots have a level lower than the given one.
+        """
+        total = 0
+        pos = min(level, self.NUM_LEVELS)
+        while pos > 0:
+            total += self.tree[pos]
+            pos -= pos & (-pos)
+        return total
+    
+    def find(self, position):
+        """
+        Returns the slot at the given position, with the slots
+        sorted by level, and its level.
+        """
+        level = 0
+        step = self.NUM_LEVELS
+        while step > 0:
+            next_level = level + step
+            if (next_level <= self.NUM_LEVELS) and (self.tree[next_level] <= position):
+                level = next_level
+                position -= self.tree[next_level]
+            step >>= 1
+        return self.levels[level][position], level
+    
+    def add(self, index, level):
+        slots = self.levels.get(level, None)
+        if slots is None:
+            slots = []
+            self.levels[level] = slots
+        self.slot_pos[index] = len(slots)
+        slots += [index]
+        self.update_tree(level, 1)
+    
+    def remove(self, index, level):
+        slots = self.levels[level]
+        pos = self.slot_pos.pop(index)
+        last = slots.pop()
+        if last != index:
+            slots[pos] = last
+            self.slot_pos[last] = pos
+        self.update_tree(level, -1)
+    
+    def __len__(self):
+        return len(self.slot_pos)
+
+class PoolQueryIndex:
+    """
+    Class which indexes a generation's free Pool slots by the Pokémon's
+    species, level, egg flag and origin game (for gen 3).
+    Each combination of species, egg flag and origin game, including
+    the ones which accept any of them, has a PoolQueryGroup, kept up
+    to date as the slots change. A random matching free slot is then
+    drawn in time logarithmic in the number of levels, no matter how
+    big the Pool is.
+    Slots are drawn with the same weight. The allocator tells the index
+    when this process takes or gives back a slot, so busy slots are
+    simply not in the groups.
+    The slots' attributes are read the first time a query arrives,
+    so the Pool isn't decoded when the server starts.
+    """
+    ANY = 0
+    EGG_EXCLUDE = 1
+    EGG_ONLY = 2
+    MAX_DRAWS = 8
+    info_classes = [RBYTradingPokémonInfo, GSCTradingPokémonInfo, RSESPTradingPokémonInfo]
+    
+    def __init__(self, gen, records):
+        self.gen = gen
+        self.records = records
+        self.slot_keys = None
+        self.groups = {}
+        self.in_use = set()
+    
+    def get_key(gen, mon, is_egg):
+        """
+        Returns the attributes of a pokémon the queries can filter on.
+        """
+        origin_game = 0
+        if gen == 2:
+            origin_game = mon.get_origin_game()
+        return (mon.get_species(), mon.get_level(), int(bool(is_egg)), origin_game)
+    
+    def get_record_key(gen, record):
+        """
+        Returns the attributes of an already validated record,
+        without checking it again.
+        The first two generations' attributes are read straight
+        from the record. The third one's are encrypted.
+        """
+        info_class = PoolQueryIndex.info_classes[gen]
+        if gen == 2:
+            mon = info_class.set_data(list(record))
+            return PoolQueryIndex.get_key(gen, mon, mon.get_is_egg())
+        is_egg = 0
+        if gen == 1:
+            is_egg = int(record[-1] == GSCUtils.egg_value)
+        return (record[info_class.species_pos], record[info_class.level_pos], is_egg, 0)
+    
+    def parse_query(data):
+        """
+        Reads species (2 bytes), min level, max level, egg
+        and origin game.
+        """
+        return (GSCUtilsMisc.read_short_le(data, 0), data[2], data[3], data[4], data[5])
+    
+    def matches(query, key):
+        # Slots which can't be decoded never match
+        if key is None:
+            return False
+        species, min_level, max_level, egg, origin_game = query
+        if (species != PoolQueryIndex.ANY) and (species != key[0]):
+            return False
+        if (key[1] < min_level) or (key[1] > max_level):
+            return False
+        if (egg == PoolQueryIndex.EGG_EXCLUDE) and key[2]:
+            return False
+        if (egg == PoolQueryIndex.EGG_ONLY) and not key[2]:
+            return False
+        if (origin_game != PoolQueryIndex.ANY) and (origin_game != key[3]):
+            return False
+        return True
+    
+    def get_group_key(query):
+        species, min_level, max_level, egg, origin_game = query
+        return (species, egg, origin_game)
+    
+    def get_group_keys(key):
+        """
+        Returns the keys of all the groups a slot belongs to.
+        """
+        if key is None:
+            return set()
+        species, level, is_egg, origin_game = key
+        egg_filters = [PoolQueryIndex.ANY, PoolQueryIndex.EGG_EXCLUDE]
+        if is_egg:
+            egg_filters = [PoolQueryIndex.ANY, PoolQueryIndex.EGG_ONLY]
+        return {(group_species, egg, group_origin_game) for group_species in [PoolQueryIndex.ANY, species] for egg in egg_filters for group_origin_game in [PoolQueryIndex.ANY, origin_game]}
+    
+    def build(self):
+        """
+        Reads the slots' attributes and puts the free ones in their groups.
+        """
+        self.slot_keys = [PoolQueryIndex.get_record_key(self.gen, self.records.get_record(i)) for i in range(len(self.records))]
+        for i in range(len(self.slot_keys)):
+            if i not in self.in_use:
+                self.add_to_groups(i, self.slot_keys[i])
+    
+    def add_to_groups(self, index, key):
+        for group_key in PoolQueryIndex.get_group_keys(key):
+            group = self.groups.get(group_key, None)
+            if group is None:
+                group = PoolQueryGroup()
+                self.groups[group_key] = group
+            group.add(index, key[1])
+    
+    def remove_from_groups(self, index, key):
+        for group_key in PoolQueryIndex.get_group_keys(key):
+            group = self.groups[group_key]
+            group.remove(index, key[1])
+            if len(group) == 0:
+                self.groups.pop(group_key)
+    
+    def set_slot(self, index, key):
+        """
+        Moves a slot to the groups of its new attributes.
+        """
+        if self.slot_keys is None:
+            return
+        old_key = self.slot_keys[index]
+        if old_key == key:
+            return
+        if index not in self.in_use:
+            self.remove_from_groups(index, old_key)
+            self.add_to_groups(index, key)
+        self.slot_keys[index] = key
+    
+    def mark_in_use(self, index):
+        if index in self.in_use:
+            return
+        self.in_use.add(index)
+        if self.slot_keys is not None:
+            self.remove_from_groups(index, self.slot_keys[index])
+    
+    def mark_free(self, index):
+        if index not in self.in_use:
+            return
+        self.in_use.discard(index)
+        if self.slot_keys is not None:
+            self.add_to_groups(index, self.slot_keys[index])
+    
+    def draw(self, query, allocator):
+        """
+        Takes a random free slot which matches the query.
+        Returns None if there are none.
+        Slots taken by other workers are still in the groups, so
+        if one is drawn, it's left out until the draw is over.
+        """
+        species, min_level, max_level, egg, origin_game = query
+        if min_level > max_level:
+            return None
+        if self.slot_keys is None:
+            self.build()
+        group_key = PoolQueryIndex.get_group_key(query)
+        drawn = None
+        taken_elsewhere = []
+        for i in range(PoolQueryIndex.MAX_DRAWS):
+            group = self.groups.get(group_key, None)
+            if group is None:
+                break
+            base = group.count_below(min_level)
+            total = group.count_below(max_level + 1) - base
+            if total == 0:
+                break
+            index, level = group.find(base + allocator.rnd.randrange(total))
+            if allocator.reserve(index):
+                drawn = index
+                break
+            self.mark_in_use(index)
+            taken_elsewhere += [index]
+        for index in taken_elsewhere:
+            self.mark_free(index)
+        return drawn
+
+class LinkRoomRegistry:
+    """
+    Class which keeps track of the link rooms with a client waiting
+    for a partner, and of how many rooms are currently linked.
+    Rooms only exist while someone is waiting in them.
+    Waiting rooms are kept in arrival order, so the expired ones
+    are always at the front.
+    """
+    WAITING_TIMEOUT = 30 * 60
+    
+    def __init__(self):
+        self.waiting = {}
+        self.num_active = 0
+    
+    def get_num_waiting(self):
+        return len(self.waiting)
+    
+    def get_num_active(self):
+        return self.num_active
+    
+    def join(self, gen, room, proxy):
+        """
+        Puts the client in the room.
+        Returns the client it got paired with, if there was one waiting.
+        """
+        key = (gen, room)
+        entry = self.waiting.get(key, None)
+        if entry is None:
+            self.waiting[key] = [proxy, monotonic()]
+            return None
+        if entry[0] is proxy:
+            return None
+        self.waiting.pop(key)
+        self.num_active += 1
+        return entry[0]
+    
+    def leave(self, gen, room, proxy):
+        """
+        Removes the client from the room, if it was waiting in it.
+        """
+        key = (gen, room)
+        entry = self.waiting.get(key, None)
+        if (entry is not None) and (entry[0] is proxy):
+            self.waiting.pop(key)
+    
+    def end_link(self):
+        """
+        Marks one of the linked rooms as closed.
+        """
+        if self.num_active > 0:
+            self.num_active -= 1
+    
+    def expire(self):
+        """
+        Removes the rooms which have been waiting for too long.
+        Returns the clients which were waiting in them.
+        """
+        expired = []
+        limit = monotonic() - LinkRoomRegistry.WAITING_TIMEOUT
+        while len(self.waiting) > 0:
+            key = next(iter(self.waiting))
+            proxy, arrival = self.waiting[key]
+            if arrival > limit:
+                break
+            self.waiting.pop(key)
+            expired += [proxy]
+        return expired
+
+class LinkSessionRegistry:
+    """
+    Class which keeps track of the tokens the linked clients
+    can use to resume their link, if their connection drops.
+    A dropped side of a link is kept for GRACE_PERIOD seconds,
+    buffering what the other client sends in the meantime.
+    """
+    GRACE_PERIOD = 30
+    token_len = 16
+    
+    def __init__(self):
+        self.sessions = {}
+    
+    def issue(self, proxy):
+        """
+        Returns a new token for the client's side of the link.
+        """
+        token = secrets.token_hex(self.token_len)
+        proxy.token = token
+        self.sessions[token] = proxy
+        return token
+    
+    def get(self, token):
+        return self.sessions.get(token, None)
+    
+    def revoke(self, proxy):
+        if proxy.token is not None:
+            self.sessions.pop(proxy.token, None)
+            proxy.token = None
+
+link_rooms = LinkRoomRegistry()
+link_sessions = LinkSessionRegistry()
+metrics = ServerMetrics()
+
 class ServerUtils:
     saved_mons_path = "pool_mons"
+    bucket = "pokemon-gb-online-pool-gen1"
     default_path = "pool_default_data/"
     bin_eop = ".bin"
+    utils_classes = [RBYUtils, GSCUtils, RSESPUtils]
+    
+    def get_saved_mons_path(gen):
+        return ServerUtils.saved_mons_path + str(gen + 1) + ServerUtils.bin_eop
     
-    def save_mons(gen):
-        """
-        Saves the currently loaded Pokémon to file.
-        """
-        data = []
-        for m in mons[gen]:
-            if gen == 1:
-                data += GSCUtils.single_mon_to_data(m[0], m[1])
-            elif gen == 0:
-                data += RBYUtils.single_mon_to_data(m[0], m[1])
-            elif gen == 2:
-                data += RSESPUtils.single_mon_to_data(m[0], m[1])
-        GSCUtilsMisc.write_data(ServerUtils.saved_mons_path + str(gen + 1) + ServerUtils.bin_eop, data)
-        global uploader
-        if uploader is None:
-            uploader = DataUploader()
-            uploader.start()
-        uploader.to_up[gen] = True
+    def get_storage_backend():
+        """
+        Snapshots are stored in POOL_STORAGE_DIR if it's set,
+        otherwise in S3.
+        """
+        global storage_backend
+        if storage_backend is None:
+            try:
+                storage_backend = LocalPoolStorage(os.environ["POOL_STORAGE_DIR"])
+            except KeyError as e:
+                storage_backend = S3PoolStorage(ServerUtils.bucket)
+        return storage_backend
+    
+    def start_flusher(always_check=False):
+        """
+        Starts uploading the Pool's changes in the background.
+        """
+        global flusher
+        keys = [ServerUtils.get_saved_mons_path(gen) for gen in range(len(mons_journals))]
+        flusher = PoolSnapshotFlusher(ServerUtils.get_storage_backend(), mons_journals, keys, upload_after*60, always_check=always_check)
+        for gen in range(len(mons_journals)):
+            flusher.mark_stored(gen, mons_stored_hashes[gen])
+        flusher.start()
+    
+    def mark_for_upload(gen):
+        if flusher is not None:
+            flusher.mark_dirty(gen)
+    
+    def save_mons(gen, data):
+        """
+        Saves the given records to file, from scratch,
+        and maps them in memory.
+        """
+        if mons[gen] is not None:
+            mons[gen].close()
+        mons_journals[gen].reset(data)
+        mons[gen] = PoolRecordStore(mons_journals[gen])
+    
+    def save_mon(index, gen, mon):
+        """
+        Saves the Pokémon in a single slot to file.
+        Only the slot's record is written.
+        """
+        mons[gen].write_record(index, ServerUtils.utils_classes[gen].single_mon_to_data(mon[0], mon[1]))
+        ServerUtils.mark_for_upload(gen)
     
     def load_mons(checks, gen):
         """
         Loads the Pool's Pokémon from file.
+        Also replays the writes which were not yet saved to the base file.
+        The stored snapshot is only used if there is no local base file,
+        or if its generation is newer than the local one's.
+        The records are validated once, and then served from memory
+        without being decoded until they're traded.
         """
-        preparing_mons = []
+        saved_mons_path = ServerUtils.get_saved_mons_path(gen)
+        single_entry_len = len(checks.single_pokemon_checks_map)
+        if gen == 1:
+            single_entry_len += 1
+        mons_checks[gen] = checks
+        mons_journals[gen] = PoolJournal(saved_mons_path, single_entry_len)
+        mons_caches[gen] = PoolSnapshotCache(saved_mons_path, bytes(TradingVersion.prepare_version_data()) + checks.get_version_data())
         
-        try:
-            s3.download_file(Bucket="pokemon-gb-online-pool-gen1", Key=ServerUtils.saved_mons_path + str(gen + 1) + ServerUtils.bin_eop, Filename="./" + ServerUtils.saved_mons_path + str(gen + 1) + ServerUtils.bin_eop)
-            raw_data = GSCUtilsMisc.read_data(ServerUtils.saved_mons_path + str(gen + 1) + ServerUtils.bin_eop)
-        except botocore.exceptions.NoCredentialsError:
-            raw_data = GSCUtilsMisc.read_data(ServerUtils.default_path + ServerUtils.saved_mons_path + str(gen + 1) + ServerUtils.bin_eop)
+        raw_data = GSCUtilsMisc.read_data(saved_mons_path)
+        stored = ServerUtils.get_storage_backend().download(saved_mons_path)
+        mons_stored_hashes[gen] = None
+        if stored is not None:
+            stored_data, stored_generation = stored
+            mons_stored_hashes[gen] = hashlib.sha256(stored_data).digest()
+            if (raw_data is None) or (stored_generation > mons_journals[gen].read_generation()):
+                # The local writes are older than the stored snapshot
+                mons_journals[gen].reset(stored_data)
+                mons_journals[gen].write_generation(stored_generation)
+                raw_data = stored_data
+        if raw_data is None:
+            raw_data = GSCUtilsMisc.read_data(ServerUtils.default_path + saved_mons_path)
         if raw_data is not None:
-            single_entry_len = len(checks.single_pokemon_checks_map)
-            if gen == 1:
-                single_entry_len += 1
-            entries = int(len(raw_data)/single_entry_len)
-            for i in range(entries):
-                if gen == 1:
-                    mon = GSCUtils.single_mon_from_data(checks, raw_data[i*single_entry_len:(i+1)*single_entry_len])
-                elif gen == 2:
-                    mon = RSESPUtils.single_mon_from_data(checks, raw_data[i*single_entry_len:(i+1)*single_entry_len])
-                elif gen == 0:
-                    mon = RBYUtils.single_mon_from_data(checks, raw_data[i*single_entry_len:(i+1)*single_entry_len])
-                if mon is not None:
-                    preparing_mons += [mon]
-            in_use_mons[gen] = set()
-            mons[gen] = preparing_mons
-    
-    def get_mon_index(index, gen):
-        """
-        If the index is None, it randomly selects a free one.
+            raw_data = mons_journals[gen].replay(raw_data)
+            valid_data = mons_caches[gen].load(raw_data)
+            if valid_data is None:
+                valid_data = ServerUtils.validate_mons(checks, gen, raw_data, single_entry_len)
+                mons_caches[gen].save(raw_data, valid_data)
+            # Make it so the slots match the base file's records
+            ServerUtils.save_mons(gen, valid_data)
+            in_use_mons[gen].reset(len(mons[gen]))
+            mons_indexes[gen] = PoolQueryIndex(gen, mons[gen])
+            in_use_mons[gen].set_listener(mons_indexes[gen])
+    
+    def validate_mons(checks, gen, raw_data, single_entry_len):
+        """
+        Returns the records which pass the checks, re-encoded.
+        """
+        raw_data = list(raw_data)
+        entries = int(len(raw_data)/single_entry_len)
+        valid_data = bytearray()
+        for i in range(entries):
+            mon = ServerUtils.utils_classes[gen].single_mon_from_data(checks, raw_data[i*single_entry_len:(i+1)*single_entry_len])
+            if mon is not None:
+                valid_data += bytes(ServerUtils.utils_classes[gen].single_mon_to_data(mon[0], mon[1]))
+        return valid_data
+    
+    def load_all_mons(checks):
+        """
+        Loads the Pool's Pokémon of all the generations at the same time.
+        """
+        # Make sure the threads share the same backend
+        ServerUtils.get_storage_backend()
+        loaders = [PoolLoader(checks[gen], gen) for gen in range(len(checks))]
+        for loader in loaders:
+            loader.start()
+        for loader in loaders:
+            loader.join()
+            if loader.error is not None:
+                raise loader.error
+    
+    def get_mon_record(index, gen):
+        """
+        Returns the encoded pokémon in a slot, without copying it.
+        """
+        return mons[gen].get_record(index)
+    
+    def flush_mons():
+        """
+        Makes sure all the Pool's changes are in the base files,
+        and uploads the pending ones right away.
+        """
+        for gen in range(len(mons)):
+            if mons[gen] is not None:
+                mons_journals[gen].compact()
+                mons[gen].flush()
+                # Only validated Pokémon are stored, so the next start can skip the checks
+                snapshot = mons_journals[gen].read_snapshot()
+                mons_caches[gen].save(snapshot, snapshot)
+        if flusher is not None:
+            flusher.flush()
+    
+    def get_mon(index, gen):
+        """
+        Decodes the pokémon in a slot.
+        """
+        return ServerUtils.utils_classes[gen].single_mon_from_data(mons_checks[gen], list(mons[gen].get_record(index)))
+    
+    def get_mon_index(index, gen, query=None):
+        """
+        If the index is None, it randomly selects a free one,
+        among the ones which match the query, if there is one.
         Returns the pokémon in that slot.
         """
-        while index is None:
-            if len(in_use_mons[gen]) == len(mons[gen]):
+        if index is None:
+            if query is not None:
+                return ServerUtils.get_matching_mon(gen, query)
+            index = in_use_mons[gen].acquire()
+            if index is None:
                 return None, None
-            rnd = Random()
-            rnd.seed()
-            new_index = rnd.randint(0,len(mons[gen])-1)
-            if new_index not in in_use_mons[gen]:
-                in_use_mons[gen].add(new_index)
-                index = new_index
-        return index, mons[gen][index]
+        return index, ServerUtils.get_mon(index, gen)
+    
+    def get_matching_mon(gen, query):
+        """
+        Randomly selects a free slot which matches the query.
+        Other workers don't update this process' index, so the
+        drawn pokémon is checked, and its slot re-indexed.
+        """
+        if mons_indexes[gen] is None:
+            return None, None
+        for i in range(PoolQueryIndex.MAX_DRAWS):
+            index = mons_indexes[gen].draw(query, in_use_mons[gen])
+            if index is None:
+                break
+            mon = ServerUtils.get_mon(index, gen)
+            key = None
+            if mon is not None:
+                key = PoolQueryIndex.get_key(gen, mon[0], mon[1])
+            mons_indexes[gen].set_slot(index, key)
+            if PoolQueryIndex.matches(query, key):
+                return index, mon
+            in_use_mons[gen].release(index)
+        return None, None
+    
+    async def try_send(websocket, data):
+        """
+        Sends the data, unless the connection is closed.
+        Its handler notices it on the next recv(), and cleans up.
+        """
+        try:
+            await websocket.send(data)
+        except websockets.ConnectionClosed:
+            pass
+    
+    def store_mon(index, gen, mon):
+        """
+        Puts a traded pokémon into its slot and frees it.
+        """
+        in_use_mons[gen].reserve(index)
+        ServerUtils.save_mon(index, gen, mon)
+        if mons_indexes[gen] is not None:
+            mons_indexes[gen].set_slot(index, PoolQueryIndex.get_key(gen, mon[0], mon[1]))
+        in_use_mons[gen].release(index)
 
-class DataUploader(threading.Thread):
+class PoolLoader(threading.Thread):
+    """
+    Class which loads a single generation's Pool.
+    """
 
-    def __init__(self):
+    def __init__(self, checks, gen):
         threading.Thread.__init__(self)
         self.daemon=True
-        self.to_up = [False, False, False]
+        self.checks = checks
+        self.gen = gen
+        self.error = None
     
     def run(self):
-        sleep(upload_after*60)
-        global uploader
-        uploader = None
-        for gen in range(2):
-            if self.to_up[gen]:
-                try:
-                    s3.upload_file(Bucket="pokemon-gb-online-pool-gen1", Key=ServerUtils.saved_mons_path + str(gen + 1) + ServerUtils.bin_eop, Filename="./" + ServerUtils.saved_mons_path + str(gen + 1) + ServerUtils.bin_eop)
-                except botocore.exceptions.NoCredentialsError:
-                    pass
+        try:
+            ServerUtils.load_mons(self.checks, self.gen)
+        except Exception as e:
+            self.error = e
 
 class ServerSpecificTransfers:
     def __init__(self):
@@ -137,16 +794,67 @@ class ServerSpecificTransfers:
         self.last_read = datetime.datetime.now()
         return hll.prepare_send_data(random_transfer, self.random_data)
 
+class PoolHandshakeTable:
+    """
+    Class which holds the steps of a generation's Pool trade handshake:
+    the Pokémon the client offers, then its accepts and its successes.
+    A step can only be received once all the previous ones have been,
+    and receiving it discards the ones after it.
+    """
+    MON_STAGE = 0
+    ACCEPT_STAGE = 1
+    SUCCESS_STAGE = 2
+    loaded_tables = {}
+    
+    def __init__(self, gen, trading_client_class):
+        if gen == 2:
+            mon_transfer = trading_client_class.pool_transfer_out
+            accept_transfers = trading_client_class.accept_transfer
+            success_transfers = trading_client_class.success_transfer
+            # Counter
+            self.mon_data_pos = 1
+            self.value_len = 3
+            self.signals_failure = True
+        else:
+            mon_transfer = trading_client_class.choice_transfer
+            accept_transfers = [trading_client_class.accept_transfer]
+            success_transfers = [trading_client_class.success_transfer]
+            # Counter + Choice
+            self.mon_data_pos = 2
+            self.value_len = 1
+            # Failures are answered with the success value,
+            # so the client never knows it has to stop
+            self.signals_failure = False
+        self.transfers = [mon_transfer] + accept_transfers + success_transfers
+        self.kinds = [PoolHandshakeTable.MON_STAGE] + ([PoolHandshakeTable.ACCEPT_STAGE] * len(accept_transfers)) + ([PoolHandshakeTable.SUCCESS_STAGE] * len(success_transfers))
+        self.indexes = [0] + list(range(len(accept_transfers))) + list(range(len(success_transfers)))
+        self.num_stages = len(self.transfers)
+        self.last_stage = self.num_stages - 1
+        self.recv_stages = {}
+        self.get_stages = {}
+        for stage in range(self.num_stages):
+            self.recv_stages[self.transfers[stage]] = stage
+            if self.kinds[stage] != PoolHandshakeTable.MON_STAGE:
+                self.get_stages[self.transfers[stage]] = stage
+    
+    def get_table(gen, trading_client_class):
+        table = PoolHandshakeTable.loaded_tables.get(gen, None)
+        if table is None:
+            table = PoolHandshakeTable(gen, trading_client_class)
+            PoolHandshakeTable.loaded_tables[gen] = table
+        return table
+
 class PoolTradeServer:
     """
     Class which handles the pool trading part.
+    The handshake's state is kept incrementally: each received step
+    is checked once, against the steps before it, so answering
+    a GET never has to go through the whole handshake again.
     """
-    accept_trade = [0x62, 0x72, [0xA20000, 0xB20000]]
-    decline_trade = [0x61, 0x71, [0xA10000, 0xB10000]]
-    success_value = [0x91, 0x91, [0x900000, 0x910000, 0x920000, 0x930000, 0x940000, 0x950000, 0x9C0000]]
+    accept_trade = [[0x62], [0x72], [0xA20000, 0xB20000]]
+    decline_trade = [[0x61], [0x71], [0xA10000, 0xB10000]]
+    success_value = [[0x91], [0x91], [0x900000, 0x910000, 0x920000, 0x930000, 0x940000, 0x950000, 0x9C0000]]
     failure_value = [0x91, 0x91, 0x9F0000]
-    num_accepts = [1,1,2]
-    num_successes = [1,1,7]
     
     def __init__(self, gen):
         checks_class = RBYChecks
@@ -165,68 +873,38 @@ class PoolTradeServer:
         rnd.seed()
         self.gen = gen
         self.own_id = rnd.randint(0,255)
-        self.last_accepted = None
-        self.last_success = None
         self.clear_pool = True
         self.hll = HighLevelListener()
-        self.hll.set_valid_transfers(self.trading_client_class.possible_transfers)
+        self.hll.set_valid_transfers(self.trading_client_class.possible_transfers, self.trading_client_class.binary_opcodes)
+        self.hll.set_mirror_framing(True)
         self.mon_index = None
-        self.received_mon = None
-        self.received_accepted = None
-        self.received_success = None
+        self.pool_headers = {}
+        self.table = PoolHandshakeTable.get_table(gen, self.trading_client_class)
+        self.received = [None] * self.table.num_stages
+        self.last_ids = [None] * self.table.num_stages
+        self.reset_handshake()
         self.can_continue = True
-        if gen != 2:
-            self.get_handlers = {
-                self.trading_client_class.pool_transfer: self.handle_get_pool,
-                self.trading_client_class.accept_transfer: self.handle_get_accepted,
-                self.trading_client_class.success_transfer: self.handle_get_success,
-                self.trading_client_class.version_client_transfer: self.handle_get_client_version,
-                self.trading_client_class.version_server_transfer: self.handle_get_server_version,
-                self.trading_client_class.random_data_transfer: self.handle_get_random_data
-            }
-            self.send_handlers = {
-                self.trading_client_class.choice_transfer: self.handle_recv_mon,
-                self.trading_client_class.accept_transfer: self.handle_recv_accepted,
-                self.trading_client_class.success_transfer: self.handle_recv_success
-            }
-        else:
-            self.reset_gen3_accepted()
-            self.reset_gen3_success()
-            self.last_accepted = [None, None]
-            self.last_success = [None, None, None, None, None, None, None]
-            self.get_handlers = {
-                self.trading_client_class.pool_transfer: self.handle_get_pool,
-                self.trading_client_class.accept_transfer[0]: self.handle_get_accepted3_0,
-                self.trading_client_class.accept_transfer[1]: self.handle_get_accepted3_1,
-                self.trading_client_class.success_transfer[0]: self.handle_get_success3_0,
-                self.trading_client_class.success_transfer[1]: self.handle_get_success3_1,
-                self.trading_client_class.success_transfer[2]: self.handle_get_success3_2,
-                self.trading_client_class.success_transfer[3]: self.handle_get_success3_3,
-                self.trading_client_class.success_transfer[4]: self.handle_get_success3_4,
-                self.trading_client_class.success_transfer[5]: self.handle_get_success3_5,
-                self.trading_client_class.success_transfer[6]: self.handle_get_success3_6,
-                self.trading_client_class.version_client_transfer: self.handle_get_client_version,
-                self.trading_client_class.version_server_transfer: self.handle_get_server_version,
-                self.trading_client_class.random_data_transfer: self.handle_get_random_data
-            }
-            self.send_handlers = {
-                self.trading_client_class.pool_transfer_out: self.handle_recv_mon3,
-                self.trading_client_class.accept_transfer[0]: self.handle_recv_accepted3_0,
-                self.trading_client_class.accept_transfer[1]: self.handle_recv_accepted3_1,
-                self.trading_client_class.success_transfer[0]: self.handle_recv_success3_0,
-                self.trading_client_class.success_transfer[1]: self.handle_recv_success3_1,
-                self.trading_client_class.success_transfer[2]: self.handle_recv_success3_2,
-                self.trading_client_class.success_transfer[3]: self.handle_recv_success3_3,
-                self.trading_client_class.success_transfer[4]: self.handle_recv_success3_4,
-                self.trading_client_class.success_transfer[5]: self.handle_recv_success3_5,
-                self.trading_client_class.success_transfer[6]: self.handle_recv_success3_6
-            }
-    
-    def reset_gen3_accepted(self):
-        self.received_accepted = [None, None]
-    
-    def reset_gen3_success(self):
-        self.received_success = [None, None, None, None, None, None, None]
+        self.query = None
+        self.send_handlers = {
+            self.trading_client_class.pool_query_transfer: self.handle_recv_pool_query
+        }
+        self.get_handlers = {
+            self.trading_client_class.pool_transfer: self.handle_get_pool,
+            self.trading_client_class.version_client_transfer: self.handle_get_client_version,
+            self.trading_client_class.version_server_transfer: self.handle_get_server_version,
+            self.trading_client_class.random_data_transfer: self.handle_get_random_data
+        }
+    
+    def reset_handshake(self):
+        # How many steps have been received
+        self.cursor = 0
+        # How many of the first received steps passed their checks
+        self.valid_stages = 0
+        # First received step whose counter doesn't follow the previous one's
+        self.broken_chain = None
+    
+    def get_received_mon(self):
+        return self.received[PoolHandshakeTable.MON_STAGE][1]
     
     async def process(self, data, connection):
         """
@@ -235,37 +913,64 @@ class PoolTradeServer:
         if there is the need to do so.
         """
         request = self.hll.process_received_data(data, connection, send_data=False)
+        transfer = request[1]
+        if transfer not in self.trading_client_class.possible_transfers.keys():
+            # GETs' tags aren't validated, don't let them grow the metrics
+            transfer = LinkRelayTable.INVALID_TRANSFER
+        metrics.inc("pool_trade_messages_total", (self.gen + 1, request[0], transfer))
         to_send = None
         if request[0] == GSCTradingStrings.get_request:
-            if request[1] in self.get_handlers.keys():
-                to_send = self.get_handlers[request[1]]()
+            handler = self.get_handlers.get(request[1], None)
+            if handler is not None:
+                to_send = handler()
+            else:
+                stage = self.table.get_stages.get(request[1], None)
+                if stage is not None:
+                    to_send = self.handle_get_stage(stage)
         elif request[0] == GSCTradingStrings.send_request:
-            if request[1] in self.send_handlers.keys():
-                to_send = self.send_handlers[request[1]](self.hll.recv_dict[request[1]])
+            handler = self.send_handlers.get(request[1], None)
+            if handler is not None:
+                handler(self.hll.recv_dict[request[1]])
+            else:
+                stage = self.table.recv_stages.get(request[1], None)
+                if stage is not None:
+                    self.handle_recv_stage(stage, self.hll.recv_dict[request[1]])
                 
         if to_send is not None:
-            await connection.send(to_send)
+            await ServerUtils.try_send(connection, to_send)
     
     def handle_get_pool(self):
         """
         Gets the pokémon from the pool and sends it to the client.
         """
         if self.mon_index is None or self.clear_pool:
-            self.received_mon = None
-            if self.gen != 2:
-                self.received_accepted = None
-                self.received_success = None
-            else:
-                self.reset_gen3_accepted()
-                self.reset_gen3_success()
+            self.reset_handshake()
             self.own_id = GSCUtilsMisc.inc_byte(self.own_id)
             self.mon_index = None
             self.clear_pool = False
-        self.mon_index, self.mon = ServerUtils.get_mon_index(self.mon_index, self.gen)
+        if self.mon_index is None:
+            self.mon_index, self.mon = ServerUtils.get_mon_index(None, self.gen, query=self.query)
         if self.mon_index is None:
             return self.hll.prepare_send_data(self.trading_client_class.pool_transfer, [self.own_id] + [self.trading_client_class.pool_fail_value])
         else:
-            return self.hll.prepare_send_data(self.trading_client_class.pool_transfer, [self.own_id] + self.utils_class.single_mon_to_data(self.mon[0], self.mon[1]))
+            # The stored records are already in the format the clients expect
+            record = ServerUtils.get_mon_record(self.mon_index, self.gen)
+            pool_header = self.pool_headers.get(self.hll.binary_framing, None)
+            if pool_header is None:
+                pool_header = bytes(self.hll.prepare_send_header(self.trading_client_class.pool_transfer, 1 + len(record)))
+                self.pool_headers[self.hll.binary_framing] = pool_header
+            return pool_header + bytes([self.own_id]) + record
+    
+    def handle_recv_pool_query(self, data):
+        """
+        Sets which Pokémon the Pool can offer from now on.
+        If one was already offered and not traded, it's given back,
+        so the next GET draws a matching one.
+        """
+        if (self.mon_index is not None) and (not self.clear_pool):
+            in_use_mons[self.gen].release(self.mon_index)
+        self.mon_index = None
+        self.query = PoolQueryIndex.parse_query(data[1:])
     
     def handle_get_client_version(self):
         return ServerSpecificTransfers.handle_get_version(self.hll, self.trading_client_class.version_client_transfer)
@@ -280,109 +985,22 @@ class PoolTradeServer:
         i = ServerSpecificTransfers()
         return i.handle_get_random(self.hll, self.trading_client_class.random_data_transfer)
     
-    def handle_get_accepted(self):
+    def get_stage_value(self, stage, out_mon, in_mon):
         """
-        If the proper steps have been taken, it sends whether the data
-        will be accepted into the server or not.
-        If not, it requests whatever data it is missing.
-        The client has to have already sent an accept.
-        """
-        if self.mon_index is not None:
-            ret = self.check_retransmits(1)
-            if ret is not None:
-                return ret
-            if self.last_accepted is None or self.last_accepted != self.received_accepted[0]:
-                self.last_accepted = self.received_accepted[0]
-                self.own_id = GSCUtilsMisc.inc_byte(self.own_id)
-            if self.received_accepted[1] == PoolTradeServer.accept_trade[self.gen] and self.received_mon is not None and self.received_mon[1] is not None:
-                return self.hll.prepare_send_data(self.trading_client_class.accept_transfer, [self.own_id] + [PoolTradeServer.accept_trade[self.gen]])
-            else:
-                return self.hll.prepare_send_data(self.trading_client_class.accept_transfer, [self.own_id] + [PoolTradeServer.decline_trade[self.gen]])
-        return None
-    
-    def handle_get_success(self):
+        Returns the value of an accept or success step, as sent
+        by the side which trades out_mon for in_mon.
         """
-        If the proper steps have been taken, it sends a success signal.
-        If not, it requests whatever data it is missing.
-        The client has to have already sent a success.
-        """
-        if self.mon_index is not None:
-            ret = self.check_retransmits(1 + self.num_accepts[self.gen])
-            if ret is not None:
-                return ret
-            if self.last_success is None or self.last_success != self.received_success[0]:
-                self.last_success = self.received_success[0]
-                self.own_id = GSCUtilsMisc.inc_byte(self.own_id)
-                self.clear_pool = True
-                if not self.mon_index in in_use_mons[self.gen]:
-                    in_use_mons[self.gen].add(self.mon_index)
-                mons[self.gen][self.mon_index] = self.received_mon[1]
-                ServerUtils.save_mons(self.gen)
-                try:
-                    in_use_mons[self.gen].remove(self.mon_index)
-                except:
-                    pass
-            return self.hll.prepare_send_data(self.trading_client_class.success_transfer, [self.own_id] + [PoolTradeServer.success_value[self.gen]])
-        return None
-    
-    def handle_get_accepted3_0(self):
-        return self.handle_get_accepted3_i(0)
-    
-    def handle_get_accepted3_1(self):
-        return self.handle_get_accepted3_i(1)
-    
-    def handle_get_success3_0(self):
-        return self.handle_get_success3_i(0)
-    
-    def handle_get_success3_1(self):
-        return self.handle_get_success3_i(1)
-    
-    def handle_get_success3_2(self):
-        return self.handle_get_success3_i(2)
-    
-    def handle_get_success3_3(self):
-        return self.handle_get_success3_i(3)
-    
-    def handle_get_success3_4(self):
-        return self.handle_get_success3_i(4)
+        index = self.table.indexes[stage]
+        if self.table.kinds[stage] == PoolHandshakeTable.ACCEPT_STAGE:
+            value = PoolTradeServer.accept_trade[self.gen][index]
+            if self.gen == 2:
+                value |= out_mon.get_species()
+            return value
+        value = PoolTradeServer.success_value[self.gen][index]
+        if self.gen == 2:
+            value |= self.expected_gen3_success_value(index, out_mon, in_mon)
+        return value
     
-    def handle_get_success3_5(self):
-        return self.handle_get_success3_i(5)
-    
-    def handle_get_success3_6(self):
-        return self.handle_get_success3_i(6)
-    
-    def handle_get_accepted3_i(self, index):
-        """
-        If the proper steps have been taken, it sends whether the data
-        will be accepted into the server or not.
-        If not, it requests whatever data it is missing.
-        The client has to have already sent an accept.
-        """
-        if self.mon_index is not None:
-            ret = self.check_retransmits3(index + 1)
-            if ret is not None:
-                return ret
-            if self.last_accepted[index] is None or self.last_accepted[index] != self.received_accepted[index][0]:
-                self.last_accepted[index] = self.received_accepted[index][0]
-                self.own_id = GSCUtilsMisc.inc_byte(self.own_id)
-            success = self.can_continue
-            if self.received_mon[1] is None:
-                success = False
-            if success:
-                for i in range(index + 1):
-                    if (self.received_accepted[i][1] & 0xFF0000) != PoolTradeServer.accept_trade[self.gen][i]:
-                        success = False
-            if success:
-                for i in range(index + 1):
-                    if(self.received_accepted[i][1] & 0xFFFF) != self.received_mon[1][0].get_species():
-                        success = False
-            if success:
-                return self.hll.prepare_send_data(self.trading_client_class.accept_transfer[index], [self.own_id] + GSCUtilsMisc.to_n_bytes_le(PoolTradeServer.accept_trade[self.gen][index] | self.mon[0].get_species(), 3))
-            else:
-                return self.hll.prepare_send_data(self.trading_client_class.accept_transfer[index], [self.own_id] + GSCUtilsMisc.to_n_bytes_le(PoolTradeServer.decline_trade[self.gen][index], 3))
-        return None
-
     def expected_gen3_success_value(self, index, out_mon, in_mon):
         if index == 0:
             return out_mon.get_species()
@@ -398,244 +1016,478 @@ class PoolTradeServer:
             return in_mon.pid >> 16
         return 0
     
-    def handle_get_success3_i(self, index):
+    def get_missing_stage(self, stage):
         """
-        If the proper steps have been taken, it sends a success signal.
-        If not, it requests whatever data it is missing.
-        The client has to have already sent a success.
-        """
-        if self.mon_index is not None:
-            ret = self.check_retransmits3(index + 1 + self.num_accepts[self.gen])
-            if ret is not None:
-                return ret
-            if self.last_success[index] is None or self.last_success[index] != self.received_success[index][0]:
-                self.last_success[index] = self.received_success[index][0]
-                self.own_id = GSCUtilsMisc.inc_byte(self.own_id)
-            success = self.can_continue
-            if self.received_mon[1] is None:
-                success = False
-            if success:
-                for i in range(self.num_accepts[self.gen]):
-                    if (self.received_accepted[i][1] & 0xFF0000) != PoolTradeServer.accept_trade[self.gen][i]:
-                        success = False
-            if success:
-                for i in range(self.num_accepts[self.gen]):
-                    if(self.received_accepted[i][1] & 0xFFFF) != self.received_mon[1][0].get_species():
-                        success = False
-            if success:
-                for i in range(index + 1):
-                    if (self.received_success[i][1] & 0xFF0000) != PoolTradeServer.success_value[self.gen][i]:
-                        success = False
-            if success:
-                for i in range(index + 1):
-                    if(self.received_success[i][1] & 0xFFFF) != self.expected_gen3_success_value(i, self.received_mon[1][0], self.mon[0]):
-                        success = False
-            if success:
-                if index == (self.num_successes[self.gen]-1):
-                    self.clear_pool = True
-                    if not self.mon_index in in_use_mons[self.gen]:
-                        in_use_mons[self.gen].add(self.mon_index)
-                    mons[self.gen][self.mon_index] = self.received_mon[1]
-                    ServerUtils.save_mons(self.gen)
-                    try:
-                        in_use_mons[self.gen].remove(self.mon_index)
-                    except:
-                        pass
-                return self.hll.prepare_send_data(self.trading_client_class.success_transfer[index], [self.own_id] + GSCUtilsMisc.to_n_bytes_le(PoolTradeServer.success_value[self.gen][index] | self.expected_gen3_success_value(index, self.mon[0], self.received_mon[1][0]), 3))
-            else:
-                self.can_continue = False
-                return self.hll.prepare_send_data(self.trading_client_class.success_transfer[index], [self.own_id] + GSCUtilsMisc.to_n_bytes_le(PoolTradeServer.failure_value[self.gen], 3))
-        return None
-
-    def check_retransmits(self, counter):
+        Returns the step the client has to send (again) before
+        the server can answer for the given one, if any.
         """
-        Handles checking that the requested data is present.
-        If not, it prepares a request for retransmission.
-        """
-        ordered_transfer = [self.received_mon, self.received_accepted, self.received_success, None]
-        ordered_transfer_strings = [self.trading_client_class.choice_transfer, self.trading_client_class.accept_transfer, self.trading_client_class.success_transfer, None]
-        for i in range(1, counter+1):
-            if ordered_transfer[i-1] is None or (ordered_transfer[i] is not None and (ordered_transfer[i][0] != GSCUtilsMisc.inc_byte(ordered_transfer[i-1][0]))):
-                return self.hll.prepare_get_data(ordered_transfer_strings[i-1])
+        if (self.broken_chain is not None) and (self.broken_chain <= stage):
+            return self.broken_chain - 1
+        if self.cursor <= stage:
+            return self.cursor
         return None
-
-    def check_retransmits3(self, counter):
+    
+    def handle_get_stage(self, stage):
         """
-        Handles checking that the requested data is present.
-        If not, it prepares a request for retransmission.
+        If the proper steps have been taken, it answers with
+        whether the accept or the success went through.
+        If not, it requests whatever data it is missing.
+        Once the last success goes through, the Pokémon is stored.
         """
-        ordered_transfer = [self.received_mon, self.received_accepted[0], self.received_accepted[1], self.received_success[0], self.received_success[1], self.received_success[2], self.received_success[3], self.received_success[4], self.received_success[5], self.received_success[6], None]
-        ordered_transfer_strings = [self.trading_client_class.pool_transfer_out, self.trading_client_class.accept_transfer[0], self.trading_client_class.accept_transfer[1], self.trading_client_class.success_transfer[0], self.trading_client_class.success_transfer[1], self.trading_client_class.success_transfer[2], self.trading_client_class.success_transfer[3], self.trading_client_class.success_transfer[4], self.trading_client_class.success_transfer[5], self.trading_client_class.success_transfer[6], None]
-        for i in range(1, counter+1):
-            if ordered_transfer[i-1] is None or (ordered_transfer[i] is not None and (ordered_transfer[i][0] != GSCUtilsMisc.inc_byte(ordered_transfer[i-1][0]))):
-                return self.hll.prepare_get_data(ordered_transfer_strings[i-1])
-        return None
+        if self.mon_index is None:
+            return None
+        missing_stage = self.get_missing_stage(stage)
+        if missing_stage is not None:
+            return self.hll.prepare_get_data(self.table.transfers[missing_stage])
+        id = self.received[stage][0]
+        if self.last_ids[stage] != id:
+            self.last_ids[stage] = id
+            self.own_id = GSCUtilsMisc.inc_byte(self.own_id)
+        success = self.can_continue and (self.valid_stages > stage)
+        if success:
+            value = self.get_stage_value(stage, self.mon[0], self.get_received_mon()[0])
+            if (stage == self.table.last_stage) and (not self.clear_pool):
+                self.clear_pool = True
+                ServerUtils.store_mon(self.mon_index, self.gen, self.get_received_mon())
+        elif self.table.kinds[stage] == PoolHandshakeTable.ACCEPT_STAGE:
+            value = PoolTradeServer.decline_trade[self.gen][self.table.indexes[stage]]
+        else:
+            if self.table.signals_failure:
+                self.can_continue = False
+            value = PoolTradeServer.failure_value[self.gen]
+        return self.hll.prepare_send_data(self.table.transfers[stage], [self.own_id] + GSCUtilsMisc.to_n_bytes_le(value, self.table.value_len))
     
-    def handle_recv_mon(self, data):
+    def is_stage_valid(self, stage, value):
         """
-        Gets the pokémon the client wants to put into the Pool.
+        Checks a received step. Only called if the steps before it are valid.
         """
-        if self.mon_index is not None:
-            id = data[0]
-            mon = self.utils_class.single_mon_from_data(self.checks, data[2:])
-            self.received_accepted = None
-            self.received_success = None
-            self.received_mon = [id, mon]
-        return None
+        if self.table.kinds[stage] == PoolHandshakeTable.MON_STAGE:
+            return value is not None
+        return value == self.get_stage_value(stage, self.get_received_mon()[0], self.mon[0])
     
-    def handle_recv_accepted(self, data):
-        if self.mon_index is not None and self.received_mon is not None:
-            id = data[0]
-            self.received_success = None
-            self.received_accepted = [id, data[1]]
-        return None
-    
-    def handle_recv_success(self, data):
-        if self.mon_index is not None and self.received_mon is not None and self.received_accepted is not None:
-            id = data[0]
-            self.received_success = [id, data[1]]
-        return None
-    
-    def handle_recv_mon3(self, data):
+    def handle_recv_stage(self, stage, data):
         """
-        Gets the pokémon the client wants to put into the Pool.
+        Stores a step of the handshake, i.e. the Pokémon the client
+        wants to put into the Pool, or one of its accepts and successes.
         """
-        if self.mon_index is not None:
-            id = data[0]
-            if len(data) > 1:
-                mon = self.utils_class.single_mon_from_data(self.checks, data[1:])
-            else:
-                mon = None
-            self.reset_gen3_accepted()
-            self.reset_gen3_success()
-            self.received_mon = [id, mon]
-        return None
-    
-    def handle_recv_accepted3_0(self, data):
-        return self.handle_recv_accepted3_i(data, 0)
-    
-    def handle_recv_accepted3_1(self, data):
-        return self.handle_recv_accepted3_i(data, 1)
-    
-    def handle_recv_success3_0(self, data):
-        return self.handle_recv_success3_i(data, 0)
-    
-    def handle_recv_success3_1(self, data):
-        return self.handle_recv_success3_i(data, 1)
-    
-    def handle_recv_success3_2(self, data):
-        return self.handle_recv_success3_i(data, 2)
-    
-    def handle_recv_success3_3(self, data):
-        return self.handle_recv_success3_i(data, 3)
-    
-    def handle_recv_success3_4(self, data):
-        return self.handle_recv_success3_i(data, 4)
+        if (self.mon_index is None) or (stage > self.cursor):
+            return
+        id = data[0]
+        if self.table.kinds[stage] == PoolHandshakeTable.MON_STAGE:
+            value = None
+            if len(data) > self.table.mon_data_pos:
+                value = self.utils_class.single_mon_from_data(self.checks, data[self.table.mon_data_pos:])
+        else:
+            value = GSCUtilsMisc.from_n_bytes_le(data[1:], self.table.value_len)
+        self.received[stage] = [id, value]
+        self.cursor = stage + 1
+        if (self.broken_chain is not None) and (self.broken_chain >= stage):
+            self.broken_chain = None
+        if (stage > 0) and (self.broken_chain is None) and (id != GSCUtilsMisc.inc_byte(self.received[stage - 1][0])):
+            self.broken_chain = stage
+        self.valid_stages = min(self.valid_stages, stage)
+        if (self.valid_stages == stage) and self.is_stage_valid(stage, value):
+            self.valid_stages = stage + 1
+        
+class LinkRelayTable:
+    """
+    Class which validates the relayed frames directly on their bytes,
+    in both the ASCII and the binary framing.
+    It also recognizes the GETs the server answers by itself.
+    """
+    FORWARD = True
+    INVALID_TRANSFER = "invalid"
+    tag_struct = struct.Struct(">I")
+    loaded_tables = {}
     
-    def handle_recv_success3_5(self, data):
-        return self.handle_recv_success3_i(data, 5)
+    def __init__(self, trading_client_class):
+        hll = HighLevelListener()
+        hll.set_valid_transfers(trading_client_class.possible_transfers, trading_client_class.binary_opcodes)
+        intercepted = [trading_client_class.version_server_transfer, trading_client_class.random_data_transfer]
+        self.send_byte = ord(GSCTradingStrings.send_request)
+        self.get_byte = ord(GSCTradingStrings.get_request)
+        self.ascii_sends = {}
+        self.ascii_gets = {}
+        self.binary_sends = [None] * 0x100
+        self.binary_gets = [None] * 0x100
+        self.invalid_transfer = ("", LinkRelayTable.INVALID_TRANSFER)
+        self.binary_transfers = [self.invalid_transfer] * 0x100
+        for transfer in trading_client_class.possible_transfers.keys():
+            tag = LinkRelayTable.get_tag(transfer)
+            self.ascii_sends[tag] = (trading_client_class.possible_transfers[transfer], (GSCTradingStrings.send_request, transfer))
+            self.ascii_gets[tag] = (LinkRelayTable.FORWARD, (GSCTradingStrings.get_request, transfer))
+        for transfer in intercepted:
+            self.ascii_gets[LinkRelayTable.get_tag(transfer)] = (transfer, (GSCTradingStrings.get_request, transfer))
+        for transfer in hll.transfer_opcodes.keys():
+            opcode = hll.transfer_opcodes[transfer]
+            self.binary_sends[HighLevelListener.BINARY_SEND_OPCODE | opcode] = trading_client_class.possible_transfers[transfer]
+            self.binary_gets[HighLevelListener.BINARY_GET_OPCODE | opcode] = LinkRelayTable.FORWARD
+            self.binary_transfers[HighLevelListener.BINARY_SEND_OPCODE | opcode] = (GSCTradingStrings.send_request, transfer)
+            self.binary_transfers[HighLevelListener.BINARY_GET_OPCODE | opcode] = (GSCTradingStrings.get_request, transfer)
+            if transfer in intercepted:
+                self.binary_gets[HighLevelListener.BINARY_GET_OPCODE | opcode] = transfer
+        self.unknown_get = (LinkRelayTable.FORWARD, self.invalid_transfer)
     
-    def handle_recv_success3_6(self, data):
-        return self.handle_recv_success3_i(data, 6)
+    def get_tag(transfer):
+        return LinkRelayTable.tag_struct.unpack(transfer.encode())[0]
     
-    def handle_recv_accepted3_i(self, data, index):
-        failed = False
-        if self.mon_index is None or self.received_mon is None:
-            failed = True
-        if not failed:
-            for i in range(index):
-                if self.received_accepted[i] is None:
-                    failed = True
-        if not failed:
-            id = data[0]
-            for i in range(index+1, self.num_accepts[self.gen]):
-                self.received_accepted[i] = None
-            self.reset_gen3_success()
-            self.received_accepted[index] = [id, GSCUtilsMisc.from_n_bytes_le(data[1:], 3)]
-        return None
+    def get_table(trading_client_class):
+        table = LinkRelayTable.loaded_tables.get(trading_client_class, None)
+        if table is None:
+            table = LinkRelayTable(trading_client_class)
+            LinkRelayTable.loaded_tables[trading_client_class] = table
+        return table
     
-    def handle_recv_success3_i(self, data, index):
-        failed = False
-        if self.mon_index is None or self.received_mon is None:
-            failed = True
-        if not failed:
-            for i in range(self.num_accepts[self.gen]):
-                if self.received_accepted[i] is None:
-                    failed = True
-        if not failed:
-            for i in range(index):
-                if self.received_success[i] is None:
-                    failed = True
-        if not failed:
-            id = data[0]
-            for i in range(index+1, self.num_successes[self.gen]):
-                self.received_success[i] = None
-            self.received_success[index] = [id, GSCUtilsMisc.from_n_bytes_le(data[1:], 3)]
-        return None
-        
+    def classify(self, data):
+        """
+        Returns None if the frame is invalid, FORWARD if it must be
+        relayed, or the transfer the server must answer by itself.
+        It also returns the kind of request and the transfer of the
+        frame, found with the same lookup.
+        """
+        if (not isinstance(data, bytes)) or (len(data) == 0):
+            return None, self.invalid_transfer
+        data_len_total = len(data)
+        first = data[0]
+        if first == self.send_byte:
+            if data_len_total <= HighLevelListener.DATA_POSITION:
+                return None, self.invalid_transfer
+            lengths, transfer = self.ascii_sends.get(LinkRelayTable.tag_struct.unpack_from(data, 1)[0], (None, self.invalid_transfer))
+            data_len = (data[HighLevelListener.LEN_POSITION] << 8) | data[HighLevelListener.LEN_POSITION + 1]
+            if (lengths is None) or (data_len not in lengths) or (data_len_total < (HighLevelListener.DATA_POSITION + data_len)):
+                return None, transfer
+            return LinkRelayTable.FORWARD, transfer
+        if first == self.get_byte:
+            if data_len_total < HighLevelListener.LEN_POSITION:
+                return None, self.invalid_transfer
+            return self.ascii_gets.get(LinkRelayTable.tag_struct.unpack_from(data, 1)[0], self.unknown_get)
+        transfer = self.binary_transfers[first]
+        lengths = self.binary_sends[first]
+        if lengths is not None:
+            data_len = 0
+            shift = 0
+            pos = 1
+            while True:
+                if pos >= data_len_total:
+                    return None, transfer
+                byte = data[pos]
+                data_len |= (byte & 0x7F) << shift
+                pos += 1
+                if byte < 0x80:
+                    break
+                shift += 7
+            if (data_len not in lengths) or (data_len_total < (pos + data_len)):
+                return None, transfer
+            return LinkRelayTable.FORWARD, transfer
+        return self.binary_gets[first], transfer
+
 class ProxyLinkServer:
     """
     Class which handles the 2-player trading part.
+    Frames relayed to a client are queued. Once HIGH_WATER_FRAMES are
+    queued, the sender waits for them to be sent, so a client which
+    doesn't read can't make the server buffer its peer's data.
+    More than MAX_BUFFERED_FRAMES queued frames, i.e. while the client
+    is dropped, end the link.
     """
+    MAX_BUFFERED_FRAMES = 0x400
+    HIGH_WATER_FRAMES = 0x40
     
     def __init__(self, gen, ws):
-        checks_class = RBYChecks
         self.trading_client_class = RBYTradingClient
         self.utils_class = RBYUtils
         if gen == 1:
-            checks_class = GSCChecks
             self.trading_client_class = GSCTradingClient
             self.utils_class = GSCUtils
         elif gen == 2:
-            checks_class = RSESPChecks
             self.trading_client_class = RSESPTradingClient
             self.utils_class = RSESPUtils
         self.server_data = ServerSpecificTransfers()
+        self.gen = gen
         self.other = None
         self.other_ws = None
         self.own_ws = ws
         self.hll = HighLevelListener()
-        self.hll.set_valid_transfers(self.trading_client_class.possible_transfers)
+        self.hll.set_valid_transfers(self.trading_client_class.possible_transfers, self.trading_client_class.binary_opcodes)
+        self.relay_table = LinkRelayTable.get_table(self.trading_client_class)
+        self.outbound = deque()
+        self.flushing = False
+        self.drained = asyncio.Event()
+        self.drained.set()
+        self.token = None
+        self.expiry = None
     
     async def process(self, data):
         """
         Processes the data. If valid, sends it to the other websocket.
         """
-        request = self.hll.is_received_valid(data)
-        if request is not None:
-            processed = False
-            if request[0] == GSCTradingStrings.get_request:
-                if request[1] == self.trading_client_class.version_server_transfer:
-                    await self.own_ws.send(ServerSpecificTransfers.handle_get_version(self.hll, self.trading_client_class.version_server_transfer))
-                    processed = True
-                elif request[1] == self.trading_client_class.random_data_transfer:
-                    await self.own_ws.send(self.server_data.handle_get_random(self.hll, self.trading_client_class.random_data_transfer))
-                    processed = True
-            if not processed:
-                if (self.other is not None) and (self.other.other == self):
-                    await self.other_ws.send(data)
-                else:
-                    self.other = None
-                    self.other_ws = None
-                    await self.own_ws.close()
+        request, transfer = self.relay_table.classify(data)
+        metrics.inc("link_messages_total", (self.gen + 1, transfer[0], transfer[1]))
+        if request is None:
+            return
+        if request is not LinkRelayTable.FORWARD:
+            # Answer using the same framing as the request
+            self.hll.set_binary_framing(data[0] >= HighLevelListener.BINARY_SEND_OPCODE)
+            if request == self.trading_client_class.version_server_transfer:
+                await ServerUtils.try_send(self.own_ws, ServerSpecificTransfers.handle_get_version(self.hll, self.trading_client_class.version_server_transfer))
+            else:
+                await ServerUtils.try_send(self.own_ws, self.server_data.handle_get_random(self.hll, self.trading_client_class.random_data_transfer))
+        elif (self.other is not None) and (self.other.other == self):
+            await self.other.relay(data)
+        else:
+            self.other = None
+            self.other_ws = None
+            await self.own_ws.close()
+    
+    async def relay(self, data):
+        """
+        Queues data coming from the other client. The queued data
+        is sent by a single task, one websocket message per frame,
+        since the clients parse one frame per message.
+        While the connection is dropped, it's only buffered.
+        Otherwise, if too much data is queued, it waits for it to be sent.
+        """
+        self.outbound.append(data)
+        if len(self.outbound) > ProxyLinkServer.MAX_BUFFERED_FRAMES:
+            # The link is closed from its own task, the caller is receiving
+            asyncio.ensure_future(self.end_link())
+            return
+        if self.own_ws is None:
+            return
+        self.start_flush()
+        if len(self.outbound) >= ProxyLinkServer.HIGH_WATER_FRAMES:
+            self.drained.clear()
+            await self.drained.wait()
+    
+    def start_flush(self):
+        if (not self.flushing) and (len(self.outbound) > 0):
+            self.flushing = True
+            asyncio.ensure_future(self.flush())
+    
+    async def flush(self):
+        """
+        Sends the queued data. A frame is only dequeued once it's sent,
+        so the ones which didn't make it are sent again on resume.
+        """
+        try:
+            while (len(self.outbound) > 0) and (self.own_ws is not None):
+                ws = self.own_ws
+                try:
+                    await ws.send(self.outbound[0])
+                except websockets.ConnectionClosed:
+                    if ws is self.own_ws:
+                        break
+                    continue
+                self.outbound.popleft()
+                if len(self.outbound) < ProxyLinkServer.HIGH_WATER_FRAMES:
+                    self.drained.set()
+        finally:
+            self.flushing = False
+    
+    def detach(self):
+        """
+        Keeps this side of the link after its connection dropped,
+        for GRACE_PERIOD seconds.
+        """
+        self.own_ws = None
+        # Only buffer while it's dropped
+        self.drained.set()
+        self.expiry = asyncio.get_running_loop().call_later(LinkSessionRegistry.GRACE_PERIOD, lambda: asyncio.ensure_future(self.expire()))
+    
+    def attach(self, ws):
+        """
+        Resumes this side of the link on a new connection,
+        and sends it the data buffered in the meantime.
+        """
+        if self.expiry is not None:
+            self.expiry.cancel()
+            self.expiry = None
+        self.own_ws = ws
+        self.other.other_ws = ws
+        self.start_flush()
+    
+    async def expire(self):
+        metrics.inc("link_resumes_total", ("expired",))
+        await self.end_link()
     
-class WebsocketServer (threading.Thread):
+    async def end_link(self):
+        """
+        Closes both sides of the link. Their tokens can't be used anymore.
+        """
+        other = self.other
+        if other is None:
+            return
+        link_rooms.end_link()
+        for proxy in [self, other]:
+            link_sessions.revoke(proxy)
+            if proxy.expiry is not None:
+                proxy.expiry.cancel()
+                proxy.expiry = None
+            proxy.other = None
+            proxy.other_ws = None
+            proxy.outbound.clear()
+            proxy.drained.set()
+        for proxy in [self, other]:
+            if proxy.own_ws is not None:
+                await proxy.own_ws.close()
+    
+class IdleConnectionReaper:
+    """
+    Class which keeps track of when each connection last sent something,
+    and periodically closes the ones which have been idle for too long,
+    giving back the Pool slots and the rooms they were holding.
+    How long a connection can be idle depends on its state.
+    Linked clients are only closed by the keepalive, since
+    the players can take their time, and waiting rooms expire
+    after LinkRoomRegistry.WAITING_TIMEOUT.
+    Pool clients are closed after handshake_timeout if they hold
+    a Pokémon, and after IDLE_TIMEOUT if they don't, even if they
+    answer the keepalive, since that doesn't mean they're trading.
+    Clients don't send anything while the player is in the trade menu,
+    so handshake_timeout is long.
+    """
+    SWEEP_TIMER = 60
+    HANDSHAKE_TIMEOUT = 60 * 60
+    IDLE_TIMEOUT = 15 * 60
+    
+    def __init__(self):
+        self.connections = {}
+        self.handshake_timeout = IdleConnectionReaper.HANDSHAKE_TIMEOUT
+    
+    def register(self, websocket, path):
+        """
+        Returns the connection's entry: its path, its processer
+        and when it was last active.
+        """
+        entry = [path, None, monotonic()]
+        self.connections[websocket] = entry
+        return entry
+    
+    def unregister(self, websocket):
+        self.connections.pop(websocket, None)
+    
+    def is_holding_mon(processer):
+        return (processer is not None) and (processer.mon_index is not None) and (not processer.clear_pool)
+    
+    def get_timeout(self, path, processer):
+        """
+        Returns for how long the connection can be idle,
+        or None if it's not up to the reaper.
+        """
+        if path.startswith("/pool"):
+            if IdleConnectionReaper.is_holding_mon(processer):
+                return self.handshake_timeout
+            return IdleConnectionReaper.IDLE_TIMEOUT
+        if path.startswith("/link") and (processer is not None):
+            return None
+        return IdleConnectionReaper.IDLE_TIMEOUT
+    
+    def sweep(self):
+        """
+        Closes the idle connections and the expired waiting rooms.
+        Returns how many of each resource it reclaimed.
+        Link connections are also counted separately.
+        """
+        reclaimed = {"connections": 0, "link_connections": 0, "pool_slots": 0, "waiting_rooms": 0}
+        to_close = []
+        for proxy in link_rooms.expire():
+            reclaimed["waiting_rooms"] += 1
+            reclaimed["link_connections"] += 1
+            to_close += [proxy.own_ws]
+        now = monotonic()
+        for websocket in list(self.connections.keys()):
+            path, processer, last_activity = self.connections[websocket]
+            timeout = self.get_timeout(path, processer)
+            if (timeout is None) or ((now - last_activity) < timeout):
+                continue
+            if path.startswith("/pool") and IdleConnectionReaper.is_holding_mon(processer):
+                in_use_mons[processer.gen].release(processer.mon_index)
+                # So the cleaner doesn't release it again
+                processer.mon_index = None
+                reclaimed["pool_slots"] += 1
+            if path.startswith("/link"):
+                reclaimed["link_connections"] += 1
+            # Closing may take a while, don't count it twice
+            self.unregister(websocket)
+            to_close += [websocket]
+        reclaimed["connections"] = len(to_close)
+        for websocket in to_close:
+            asyncio.ensure_future(websocket.close())
+        return reclaimed
+    
+    async def run(self):
+        while True:
+            await asyncio.sleep(IdleConnectionReaper.SWEEP_TIMER)
+            reclaimed = self.sweep()
+            metrics.inc("pool_trade_reaped_total", ("connections",), reclaimed["connections"] - reclaimed["link_connections"])
+            metrics.inc("pool_trade_reaped_total", ("pool_slots",), reclaimed["pool_slots"])
+            metrics.inc("link_reaped_total", ("connections",), reclaimed["link_connections"])
+            metrics.inc("link_reaped_total", ("waiting_rooms",), reclaimed["waiting_rooms"])
+            if reclaimed["connections"] > 0:
+                print("Reaped " + str(reclaimed["connections"]) + " idle connections, " + str(reclaimed["pool_slots"]) + " Pool slots and " + str(reclaimed["waiting_rooms"]) + " waiting rooms.")
+
+idle_reaper = IdleConnectionReaper()
+
+class WebsocketServer:
     '''
     Class which handles responding to the websocket requests.
+    Keepalive pings are sent every keepalive_interval seconds,
+    and connections which don't answer within keepalive_timeout
+    seconds are dropped.
     '''
+    DRAIN_TIMEOUT = 60
+    DRAIN_CHECK_TIMER = 0.5
+    NORMAL_CLOSURE = 1000
+    GOING_AWAY = 1001
+    METRICS_HOST = "127.0.0.1"
+    worker_index = 0
+    worker_socket_paths = []
     
-    def __init__(self, host="", port=11111):
-        threading.Thread.__init__(self)
-        self.daemon=True
+    def __init__(self, host="", port=11111, num_workers=1, metrics_port=11112, keepalive_interval=20, keepalive_timeout=20, handshake_timeout=IdleConnectionReaper.HANDSHAKE_TIMEOUT):
         self.host = host
+        self.stop_event = None
+        self.metrics_server = None
+        self.reaper_task = None
         try:
             self.port = int(os.environ["PORT"])
         except KeyError as e:
             self.port = port
+        try:
+            self.metrics_port = int(os.environ["METRICS_PORT"])
+        except KeyError as e:
+            self.metrics_port = metrics_port
+        try:
+            self.num_workers = int(os.environ["WORKERS"])
+        except KeyError as e:
+            self.num_workers = num_workers
+        try:
+            self.keepalive_interval = float(os.environ["KEEPALIVE_INTERVAL"])
+        except KeyError as e:
+            self.keepalive_interval = keepalive_interval
+        try:
+            self.keepalive_timeout = float(os.environ["KEEPALIVE_TIMEOUT"])
+        except KeyError as e:
+            self.keepalive_timeout = keepalive_timeout
+        try:
+            self.handshake_timeout = float(os.environ["HANDSHAKE_TIMEOUT"])
+        except KeyError as e:
+            self.handshake_timeout = handshake_timeout
+        # 0 disables the pings
+        if self.keepalive_interval <= 0:
+            self.keepalive_interval = None
+        idle_reaper.handshake_timeout = self.handshake_timeout
+        if not hasattr(os, "fork"):
+            self.num_workers = 1
+        if self.num_workers > 1:
+            for gen in range(len(in_use_mons)):
+                in_use_mons[gen] = SharedPoolSlotAllocator()
         self.checks = [RBYChecks([0,0,0], True), GSCChecks([0,0,0], True), RSESPChecks([0,0,0], True)]
-        ServerUtils.load_mons(self.checks[0], 0)
-        ServerUtils.load_mons(self.checks[1], 1)
-        ServerUtils.load_mons(self.checks[2], 2)
+        ServerUtils.load_all_mons(self.checks)
+        if self.num_workers > 1:
+            for journal in mons_journals:
+                journal.set_lock(multiprocessing.Lock())
+        self.compactor = PoolJournalCompactor(mons_journals)
+        WebsocketServer.prepare_metrics()
 
     async def link_function(websocket, data, path, link_proxy):
         '''
@@ -649,26 +1501,58 @@ class WebsocketServer (threading.Thread):
             gen = WebsocketServer.get_gen(path)
             room = int(path[7:12])
             if link_proxy is None:
+                token = WebsocketServer.get_resume_token(path)
+                if token is not None:
+                    return room, await WebsocketServer.resume_link(websocket, gen, token)
                 link_proxy = ProxyLinkServer(gen, websocket)
             if link_proxy.other_ws is None:
-                if len(link_rooms[gen][room]) == 0:
-                    if link_proxy not in link_rooms[gen][room]:
-                        link_rooms[gen][room].add(link_proxy)
-                elif link_proxy not in link_rooms[gen][room]:
-                    other_proxy = link_rooms[gen][room].pop()
+                expired_proxies = link_rooms.expire()
+                for expired_proxy in expired_proxies:
+                    await expired_proxy.own_ws.close()
+                if link_proxy in expired_proxies:
+                    return room, link_proxy
+                other_proxy = link_rooms.join(gen, room, link_proxy)
+                if other_proxy is not None:
                     other_proxy.other_ws = link_proxy.own_ws
                     other_proxy.other = link_proxy
                     link_proxy.other = other_proxy
                     link_proxy.other_ws = other_proxy.own_ws
                     repl = ["CLIENT", "CLIENT"]
-                    reply_old = repl[0]
-                    reply_new = repl[1]
-                    await link_proxy.other_ws.send(reply_old)
-                    await link_proxy.own_ws.send(reply_new)
+                    reply_old = repl[0] + " " + link_sessions.issue(other_proxy)
+                    reply_new = repl[1] + " " + link_sessions.issue(link_proxy)
+                    await ServerUtils.try_send(link_proxy.other_ws, reply_old)
+                    await ServerUtils.try_send(link_proxy.own_ws, reply_new)
             else:
                 await link_proxy.process(data)
         return room, link_proxy
     
+    def get_resume_token(path):
+        return parse_qs(urlsplit(path).query).get("resume", [None])[0]
+    
+    async def resume_link(websocket, gen, token):
+        """
+        Reattaches a client whose connection dropped to its side
+        of the link. If the token isn't valid, the connection is closed.
+        """
+        link_proxy = link_sessions.get(token)
+        if (link_proxy is None) or (link_proxy.gen != gen):
+            metrics.inc("link_resumes_total", ("rejected",))
+            await websocket.close()
+            return None
+        await ServerUtils.try_send(websocket, "CLIENT " + token)
+        # The link may have expired in the meantime
+        if link_proxy.other is None:
+            metrics.inc("link_resumes_total", ("rejected",))
+            await websocket.close()
+            return None
+        old_ws = link_proxy.own_ws
+        link_proxy.attach(websocket)
+        metrics.inc("link_resumes_total", ("resumed",))
+        # The old connection may be still open, if the client noticed the drop first
+        if old_ws is not None:
+            await old_ws.close()
+        return link_proxy
+    
     async def pool_function(websocket, data, path, pool_trader):
         '''
         Handler which handles pool trading messages.
@@ -681,6 +1565,62 @@ class WebsocketServer (threading.Thread):
         
         return pool_trader
     
+    def prepare_metrics():
+        metrics.add_family("pool_trade_connections_total", ServerMetrics.COUNTER, "Non-link connections opened, by path and generation.", ["path", "gen"])
+        metrics.add_family("pool_trade_open_connections", ServerMetrics.GAUGE, "Non-link connections currently open, by path and generation.", ["path", "gen"])
+        metrics.add_family("link_connections_total", ServerMetrics.COUNTER, "Link connections opened, by generation.", ["gen"])
+        metrics.add_family("link_open_connections", ServerMetrics.GAUGE, "Link connections currently open, by generation.", ["gen"])
+        metrics.add_family("pool_trade_messages_total", ServerMetrics.COUNTER, "Pool messages received, by generation, request and transfer.", ["gen", "request", "transfer"])
+        metrics.add_family("link_messages_total", ServerMetrics.COUNTER, "Relayed link messages, by generation, request and transfer.", ["gen", "request", "transfer"])
+        metrics.add_family("pool_trade_handler_latency_seconds", ServerMetrics.HISTOGRAM, "Time spent handling a single non-link message.", ["path", "gen"])
+        metrics.add_family("link_handler_latency_seconds", ServerMetrics.HISTOGRAM, "Time spent handling a single link message.", ["gen"])
+        metrics.add_family("link_rooms", ServerMetrics.GAUGE, "Link rooms, by state.", ["state"])
+        metrics.add_family("link_resumes_total", ServerMetrics.COUNTER, "Dropped link connections, by whether they were resumed.", ["result"])
+        metrics.add_family("pool_trade_reaped_total", ServerMetrics.COUNTER, "Resources reclaimed from idle non-link connections, by kind.", ["resource"])
+        metrics.add_family("link_reaped_total", ServerMetrics.COUNTER, "Resources reclaimed from idle link connections, by kind.", ["resource"])
+        metrics.add_family("pool_trade_pool_slots", ServerMetrics.GAUGE, "Pool slots, by generation and state.", ["gen", "state"])
+        metrics.add_collector(WebsocketServer.collect_metrics)
+        WebsocketServer.prepare_snapshot_metrics(metrics)
+    
+    def prepare_snapshot_metrics(metrics):
+        """
+        The snapshots are uploaded by the process which runs the flusher.
+        """
+        metrics.add_family("pool_snapshot_lag_seconds", ServerMetrics.GAUGE, "Time the Pool's changes have been waiting to be uploaded, by generation.", ["gen"])
+        metrics.add_family("pool_snapshot_failed_uploads_total", ServerMetrics.COUNTER, "Failed Pool snapshot upload attempts.")
+        metrics.add_collector(WebsocketServer.collect_snapshot_metrics)
+    
+    def collect_snapshot_metrics(metrics):
+        if flusher is None:
+            return
+        for gen in range(len(mons_journals)):
+            if mons_journals[gen] is not None:
+                metrics.set("pool_snapshot_lag_seconds", (gen + 1,), flusher.get_lag(gen))
+        metrics.set("pool_snapshot_failed_uploads_total", (), flusher.failed_uploads)
+    
+    def collect_metrics(metrics):
+        """
+        Reads the current state of the rooms and of the Pool.
+        """
+        metrics.set("link_rooms", ("waiting",), link_rooms.get_num_waiting())
+        metrics.set("link_rooms", ("paired",), link_rooms.get_num_active())
+        for gen in range(len(mons)):
+            if mons[gen] is not None:
+                metrics.set("pool_trade_pool_slots", (gen + 1, "in_use"), len(in_use_mons[gen]))
+                metrics.set("pool_trade_pool_slots", (gen + 1, "total"), len(mons[gen]))
+    
+    def get_metrics_labels(path):
+        """
+        Returns the prefix of the connection's families and its labels.
+        Link connections have their own families.
+        """
+        for kind in ["link", "pool"]:
+            if path.startswith("/" + kind) and (len(path) > 5) and path[5].isdigit():
+                if kind == "link":
+                    return "link_", (WebsocketServer.get_gen(path) + 1,)
+                return "pool_trade_", (kind, WebsocketServer.get_gen(path) + 1)
+        return "pool_trade_", ("other", 0)
+    
     def get_gen(path):
         gen = int(path[5]) - 1
         if gen >= 3:
@@ -689,71 +1629,273 @@ class WebsocketServer (threading.Thread):
             gen = 0
         return gen
         
-    async def cleaner(identifier, processer, path):
+    async def cleaner(identifier, processer, path, websocket):
         gen = WebsocketServer.get_gen(path)
         if path.startswith("/link"):
-            if processer in link_rooms[gen][identifier]:
-                link_rooms[gen][identifier].remove(processer)
-            if processer is not None and processer.other_ws is not None:
-                other = processer.other
-                processer.other = None
-                processer.other_ws = None
-                other.other = None
-                other.other_ws = None
-                await other.own_ws.close()
+            link_rooms.leave(gen, identifier, processer)
+            # After a resume, the old connection has nothing to clean
+            if processer is not None and processer.other_ws is not None and processer.own_ws is websocket:
+                if websocket.close_code == WebsocketServer.NORMAL_CLOSURE:
+                    await processer.end_link()
+                else:
+                    processer.detach()
         if path.startswith("/pool"):
             if processer is not None and processer.mon_index is not None and not processer.clear_pool:
-                if processer.mon_index in in_use_mons[gen]:
-                    in_use_mons[gen].remove(processer.mon_index)
+                in_use_mons[gen].release(processer.mon_index)
 
+    def get_link_owner(path):
+        """
+        Returns the worker which handles the link room.
+        """
+        num_workers = len(WebsocketServer.worker_socket_paths)
+        if (num_workers <= 1) or (len(path) < 12):
+            return WebsocketServer.worker_index
+        return ((WebsocketServer.get_gen(path) * total_rooms) + int(path[7:12])) % num_workers
+    
+    async def forward_to_owner(websocket, path, owner):
+        """
+        Relays a link connection to the worker which handles its room,
+        so both the clients of a room end up in the same worker.
+        """
+        async def pipe(source, destination):
+            async for message in source:
+                await destination.send(message)
+        try:
+            async with websockets.unix_connect(WebsocketServer.worker_socket_paths[owner], "ws://localhost" + path, ping_interval=None) as owner_ws:
+                tasks = [asyncio.ensure_future(pipe(websocket, owner_ws)), asyncio.ensure_future(pipe(owner_ws, websocket))]
+                done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.exception()
+                for task in pending:
+                    task.cancel()
+                # Let the owner know whether the client can still resume
+                if websocket.close_code not in [None, WebsocketServer.NORMAL_CLOSURE]:
+                    await owner_ws.close(code=WebsocketServer.GOING_AWAY)
+        except websockets.ConnectionClosed:
+            pass
+        except Exception as e:
+            print('Websocket server error:', str(e))
+        await websocket.close()
+    
     async def handler(websocket, path):
         """
         Gets the data and then calls the proper handler while keeping
         the connection active.
         """
+        if path.startswith("/link"):
+            owner = WebsocketServer.get_link_owner(path)
+            if owner != WebsocketServer.worker_index:
+                await WebsocketServer.forward_to_owner(websocket, path, owner)
+                return
         curr_room = 100000
         processer = None
-        while True:
-            try:
-                data = await websocket.recv()
-            except websockets.ConnectionClosed:
-                print(f"Terminated")
-                await WebsocketServer.cleaner(curr_room, processer, path)
-                break
-            except Exception as e:
-                print('Websocket server error:', str(e))
-                await WebsocketServer.cleaner(curr_room, processer, path)
-                break
-            if path.startswith("/link"):
-                curr_room, processer = await WebsocketServer.link_function(websocket, data, path, processer)
-            if path.startswith("/pool"):
-                processer = await WebsocketServer.pool_function(websocket, data, path, processer)
+        prefix, labels = WebsocketServer.get_metrics_labels(path)
+        metrics.inc(prefix + "connections_total", labels)
+        metrics.inc(prefix + "open_connections", labels)
+        activity = idle_reaper.register(websocket, path)
+        try:
+            while True:
+                try:
+                    data = await websocket.recv()
+                except websockets.ConnectionClosed:
+                    print("Terminated")
+                    await WebsocketServer.cleaner(curr_room, processer, path, websocket)
+                    break
+                except Exception as e:
+                    print('Websocket server error:', str(e))
+                    await WebsocketServer.cleaner(curr_room, processer, path, websocket)
+                    break
+                start = perf_counter()
+                if path.startswith("/link"):
+                    curr_room, processer = await WebsocketServer.link_function(websocket, data, path, processer)
+                if path.startswith("/pool"):
+                    processer = await WebsocketServer.pool_function(websocket, data, path, processer)
+                metrics.observe(prefix + "handler_latency_seconds", labels, perf_counter() - start)
+                activity[1] = processer
+                activity[2] = monotonic()
+        finally:
+            idle_reaper.unregister(websocket)
+            metrics.inc(prefix + "open_connections", labels, -1)
                 
+    def has_active_trades():
+        for gen in range(len(in_use_mons)):
+            if len(in_use_mons[gen]) > 0:
+                return True
+        return link_rooms.get_num_active() > 0
+    
+    def is_worker(self):
+        return len(WebsocketServer.worker_socket_paths) > 0
+    
+    def request_stop(self):
+        """
+        Starts the shutdown. If it was already started, exits right away.
+        Workers are only stopped through their parent, which never asks twice.
+        """
+        if self.stop_event.is_set():
+            if not self.is_worker():
+                exit_gracefully()
+            return
+        print('Shutting down...')
+        self.stop_event.set()
+    
+    def register_signals(self, loop):
+        stop_signals = [signal.SIGINT, signal.SIGTERM]
+        if self.is_worker():
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            stop_signals = [signal.SIGTERM]
+        for sig in stop_signals:
+            try:
+                loop.add_signal_handler(sig, self.request_stop)
+            except NotImplementedError:
+                signal.signal(sig, lambda sig, frame: loop.call_soon_threadsafe(self.request_stop))
+    
+    async def drain(self, servers):
+        """
+        Stops accepting connections, waits for the active trades
+        to finish, up to DRAIN_TIMEOUT seconds, and then closes
+        the remaining connections and saves the Pool.
+        """
+        loop = asyncio.get_running_loop()
+        for server in servers:
+            server.server.close()
+        deadline = monotonic() + WebsocketServer.DRAIN_TIMEOUT
+        while WebsocketServer.has_active_trades() and (monotonic() < deadline):
+            await asyncio.sleep(WebsocketServer.DRAIN_CHECK_TIMER)
+        self.reaper_task.cancel()
+        for server in servers:
+            server.close()
+            await server.wait_closed()
+        await loop.run_in_executor(None, ServerUtils.flush_mons)
+        await self.metrics_server.close()
+    
+    async def start_metrics_server(self):
+        """
+        Serves the metrics on localhost only.
+        Each worker uses the port after the previous worker's one.
+        """
+        self.metrics_server = MetricsHTTPServer(metrics)
+        try:
+            await self.metrics_server.start(WebsocketServer.METRICS_HOST, self.metrics_port + WebsocketServer.worker_index)
+        except OSError as e:
+            print('Metrics server error:', str(e))
+    
+    def start_supervisor_metrics_server(self):
+        """
+        With more than one worker, the snapshots are uploaded by
+        the supervisor, so it serves their metrics on the port
+        after the last worker's one.
+        """
+        supervisor_metrics = ServerMetrics()
+        WebsocketServer.prepare_snapshot_metrics(supervisor_metrics)
+        async def serve_metrics():
+            metrics_server = MetricsHTTPServer(supervisor_metrics)
+            try:
+                await metrics_server.start(WebsocketServer.METRICS_HOST, self.metrics_port + self.num_workers)
+            except OSError as e:
+                print('Metrics server error:', str(e))
+                return
+            await asyncio.Event().wait()
+        metrics_thread = threading.Thread(target=asyncio.run, args=(serve_metrics(),), daemon=True)
+        metrics_thread.start()
+    
+    async def serve(self):
+        """
+        Runs the server until it's asked to stop.
+        Workers also listen on their own unix socket, which
+        the other workers use to relay link rooms to them.
+        The metrics are served on localhost, on a separate port.
+        """
+        loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        self.register_signals(loop)
+        servers = [await websockets.serve(WebsocketServer.handler, self.host, self.port, reuse_port=self.is_worker(), ping_interval=self.keepalive_interval, ping_timeout=self.keepalive_timeout, close_timeout=self.keepalive_timeout)]
+        if self.is_worker():
+            # The forwarding worker's connection already has the keepalive
+            servers += [await websockets.unix_serve(WebsocketServer.handler, WebsocketServer.worker_socket_paths[WebsocketServer.worker_index], ping_interval=None)]
+        await self.start_metrics_server()
+        self.reaper_task = asyncio.ensure_future(idle_reaper.run())
+        await self.stop_event.wait()
+        await self.drain(servers)
+    
+    def run_worker(self, worker_index):
+        WebsocketServer.worker_index = worker_index
+        for allocator in in_use_mons:
+            allocator.reseed()
+        asyncio.run(self.serve())
+    
     def run(self):
         """
-        Runs the server in a second Thread in order to keep
-        the program responsive.
+        Runs the server. With more than one worker, it forks them,
+        and then waits for them to exit.
+        If a worker dies while the server is running, the others are
+        stopped too, since it may have been holding a shared lock,
+        and the process exits with an error, so it can be restarted.
         """
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        start_server = websockets.serve(WebsocketServer.handler, self.host, self.port)
-        loop.run_until_complete(start_server)
-        loop.run_forever()
+        if self.num_workers <= 1:
+            self.compactor.start()
+            ServerUtils.start_flusher()
+            asyncio.run(self.serve())
+            return
+        socket_base = os.path.join(tempfile.gettempdir(), "pool_trade_server_" + str(os.getpid()) + "_")
+        WebsocketServer.worker_socket_paths = [socket_base + str(i) + ".sock" for i in range(self.num_workers)]
+        workers = []
+        for i in range(self.num_workers):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    self.run_worker(i)
+                finally:
+                    os._exit(0)
+            workers += [pid]
+        self.compactor.start()
+        # The changes happen inside of the workers, so check all the snapshots
+        ServerUtils.start_flusher(always_check=True)
+        self.start_supervisor_metrics_server()
+        stopping = [False]
+        def stop_workers(sig, frame):
+            stop_signal = signal.SIGTERM
+            if stopping[0]:
+                stop_signal = signal.SIGKILL
+            print('Shutting down...')
+            stopping[0] = True
+            for pid in workers:
+                try:
+                    os.kill(pid, stop_signal)
+                except ProcessLookupError:
+                    pass
+        signal.signal(signal.SIGINT, stop_workers)
+        signal.signal(signal.SIGTERM, stop_workers)
+        running_workers = list(workers)
+        worker_died = False
+        while len(running_workers) > 0:
+            pid, status = os.wait()
+            if pid not in running_workers:
+                continue
+            running_workers.remove(pid)
+            if not stopping[0]:
+                print('Worker ' + str(pid) + ' stopped unexpectedly.')
+                worker_died = True
+                stop_workers(None, None)
+        for path in WebsocketServer.worker_socket_paths:
+            if os.path.exists(path):
+                os.remove(path)
+        if worker_died:
+            # The journals' lock may be held by the dead worker. The logs
+            # are replayed on the next start, so nothing is lost.
+            exit_gracefully()
+        ServerUtils.flush_mons()
 
 def exit_gracefully():
     os._exit(1)
 
-def signal_handler(sig, frame):
-    print('You pressed Ctrl+C!')
-    exit_gracefully()
+try:
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except:
+    pass
 
 GSCUtils()
 RBYUtils()
 RSESPUtils()
 ws = WebsocketServer()
-ws.start()
-
-signal.signal(signal.SIGINT, signal_handler)
-
-while True:
-    sleep(1)
+ws.run()
@@ -0,0 +1,412 @@
+#!/usr/bin/python3
+import os
+import sys
+import json
+import tempfile
+import multiprocessing
+from queue import Empty
+from random import Random
+from time import monotonic, perf_counter
+from argparse import ArgumentParser
+from server_benchmark import BenchmarkServer
+from utilities.high_level_listener import HighLevelListener
+from utilities.websocket_client import PoolTradeRunner, ProxyConnectionRunner
+from utilities.gsc_trading import GSCTrading
+from utilities.gsc_trading_jp import GSCTradingJP
+from utilities.rby_trading import RBYTrading
+from utilities.rse_sp_trading import RSESPTrading
+from utilities.gsc_trading_menu import GSCTradingMenu
+from utilities.gsc_trading_strings import GSCTradingStrings
+from utilities.virtual_link_partner import GSCLinkPartner, GSCJPLinkPartner, RBYLinkPartner, RSESPLinkPartner
+
+class TradeScenario:
+    """
+    Class which describes a single benchmarked trade setup.
+    The third generation has a single setup for both modes.
+    Pool setups can also send a query, and check that the Pool
+    only offers Pokémon which match it.
+    The link mode sets how bytes reach the device: all at once through
+    the bulk transfers (bulk), one by one with the fixed pacing (byte),
+    or one by one with the adaptive pacing (paced).
+    """
+    query_max_level = 30
+    link_modes = ["bulk", "byte", "paced"]
+    trading_classes = {
+        "gen1": [RBYTrading, RBYLinkPartner, 1, False],
+        "gen2": [GSCTrading, GSCLinkPartner, 2, False],
+        "gen2_jp": [GSCTradingJP, GSCJPLinkPartner, 2, True],
+        "gen3": [RSESPTrading, RSESPLinkPartner, 3, False]
+    }
+
+    def __init__(self, game, trade_type, buffered, query=False, link_mode="bulk"):
+        self.game = game
+        self.trade_type = trade_type
+        self.buffered = buffered
+        self.query = query
+        self.link_mode = link_mode
+        self.trading_class, self.partner_class, self.gen, self.japanese = self.trading_classes[game]
+
+    def get_base_name(self):
+        if self.trade_type == GSCTradingStrings.pool_trade_str:
+            if self.query:
+                return self.game + "_pool_query"
+            return self.game + "_pool"
+        if self.gen == 3:
+            return self.game
+        if self.buffered:
+            return self.game + "_buffered"
+        return self.game + "_sync"
+
+    def get_name(self):
+        if self.link_mode == "bulk":
+            return self.get_base_name()
+        return self.get_base_name() + "_" + self.link_mode
+
+    def uses_bulk_transfers(self):
+        return self.link_mode == "bulk"
+
+    def get_num_engines(self):
+        if self.trade_type == GSCTradingStrings.pool_trade_str:
+            return 1
+        return 2
+
+    def get_all(link_modes=["bulk"]):
+        scenarios = []
+        for link_mode in link_modes:
+            for game in TradeScenario.trading_classes.keys():
+                if TradeScenario.trading_classes[game][2] == 3:
+                    scenarios += [TradeScenario(game, GSCTradingStrings.two_player_trade_str, True, link_mode=link_mode)]
+                else:
+                    scenarios += [TradeScenario(game, GSCTradingStrings.two_player_trade_str, False, link_mode=link_mode)]
+                    scenarios += [TradeScenario(game, GSCTradingStrings.two_player_trade_str, True, link_mode=link_mode)]
+            for game in TradeScenario.trading_classes.keys():
+                scenarios += [TradeScenario(game, GSCTradingStrings.pool_trade_str, False, link_mode=link_mode)]
+            for game in TradeScenario.trading_classes.keys():
+                scenarios += [TradeScenario(game, GSCTradingStrings.pool_trade_str, False, query=True, link_mode=link_mode)]
+        return scenarios
+
+class BenchmarkMenu:
+    """
+    Class which holds the options the trading engine reads,
+    without going through the command line or the menus.
+    """
+    max_level = GSCTradingMenu.default_max_level
+    egg = False
+    pool_species = GSCTradingMenu.default_pool_species
+    pool_eggs = GSCTradingMenu.default_pool_eggs
+    is_emulator = False
+    multiboot = False
+    do_sanity_checks = True
+    kill_on_byte_drops = False
+    adaptive_pacing = False
+    pacing_profiles = GSCTradingMenu.default_pacing_profiles
+    verbose = False
+
+    def __init__(self, scenario, host, port, room, instrumentation=False):
+        self.server = [host, port]
+        self.gen = scenario.gen
+        self.japanese = scenario.japanese
+        self.buffered = scenario.buffered
+        self.trade_type = scenario.trade_type
+        self.room = room
+        self.instrumentation = instrumentation
+        if scenario.query:
+            self.max_level = scenario.query_max_level
+        if scenario.link_mode == "paced":
+            self.adaptive_pacing = True
+            # Don't touch the profiles learned for real devices
+            self.pacing_profiles = os.path.join(tempfile.gettempdir(), "trade_benchmark_pacing_" + str(os.getpid()) + ".json")
+
+class CountingHighLevelListener(HighLevelListener):
+    """
+    Class which counts the frames exchanged with the server.
+    """
+
+    def __init__(self):
+        super(CountingHighLevelListener, self).__init__()
+        self.frames_sent = 0
+        self.frames_received = 0
+
+    def get_frames(self):
+        frames = super(CountingHighLevelListener, self).get_frames()
+        self.frames_sent += len(frames)
+        return frames
+
+    def process_received_data(self, data, connection, send_data=True, preparer=False):
+        self.frames_received += 1
+        return super(CountingHighLevelListener, self).process_received_data(data, connection, send_data=send_data, preparer=preparer)
+
+class SimulatedDevice:
+    """
+    Class which connects the engine to a virtual link partner
+    and counts the bytes swapped with it.
+    """
+
+    def __init__(self, partner):
+        self.partner = partner
+        self.bytes_swapped = 0
+
+    def sendByte(self, byte_to_send, num_bytes):
+        self.bytes_swapped += num_bytes
+        self.partner.sendByte(byte_to_send, num_bytes)
+
+    def receiveByte(self, num_bytes):
+        return self.partner.receiveByte(num_bytes)
+
+    def swapBytes(self, data, num_bytes, delay):
+        self.bytes_swapped += len(data) * num_bytes
+        return self.partner.swapBytes(data, num_bytes, delay)
+
+class PhaseTimer:
+    """
+    Class which measures the wall time spent in the engine's phases.
+    Phases can be nested: success is also counted in do_trade.
+    """
+
+    def __init__(self):
+        self.phases = {}
+
+    def add(self, name, elapsed):
+        if name not in self.phases.keys():
+            self.phases[name] = {"count": 0, "total_s": 0, "max_s": 0}
+        phase = self.phases[name]
+        phase["count"] += 1
+        phase["total_s"] += elapsed
+        phase["max_s"] = max(phase["max_s"], elapsed)
+
+    def wrap(self, target, method_name, get_phase_name=None):
+        """
+        Replaces a method of target with one which times it.
+        """
+        method = getattr(target, method_name)
+        def timed_method(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                name = method_name
+                if get_phase_name is not None:
+                    name = get_phase_name(args)
+                self.add(name, perf_counter() - start)
+        setattr(target, method_name, timed_method)
+
+def get_section_phase_name(args):
+    index = 0
+    if (len(args) > 0) and isinstance(args[0], int):
+        index = args[0]
+    return "read_section_" + str(index)
+
+def check_pool_query(trade_c, menu):
+    """
+    Makes the engine fail if the Pool offers a Pokémon
+    which doesn't match its query.
+    """
+    method = trade_c.comms.get_pool_trading_data
+    def checked_get_pool_trading_data():
+        mon = method()
+        if mon is not None:
+            level = mon.pokemon[-1].get_level()
+            if level > menu.max_level:
+                raise ValueError("Pool offered a level " + str(level) + " Pokémon, above the queried " + str(menu.max_level))
+        return mon
+    trade_c.comms.get_pool_trading_data = checked_get_pool_trading_data
+
+def run_engine(scenario, options, room, results, finished):
+    """
+    Runs a single trading engine against a virtual link partner,
+    until the partner stops trading.
+    It keeps its connection open until the other engines are done too.
+    """
+    if not options["verbose"]:
+        sys.stdout = open(os.devnull, "w")
+    error = None
+    def kill_function():
+        results.put({"error": "connection closed"})
+        results.close()
+        results.join_thread()
+        os._exit(1)
+    menu = BenchmarkMenu(scenario, options["host"], options["port"], room, instrumentation=options["instrumentation"])
+    if scenario.trade_type == GSCTradingStrings.two_player_trade_str:
+        connection = ProxyConnectionRunner(menu, kill_function)
+    else:
+        connection = PoolTradeRunner(menu, kill_function)
+    connection.hll = CountingHighLevelListener()
+    device = SimulatedDevice(scenario.partner_class(num_trades=options["trades"]))
+    if scenario.uses_bulk_transfers():
+        trade_c = scenario.trading_class(device.sendByte, device.receiveByte, connection, menu, kill_function, True, bulk_swapping_func=device.swapBytes)
+    else:
+        trade_c = scenario.trading_class(device.sendByte, device.receiveByte, connection, menu, kill_function, False)
+    timer = PhaseTimer()
+    for method_name in ["enter_room", "sit_to_table", "do_trade", "wait_for_success"]:
+        if hasattr(trade_c, method_name):
+            timer.wrap(trade_c, method_name)
+    timer.wrap(trade_c, "read_section", get_section_phase_name)
+    if scenario.query:
+        check_pool_query(trade_c, menu)
+    connection.start()
+    start = perf_counter()
+    try:
+        if scenario.trade_type == GSCTradingStrings.two_player_trade_str:
+            trade_c.player_trade(scenario.buffered)
+        else:
+            trade_c.pool_trade()
+    except Exception as e:
+        error = type(e).__name__ + ": " + str(e)
+    duration = perf_counter() - start
+    if menu.adaptive_pacing and os.path.exists(menu.pacing_profiles):
+        os.remove(menu.pacing_profiles)
+    phases = timer.phases
+    if "wait_for_success" in phases.keys():
+        phases["success"] = phases.pop("wait_for_success")
+    results.put({
+        "error": error,
+        "wall_s": duration,
+        "trades": device.partner.trades_done,
+        "phases": phases,
+        "bytes_swapped": device.bytes_swapped,
+        "frames_sent": connection.hll.frames_sent,
+        "frames_received": connection.hll.frames_received,
+        "instrumentation": trade_c.instrumentation.to_dict()
+    })
+    finished.wait(options["timeout"])
+
+def run_scenario(scenario, options, room):
+    """
+    Runs the engines of a scenario in their own processes,
+    so they don't share anything but the server.
+    """
+    results = multiprocessing.Queue()
+    finished = multiprocessing.Event()
+    processes = []
+    start = monotonic()
+    for i in range(scenario.get_num_engines()):
+        process = multiprocessing.Process(target=run_engine, args=(scenario, options, room, results, finished))
+        process.start()
+        processes += [process]
+    engines = []
+    error = None
+    try:
+        for process in processes:
+            engines += [results.get(timeout=max(options["timeout"] - (monotonic() - start), 0))]
+    except Empty:
+        error = "timeout"
+    duration = monotonic() - start
+    finished.set()
+    for process in processes:
+        process.join(5)
+        if process.is_alive():
+            process.kill()
+            process.join()
+    for engine in engines:
+        if (error is None) and (engine["error"] is not None):
+            error = engine["error"]
+    return {
+        "scenario": scenario.get_name(),
+        "gen": scenario.gen,
+        "japanese": scenario.japanese,
+        "trade_type": scenario.trade_type,
+        "buffered": scenario.buffered,
+        "query": scenario.query,
+        "link_mode": scenario.link_mode,
+        "trades": options["trades"],
+        "ok": error is None,
+        "error": error,
+        "wall_s": duration,
+        "engines": engines
+    }
+
+def print_report(report):
+    for result in report:
+        state = "ok"
+        if not result["ok"]:
+            state = result["error"]
+        print(result["scenario"] + ": " + str(round(result["wall_s"], 3)) + "s (" + state + ")")
+        for i in range(len(result["engines"])):
+            engine = result["engines"][i]
+            if "phases" not in engine.keys():
+                continue
+            print("  engine " + str(i) + ": bytes_swapped: " + str(engine["bytes_swapped"]) + ", frames_sent: " + str(engine["frames_sent"]) + ", frames_received: " + str(engine["frames_received"]))
+            for name in engine["phases"].keys():
+                phase = engine["phases"][name]
+                print("    " + name + ": " + str(round(phase["total_s"], 3)) + "s, x" + str(phase["count"]))
+            if engine["instrumentation"] is not None:
+                print_instrumentation(engine["instrumentation"])
+
+def print_instrumentation(instrumentation):
+    for name in instrumentation["histograms"].keys():
+        histogram = instrumentation["histograms"][name]
+        print("    " + name + ": " + str(round(histogram["total_s"], 3)) + "s, x" + str(histogram["count"]) + ", p50: " + str(round(histogram["p50_s"] * 1000, 3)) + "ms, p99: " + str(round(histogram["p99_s"] * 1000, 3)) + "ms, max: " + str(round(histogram["max_s"] * 1000, 3)) + "ms")
+    for name in instrumentation["counters"].keys():
+        print("    " + name + ": " + str(instrumentation["counters"][name]))
+
+def handle_args():
+    parser = ArgumentParser(description="Runs complete trades between trading engines and virtual devices, through serving.py.")
+    parser.add_argument("-s", "--scenarios", dest="scenarios", default=None,
+                        help="comma separated scenarios to run, i.e. gen2_sync,gen3_pool. All of them by default")
+    parser.add_argument("-lm", "--link_modes", dest="link_modes", default="bulk",
+                        help="comma separated link modes to run the scenarios with, among bulk, byte and paced. Only bulk by default")
+    parser.add_argument("-n", "--trades", dest="trades", default=1,
+                        help="trades done by each virtual device before it stops", type=int)
+    parser.add_argument("-t", "--timeout", dest="timeout", default=300,
+                        help="seconds after which a scenario is considered failed", type=float)
+    parser.add_argument("-o", "--output", dest="output", default=None,
+                        help="file the JSON results are written to")
+    parser.add_argument("-sh", "--server_host", dest="host", default="localhost",
+                        help="server's host")
+    parser.add_argument("-sp", "--server_port", dest="port", default=11311,
+                        help="server's port", type=int)
+    parser.add_argument("-mp", "--metrics_port", dest="metrics_port", default=11312,
+                        help="port of the started server's metrics", type=int)
+    parser.add_argument("-ns", "--no_server",
+                        action="store_true", dest="no_server", default=False,
+                        help="use an already running server instead of starting one")
+    parser.add_argument("-j", "--json",
+                        action="store_true", dest="json", default=False,
+                        help="print the results as JSON")
+    parser.add_argument("-i", "--instrumentation",
+                        action="store_true", dest="instrumentation", default=False,
+                        help="instrument the engines' hot path and report its latencies")
+    parser.add_argument("-v", "--verbose",
+                        action="store_true", dest="verbose", default=False,
+                        help="show the engines' and the started server's output")
+    return parser.parse_args()
+
+def main():
+    args = handle_args()
+    link_modes = args.link_modes.split(",")
+    for link_mode in link_modes:
+        if link_mode not in TradeScenario.link_modes:
+            print("Unknown link mode: " + link_mode)
+            sys.exit(2)
+    scenarios = TradeScenario.get_all(link_modes=link_modes)
+    if args.scenarios is not None:
+        names = args.scenarios.split(",")
+        scenarios = [scenario for scenario in scenarios if scenario.get_name() in names]
+    options = {"host": args.host, "port": args.port, "trades": args.trades, "timeout": args.timeout, "verbose": args.verbose, "instrumentation": args.instrumentation}
+    room_base = Random().randint(0, 99999 - len(scenarios))
+
+    server = None
+    if not args.no_server:
+        server = BenchmarkServer(args.port, args.metrics_port, 1, args.verbose)
+    report = []
+    try:
+        if server is not None:
+            server.start()
+        for i in range(len(scenarios)):
+            report += [run_scenario(scenarios[i], options, room_base + i)]
+    finally:
+        if server is not None:
+            server.stop()
+
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=4)
+    if args.json:
+        print(json.dumps(report, indent=4))
+    else:
+        print_report(report)
+    if not all(result["ok"] for result in report):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -24,6 +24,9 @@ p = None
 max_usb_timeout_w = 5
 max_usb_timeout_r = 0.1
 max_packet_size = 0x40
+us_between_transfer = 1000
+# Exceptions the chosen backend raises when a read times out
+read_timeout_errors = ()
 
 VID = 0xcafe
 PID = 0x4011
@@ -49,9 +52,9 @@ def transfer_func(sender, receiver, list_sender, raw_receiver, is_serial):
         menu.gen = 3
 
     if menu.gen == 3:
-        config_base = multiboot.get_configure_list(1000, 4)
+        config_base = multiboot.get_configure_list(us_between_transfer, 4)
     else:
-        config_base = multiboot.get_configure_list(1000, 1)
+        config_base = multiboot.get_configure_list(us_between_transfer, 1)
 
     result = 1
     while result != 0:
@@ -69,21 +72,26 @@ def transfer_func(sender, receiver, list_sender, raw_receiver, is_serial):
     if(ret == 1) and (menu.gen == 3):
         pre_sleep = True
 
+    # The reconfigurable firmware can time whole sequences by itself
+    bulk_swapper = None
+    if ret == 1:
+        bulk_swapper = swapBytes
+
     if menu.multiboot:
         multiboot.multiboot(raw_receiver, sender, list_sender, path)
         return
     if menu.gen == 2:
         if menu.japanese:
-            trade_c = GSCTradingJP(sender, receiver, connection, menu, kill_function, pre_sleep)
+            trade_c = GSCTradingJP(sender, receiver, connection, menu, kill_function, pre_sleep, bulk_swapping_func=bulk_swapper)
         else:
-            trade_c = GSCTrading(sender, receiver, connection, menu, kill_function, pre_sleep)
+            trade_c = GSCTrading(sender, receiver, connection, menu, kill_function, pre_sleep, bulk_swapping_func=bulk_swapper)
     elif menu.gen == 3:
-        trade_c = RSESPTrading(sender, receiver, connection, menu, kill_function, pre_sleep)
+        trade_c = RSESPTrading(sender, receiver, connection, menu, kill_function, pre_sleep, bulk_swapping_func=bulk_swapper)
     elif menu.gen == 1:
         if menu.japanese:
-            trade_c = RBYTradingJP(sender, receiver, connection, menu, kill_function, pre_sleep)
+            trade_c = RBYTradingJP(sender, receiver, connection, menu, kill_function, pre_sleep, bulk_swapping_func=bulk_swapper)
         else:
-            trade_c = RBYTrading(sender, receiver, connection, menu, kill_function, pre_sleep)
+            trade_c = RBYTrading(sender, receiver, connection, menu, kill_function, pre_sleep, bulk_swapping_func=bulk_swapper)
     connection.start()
     
     if menu.trade_type == GSCTradingStrings.two_player_trade_str:
@@ -91,6 +99,44 @@ def transfer_func(sender, receiver, list_sender, raw_receiver, is_serial):
     elif menu.trade_type == GSCTradingStrings.pool_trade_str:
         trade_c.pool_trade()
 
+# Sets how long the reconfigurable firmware waits between two transfers.
+def configure_timing(target_us, num_bytes):
+    config_base = multiboot.get_configure_list(target_us, num_bytes)
+    list_sender(config_base, chunk_size=len(config_base))
+    if multiboot.read_all(raw_receiver) != 1:
+        raise IOError("The firmware didn't accept the new timing!")
+
+# Uses the timed transfer mode of the reconfigurable firmware.
+# The whole sequence is written at once and the device's
+# bytes are read back in bulk.
+# The firmware's timing is only changed for the sequence, so the bytes
+# swapped one by one aren't delayed by both it and the host.
+def swapBytes(data, num_bytes, delay):
+    target_us = us_between_transfer
+    if delay is not None:
+        target_us = int(delay * 1000000)
+    if target_us != us_between_transfer:
+        configure_timing(target_us, num_bytes)
+    out_data = []
+    for byte_to_send in data:
+        out_data += list(byte_to_send.to_bytes(num_bytes, byteorder='big'))
+    recv = b''
+    # Restore the timing even if the transfer fails
+    try:
+        list_sender(out_data, chunk_size=max_packet_size)
+        end_time = time.time() + max_usb_timeout_w + ((len(data) * target_us) / 1000000)
+        while len(recv) < len(out_data):
+            if time.time() >= end_time:
+                raise TimeoutError("The device answered to " + str(len(recv)) + " bytes out of " + str(len(out_data)) + "!")
+            try:
+                recv += bytes(raw_receiver(len(out_data) - len(recv)))
+            except read_timeout_errors:
+                pass
+    finally:
+        if target_us != us_between_transfer:
+            configure_timing(us_between_transfer, num_bytes)
+    return [int.from_bytes(recv[i:i+num_bytes], byteorder='big') for i in range(0, len(out_data), num_bytes)]
+
 # Code dependant on this connection method
 def sendByte(byte_to_send, num_bytes):
     epOut.write(byte_to_send.to_bytes(num_bytes, byteorder='big'), timeout=int(max_usb_timeout_w * 1000))
@@ -358,6 +404,7 @@ try:
             receiver = receiveByte
             list_sender = sendList
             raw_receiver = receiveByte_raw
+            read_timeout_errors = (usb.core.USBTimeoutError,)
             found = True
     if (not found) and try_winusbcdc:
         if(winusbcdc_method()):
@@ -5,6 +5,8 @@ from .trading_version import TradingVersion
 from .gsc_trading_data_utils import *
 from .gsc_trading_menu import GSCBufferedNegotiator
 from .gsc_trading_strings import GSCTradingStrings
+from .link_pacing import LinkPacer, LinkPacingProfiles
+from .trading_instrumentation import TradingInstrumentation, DisabledTradingInstrumentation
 
 class GSCTradingClient:
     """
@@ -27,6 +29,7 @@ class GSCTradingClient:
     version_server_transfer = "VES2"
     random_data_transfer = "RAN2"
     need_data_transfer = "ASK2"
+    pool_query_transfer = "PQR2"
     possible_transfers = {
         full_transfer: {0x412, 0x40C}, # Sum of special_sections_len - Ver 1.0, 2.0 - 4.0
         single_transfer: {7, 32}, # Ver 1.0 - 3.0 and 4.0
@@ -41,7 +44,26 @@ class GSCTradingClient:
         version_client_transfer : {6}, # Client's version value
         version_server_transfer : {6}, # Server's version value
         random_data_transfer : {10}, # Random values from server
-        need_data_transfer : {1 + 1} # Counter + Whether it needs the other player's data
+        need_data_transfer : {1 + 1}, # Counter + Whether it needs the other player's data
+        pool_query_transfer : {1 + 2 + 1 + 1 + 1 + 1} # Counter + Species + Min Level + Max Level + Egg + Origin Game
+    }
+    # Opcodes of the binary framing. Never reuse or change them
+    binary_opcodes = {
+        full_transfer: 0,
+        single_transfer: 1,
+        pool_transfer: 2,
+        moves_transfer: 3,
+        mail_transfer: 4,
+        choice_transfer: 5,
+        accept_transfer: 6,
+        success_transfer: 7,
+        buffered_transfer: 8,
+        negotiation_transfer: 9,
+        version_client_transfer: 10,
+        version_server_transfer: 11,
+        random_data_transfer: 12,
+        need_data_transfer: 13,
+        pool_query_transfer: 14
     }
     buffered_value = 0x85
     not_buffered_value = 0x12
@@ -56,7 +78,7 @@ class GSCTradingClient:
         self.fileBaseTargetName = base_no_trade
         self.fileBasePoolTargetName = base_pool
         self.connection = connection.hll
-        self.connection.set_valid_transfers(self.possible_transfers)
+        self.connection.set_valid_transfers(self.possible_transfers, self.binary_opcodes)
         self.stop_trade = stop_trade
         self.received_one = False
         self.party_reader = party_reader
@@ -100,6 +122,17 @@ class GSCTradingClient:
         """
         self.connection.send_data(self.version_client_transfer, TradingVersion.prepare_version_data())
     
+    def update_framing(self, versions):
+        """
+        Uses the binary framing only if all the other ends
+        of the connection support it.
+        """
+        binary_framing = True
+        for version in versions:
+            if not TradingVersion.supports_binary_framing(version):
+                binary_framing = False
+        self.connection.set_binary_framing(binary_framing)
+    
     def get_random(self):
         """
         Handles getting the RNG values.
@@ -302,6 +335,15 @@ class GSCTradingClient:
             final_data += data[i]
         self.connection.send_data(self.full_transfer, final_data)
         
+    def send_pool_query(self, species=0, min_level=0, max_level=0xFF, egg=0, origin_game=0):
+        """
+        Makes the server only offer Pool Pokémon which match the criteria.
+        Species and origin_game are ignored if 0. egg is 0 for any,
+        1 to exclude eggs and 2 for eggs only.
+        It must be sent before getting the Pool's Pokémon.
+        """
+        self.send_with_counter(self.pool_query_transfer, GSCUtilsMisc.to_n_bytes_le(species, 2) + [min_level, max_level, egg, origin_game])
+        
     def get_pool_trading_data(self):
         """
         Handles getting the trading data for the mon offered by the server.
@@ -320,7 +362,7 @@ class GSCTradingClient:
                 mon = self.party_reader(GSCUtilsMisc.read_data(self.fileBasePoolTargetName), do_full=False)
                 mon.pokemon += [received_mon[0]]
                 
-                # Handle max level option
+                # Handle max level option, for servers which ignore the query
                 if received_mon[0].get_level() > self.trader.max_level:
                     received_mon[0].set_level(self.trader.max_level)
                 
@@ -351,8 +393,9 @@ class GSCTradingClient:
     def send_trading_data(self, data):
         """
         Handles sending the player's current bytes of trading data.
+        Only the most recent bytes matter, so older unsent ones are replaced.
         """
-        self.connection.send_data(self.single_transfer, data)
+        self.connection.send_data(self.single_transfer, data, coalesce=True)
     
     def send_buffered_data(self, buffered):
         """
@@ -457,10 +500,12 @@ class GSCTrading:
     first_trade_index = 0x70
     decline_trade = 0x71
     accept_trade = 0x72
+    bulk_chunk_size = 0x40
     
-    def __init__(self, sending_func, receiving_func, connection, menu, kill_function, pre_sleep):
+    def __init__(self, sending_func, receiving_func, connection, menu, kill_function, pre_sleep, bulk_swapping_func=None):
         self.sendByte = sending_func
         self.receiveByte = receiving_func
+        self.swapBytes = bulk_swapping_func
         self.checks = self.get_checks(menu)
         self.comms = self.get_comms(connection, menu)
         self.menu = menu
@@ -470,6 +515,30 @@ class GSCTrading:
         self.is_running_compat_3_mode = False
         self.max_seconds_between_transfers = 0.8
         self.pre_sleep = pre_sleep
+        self.pacer = self.get_pacer(sending_func, menu)
+        self.instrumentation = self.get_instrumentation(menu)
+        self.instrumentation.install(self)
+    
+    def get_instrumentation(self, menu):
+        """
+        Prepares the instrumentation of the engine's hot path.
+        When disabled, the engine's methods are left untouched.
+        """
+        if menu.instrumentation:
+            return TradingInstrumentation()
+        return DisabledTradingInstrumentation()
+    
+    def get_pacer(self, sending_func, menu):
+        """
+        Prepares the pacer, with the profile of the device in use.
+        """
+        profiles = None
+        if menu.adaptive_pacing:
+            profiles = LinkPacingProfiles(menu.pacing_profiles)
+        return LinkPacer(self.sleep_timer, self.get_pacing_profile_name(sending_func), profiles=profiles, enabled=menu.adaptive_pacing)
+    
+    def get_pacing_profile_name(self, sending_func):
+        return type(self).__name__ + "/" + getattr(sending_func, "__module__", "") + "." + getattr(sending_func, "__qualname__", "")
     
     def get_and_init_utils_class(self):
         GSCUtils()
@@ -535,7 +604,21 @@ class GSCTrading:
         or an error depending on kill_on_byte_drops.
         """
         if self.has_transfer_failed(byte, byte_index, section_index):
+            self.pacer.on_drop()
             self.act_on_bad_data()
+        else:
+            self.pacer.on_valid()
+    
+    def track_transfer(self, byte, byte_index, section_index):
+        """
+        Lets the pacer know whether the transfer dropped any bytes,
+        without acting on it.
+        """
+        if byte_index < self.get_section_length(section_index):
+            if self.has_transfer_failed(byte, byte_index, section_index):
+                self.pacer.on_drop()
+            else:
+                self.pacer.on_valid()
     
     def act_on_bad_data(self):
         """
@@ -559,7 +642,7 @@ class GSCTrading:
         return self.special_sections_len[index]
     
     def get_checker(self, index):
-        return self.checks.checks_map[index]
+        return self.checks.get_checks_map()[index]
     
     def convert_mail_data(self, data, to_device):
         """
@@ -616,18 +699,22 @@ class GSCTrading:
 
         self.verbose_print(GSCTradingStrings.separate_section_str, end='')
         
-        if buffered:
+        if buffered and (send_data is not None) and (self.swapBytes is not None):
+            buf = self.buffered_bulk_section(next, index, send_data, length, checker)
+            other_buf = send_data
+        elif buffered:
             buf = [next]
             # If the trade is buffered, just send the data from the buffer
             i = 0
             while i < (length-1):
                 if send_data is not None:
-                    next = self.prevent_no_input(checker[i](send_data[i]))
+                    next = self.prevent_no_input(checker[i](self.checks, send_data[i]))
                     send_data[i] = next
                 next_i = i+1
                 if next_i not in self.fillers[index].keys():
                     next = self.swap_byte(next)
                     self.verbose_print(GSCTradingStrings.transfer_to_hardware_str.format(index=self.get_printable_index(index), completion=GSCTradingStrings.x_out_of_y_str(next_i, length)), end='')
+                    self.track_transfer(next, next_i, index)
                     buf += [next]
                 # Handle fillers
                 else:
@@ -635,14 +722,14 @@ class GSCTrading:
                     filler_val = self.fillers[index][next_i][1]
                     if send_data is not None:
                         for j in range(filler_len):
-                            send_data[next_i + j] = checker[next_i + j](send_data[next_i + j])
+                            send_data[next_i + j] = checker[next_i + j](self.checks, send_data[next_i + j])
                     buf += ([filler_val] * filler_len)
                     i += (filler_len - 1)
                 i += 1
             
             if send_data is not None:
                 # Send the last byte too
-                next = self.prevent_no_input(checker[length-1](send_data[length-1]))
+                next = self.prevent_no_input(checker[length-1](self.checks, send_data[length-1]))
                 send_data[length-1] = next
             self.swap_byte(next)
             self.verbose_print(GSCTradingStrings.transfer_to_hardware_str.format(index=self.get_printable_index(index), completion=GSCTradingStrings.x_out_of_y_str(length, length)), end='')
@@ -655,9 +742,55 @@ class GSCTrading:
             else:
                 buf, other_buf, last_sent = self.synch_exchange_section_new(next, index, length, checker, send_buf)
 
+        self.pacer.save_profile()
         self.verbose_print(GSCTradingStrings.separate_section_str, end='')
         return buf, other_buf, last_sent
-    
+
+    def buffered_bulk_section(self, next, index, send_data, length, checker):
+        """
+        Sends a buffered data section to the device in bulk.
+        Its bytes are known in advance, so they're prepared all at once
+        and then swapped a chunk at a time.
+        """
+        buf = [next]
+        to_send = []
+        positions = []
+        i = 0
+        while i < (length-1):
+            next = self.prevent_no_input(checker[i](self.checks, send_data[i]))
+            send_data[i] = next
+            next_i = i+1
+            if next_i not in self.fillers[index].keys():
+                to_send += [next]
+                positions += [len(buf)]
+                buf += [None]
+            # Handle fillers
+            else:
+                filler_len = self.fillers[index][next_i][0]
+                filler_val = self.fillers[index][next_i][1]
+                for j in range(filler_len):
+                    send_data[next_i + j] = checker[next_i + j](self.checks, send_data[next_i + j])
+                buf += ([filler_val] * filler_len)
+                i += (filler_len - 1)
+            i += 1
+
+        # Send the last byte too, and what's needed to check for drops
+        next = self.prevent_no_input(checker[length-1](self.checks, send_data[length-1]))
+        send_data[length-1] = next
+        to_send += [next] + ([self.no_data] * self.drop_bytes_checks[2][index])
+
+        for i in range(0, len(to_send), self.bulk_chunk_size):
+            recv = self.swap_bytes(to_send[i:i+self.bulk_chunk_size])
+            for j in range(len(recv)):
+                if (i + j) < len(positions):
+                    buf[positions[i + j]] = recv[j]
+                    self.track_transfer(recv[j], positions[i + j], index)
+            completion = length
+            if (i + len(recv)) < len(positions):
+                completion = positions[i + len(recv)]
+            self.verbose_print(GSCTradingStrings.transfer_to_hardware_str.format(index=self.get_printable_index(index), completion=GSCTradingStrings.x_out_of_y_str(completion, length)), end='')
+        return buf
+
     def synch_synch_section_old(self, index):
         # Wait for a connection to be established if it's synchronous
         send_buf = [[0xFFFF,0xFF],[0xFFFF,0xFF],[index]]
@@ -738,7 +871,7 @@ class GSCTrading:
                         recv_data = self.get_swappable_bytes(recv_buf, length, index)
                     if i in recv_data.keys() and (i < length):
                         # Clean it and send it
-                        cleaned_byte = self.prevent_no_input(checker[i](recv_data[i]))
+                        cleaned_byte = self.prevent_no_input(checker[i](self.checks, recv_data[i]))
                         next_i = i+1
                         # Handle fillers
                         if next_i in self.fillers[index].keys():
@@ -748,7 +881,7 @@ class GSCTrading:
                             send_buf[(next_i)&1][1] = filler_val
                             buf += ([filler_val] * filler_len)
                             for j in range(filler_len):
-                                other_buf += [checker[next_i + j](filler_val)]
+                                other_buf += [checker[next_i + j](self.checks, filler_val)]
                             i += (filler_len - 1)
                         else:
                             next = self.swap_byte(cleaned_byte)
@@ -800,18 +933,18 @@ class GSCTrading:
                 while pos_recv in recv_data.keys():
                     if pos_recv >= length:
                         break
-                    cleaned_byte = self.prevent_no_input(checker[pos_recv](recv_data[pos_recv]))
+                    cleaned_byte = self.prevent_no_input(checker[pos_recv](self.checks, recv_data[pos_recv]))
                     other_buf += [cleaned_byte]
                     pos_recv += 1
                     
                     if pos_recv in self.fillers[index].keys():
-                        filler_len = self.fillers[index][pos_send][0]
-                        filler_val = self.fillers[index][pos_send][1]
+                        filler_len = self.fillers[index][pos_recv][0]
+                        filler_val = self.fillers[index][pos_recv][1]
                         added_len = 0
                         for j in range(filler_len):
                             if (pos_recv + j) >= length:
                                 break
-                            other_buf += [checker[pos_recv + j](filler_val)]
+                            other_buf += [checker[pos_recv + j](self.checks, filler_val)]
                             added_len += 1
                         pos_recv += added_len
             byte_to_console = self.no_input
@@ -828,10 +961,11 @@ class GSCTrading:
                 if schedule_console:
                     i += 1
                     if i in self.fillers[index].keys():
-                        filler_len = self.fillers[index][pos_send][0]
+                        filler_len = self.fillers[index][i][0]
                         i += filler_len
             
             if schedule_console:
+                self.instrumentation.count_scheduled(byte_to_console == self.no_input)
                 if byte_to_console == self.no_input:
                     bytes_offset += 1
                     if bytes_offset > self.max_tolerance_bytes:
@@ -839,6 +973,7 @@ class GSCTrading:
                 next = self.swap_byte(byte_to_console)
                 self.verbose_print(GSCTradingStrings.transfer_to_hardware_str.format(index=self.get_printable_index(index), completion=GSCTradingStrings.x_out_of_y_str(i, length)), end='')
                 last_transfer_time = datetime.datetime.now()
+                self.track_transfer(next, pos_send, index)
                 send_buf[send_index] = [pos_send, next, index, False, 0]
                 send_index = (send_index + 1) % self.total_send_buf_new_bytes
                 buf += [next]
@@ -879,12 +1014,32 @@ class GSCTrading:
         It's a high level abstraction which emulates how real hardware works.
         """
         if not self.pre_sleep:
-            self.sleep_func()
+            self.pacer.wait()
+        self.pacer.begin_transfer()
         self.sendByte(send_data, self.num_bytes_per_transfer)
         recv = self.receiveByte(self.num_bytes_per_transfer)
+        self.pacer.end_transfer()
         if self.extremely_verbose:
             print(GSCTradingStrings.byte_transfer_str.format(send_data=send_data, recv=recv))
         return recv
+
+    def swap_bytes(self, send_data):
+        """
+        Swaps a sequence of bytes with the device. The bytes mustn't
+        depend on what is received. If the device supports it,
+        they're all sent with one bulk write and read back
+        with one bulk read. Otherwise, they're swapped one by one.
+        """
+        if self.swapBytes is None:
+            return [self.swap_byte(send_byte) for send_byte in send_data]
+        delay = None
+        if not self.pre_sleep:
+            delay = self.pacer.get_delay()
+        recv = self.swapBytes(send_data, self.num_bytes_per_transfer, delay)
+        if self.extremely_verbose:
+            for i in range(len(send_data)):
+                print(GSCTradingStrings.byte_transfer_str.format(send_data=send_data[i], recv=recv[i]))
+        return recv
     
     def create_success_set(self, traded_mons):
         """
@@ -1335,6 +1490,7 @@ class GSCTrading:
             other_client_version = self.attempt_receive(self.comms.get_client_version, 5)
             if other_client_version is not None:
                 self.is_running_compat_3_mode = False
+                self.comms.update_framing([server_version, other_client_version])
         
         if self.is_running_compat_3_mode:
             random_data, random_data_other, just_sent = self.read_section(0, send_data[0], buffered, just_sent, 0)
@@ -1463,6 +1619,7 @@ class GSCTrading:
             self.other_blank_trade = True
             # Start interacting with the trading menu
             self.do_trade(self.comms.get_chosen_mon, close=not valid)
+        self.instrumentation.print_summary()
 
     def pool_trade(self):
         """
@@ -1474,6 +1631,8 @@ class GSCTrading:
         self.reset_trade()
         self.max_level = self.menu.max_level
         self.exit_or_new = True
+        # Only get Pool Pokémon which respect the options
+        self.comms.send_pool_query(species=self.menu.pool_species, max_level=self.max_level, egg=self.menu.pool_eggs)
         # Start of what the player sees. Enters the room
         self.enter_room()
         while True:
@@ -1492,7 +1651,8 @@ class GSCTrading:
 
             # Start interacting with the trading menu
             self.do_trade(self.get_first_mon, to_server=True)
+        self.instrumentation.print_summary()
         
     # Function needed in order to make sure there is enough time for the slave to prepare the next byte.
     def sleep_func(self, multiplier = 1):
-        time.sleep(self.sleep_timer * multiplier)
+        time.sleep(self.pacer.get_delay() * multiplier)
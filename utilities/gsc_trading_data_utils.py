@@ -1,5 +1,8 @@
+import os
 import math
 import sys
+import hashlib
+import threading
 from .gsc_trading_strings import GSCTradingStrings
 
 class GSCUtilsLoaders:
@@ -1003,11 +1006,90 @@ class GSCTradingData:
         self.utils_class.create_patches_data(data[3], data[3], self.utils_class, is_mail=True)
         return data
     
+class GSCChecksTables:
+    """
+    Class which contains the data the sanity checks are built from,
+    and the maps of the check functions to apply to each byte.
+    It's prepared only once per checks class, and then shared
+    by all of its instances, which must not modify it.
+    The maps hold the class' functions, which are called with
+    the checks instance holding the session's state.
+    """
+    loaded_tables = {}
+    loading_lock = threading.Lock()
+    
+    def __init__(self, checks_class):
+        def read_list(target):
+            return GSCUtilsMisc.read_data(checks_class.base_folder + target)
+        self.bad_ids_items = GSCUtilsLoaders.prepare_check_list(read_list(checks_class.bad_ids_items_path))
+        self.bad_ids_moves = GSCUtilsLoaders.prepare_check_list(read_list(checks_class.bad_ids_moves_path))
+        self.bad_ids_pokemon = GSCUtilsLoaders.prepare_check_list(read_list(checks_class.bad_ids_pokemon_path))
+        self.bad_ids_text = GSCUtilsLoaders.prepare_check_list(read_list(checks_class.bad_ids_text_path))
+        self.pokemon_patch_sets = [GSCUtilsLoaders.prepare_check_list(read_list(checks_class.pokemon_patch_set_0_path)), GSCUtilsLoaders.prepare_check_list(read_list(checks_class.pokemon_patch_set_1_path))]
+        self.mail_patch_set = [GSCUtilsLoaders.prepare_check_list(read_list(checks_class.mail_patch_set_path))]
+        self.japanese_mail_patch_set = [GSCUtilsLoaders.prepare_check_list(read_list(checks_class.mail_patch_set_path))]
+        self.checks_map_data = read_list(checks_class.checks_map_path)
+        self.single_pokemon_checks_map_data = read_list(checks_class.single_pokemon_checks_map_path)
+        self.moves_checks_map_data = read_list(checks_class.moves_checks_map_path)
+        self.digest = GSCChecksTables.get_digest(checks_class)
+        self.check_functions = [getattr(checks_class, name) for name in checks_class.check_function_names]
+        self.single_pokemon_checks_map = GSCUtilsLoaders.prepare_functions_map(self.single_pokemon_checks_map_data, self.check_functions)
+        self.moves_checks_map = GSCUtilsLoaders.prepare_functions_map(self.moves_checks_map_data, self.check_functions)
+        self.checks_maps = {}
+        self.checks_maps_lock = threading.Lock()
+    
+    def get_checks_map(self, lengths):
+        """
+        Returns the full trade's checks map, divided in sections
+        of the given lengths.
+        It's big and the Pool never uses it, so it's only
+        prepared the first time it's needed.
+        """
+        key = tuple(lengths)
+        checks_map = self.checks_maps.get(key, None)
+        if checks_map is None:
+            with self.checks_maps_lock:
+                checks_map = self.checks_maps.get(key, None)
+                if checks_map is None:
+                    raw_data_sections = GSCUtilsMisc.divide_data(self.checks_map_data, lengths)
+                    checks_map = [[],[],[],[]]
+                    for i in range(len(raw_data_sections)):
+                        checks_map[i] = GSCUtilsLoaders.prepare_functions_map(raw_data_sections[i], self.check_functions)
+                    self.checks_maps[key] = checks_map
+        return checks_map
+    
+    def get_digest(checks_class):
+        """
+        Returns a digest of all the data files in the checks' folder,
+        which the checks and the utils classes read their tables from.
+        """
+        digest = hashlib.sha256()
+        for name in sorted(os.listdir(checks_class.base_folder)):
+            with open(checks_class.base_folder + name, 'rb') as f:
+                data = f.read()
+            digest.update(name.encode() + len(data).to_bytes(4, byteorder='little') + data)
+        return digest.digest()
+    
+    def get_tables(checks_class):
+        """
+        Returns the tables for the checks class, loading them if needed.
+        """
+        tables = GSCChecksTables.loaded_tables.get(checks_class, None)
+        if tables is None:
+            with GSCChecksTables.loading_lock:
+                tables = GSCChecksTables.loaded_tables.get(checks_class, None)
+                if tables is None:
+                    tables = GSCChecksTables(checks_class)
+                    GSCChecksTables.loaded_tables[checks_class] = tables
+        return tables
+
 class GSCChecks:
     """
     Class which handles sanity checks and cleaning of the received data.
     checks_map and single_pokemon_checks_map are its product used to apply
-    the checks.
+    the checks. They're shared by all the instances of the class, which
+    only hold the state of the data they're currently checking.
+    The maps' functions must be called with the instance.
     """
     base_folder = "useful_data/gsc/"
     bad_ids_items_path = "bad_ids_items.bin"
@@ -1033,53 +1115,71 @@ class GSCChecks:
     rattata_id = 0x13
     question_mark = 0xE6
     newline = 0x4E
+    # Bump it when the checks' code changes what they let through
+    checks_version = 1
+    # The IDs in the checks maps are indexes in this list
+    check_function_names = [
+        "clean_nothing",
+        "clean_text",
+        "clean_team_size",
+        "clean_species",
+        "clean_move",
+        "clean_item",
+        "clean_level",
+        "check_hp",
+        "clean_text_final",
+        "load_stat_exp",
+        "load_stat_iv",
+        "check_stat",
+        "clean_species_sp",
+        "clean_pp",
+        "clean_experience",
+        "clean_egg_cycles_friendship",
+        "clean_type",
+        "clean_text_newline",
+        "clean_text_final_no_end",
+        "clean_species_force_terminate",
+        "clean_mail_species",
+        "clean_mail_item",
+        "clean_mail_same_species",
+        "clean_pokemon_patch_set",
+        "clean_mail_patch_set",
+        "clean_japanese_mail_patch_set"
+        ]
     
     def __init__(self, section_sizes, do_sanity_checks):
         self.utils_class = self.get_utils_class()
         self.do_sanity_checks = do_sanity_checks
-        self.bad_ids_items = GSCUtilsLoaders.prepare_check_list(GSCUtilsMisc.read_data(self.get_path(self.bad_ids_items_path)))
-        self.bad_ids_moves = GSCUtilsLoaders.prepare_check_list(GSCUtilsMisc.read_data(self.get_path(self.bad_ids_moves_path)))
-        self.bad_ids_pokemon = GSCUtilsLoaders.prepare_check_list(GSCUtilsMisc.read_data(self.get_path(self.bad_ids_pokemon_path)))
-        self.bad_ids_text = GSCUtilsLoaders.prepare_check_list(GSCUtilsMisc.read_data(self.get_path(self.bad_ids_text_path)))
-        self.pokemon_patch_sets = [GSCUtilsLoaders.prepare_check_list(GSCUtilsMisc.read_data(self.get_path(self.pokemon_patch_set_0_path))), GSCUtilsLoaders.prepare_check_list(GSCUtilsMisc.read_data(self.get_path(self.pokemon_patch_set_1_path)))]
-        self.mail_patch_set = [GSCUtilsLoaders.prepare_check_list(GSCUtilsMisc.read_data(self.get_path(self.mail_patch_set_path)))]
-        self.japanese_mail_patch_set = [GSCUtilsLoaders.prepare_check_list(GSCUtilsMisc.read_data(self.get_path(self.mail_patch_set_path)))]
-        self.check_functions = [
-            self.clean_nothing,
-            self.clean_text,
-            self.clean_team_size,
-            self.clean_species,
-            self.clean_move,
-            self.clean_item,
-            self.clean_level,
-            self.check_hp,
-            self.clean_text_final,
-            self.load_stat_exp,
-            self.load_stat_iv,
-            self.check_stat,
-            self.clean_species_sp,
-            self.clean_pp,
-            self.clean_experience,
-            self.clean_egg_cycles_friendship,
-            self.clean_type,
-            self.clean_text_newline,
-            self.clean_text_final_no_end,
-            self.clean_species_force_terminate,
-            self.clean_mail_species,
-            self.clean_mail_item,
-            self.clean_mail_same_species,
-            self.clean_pokemon_patch_set,
-            self.clean_mail_patch_set,
-            self.clean_japanese_mail_patch_set
-            ]
-        self.checks_map = self.prepare_checks_map(GSCUtilsMisc.read_data(self.get_path(self.checks_map_path)), section_sizes, self.check_functions)
-        self.single_pokemon_checks_map = GSCUtilsLoaders.prepare_functions_map(GSCUtilsMisc.read_data(self.get_path(self.single_pokemon_checks_map_path)), self.check_functions)
-        self.moves_checks_map = GSCUtilsLoaders.prepare_functions_map(GSCUtilsMisc.read_data(self.get_path(self.moves_checks_map_path)), self.check_functions)
+        self.section_sizes = section_sizes
+        tables = GSCChecksTables.get_tables(type(self))
+        self.bad_ids_items = tables.bad_ids_items
+        self.bad_ids_moves = tables.bad_ids_moves
+        self.bad_ids_pokemon = tables.bad_ids_pokemon
+        self.bad_ids_text = tables.bad_ids_text
+        self.pokemon_patch_sets = tables.pokemon_patch_sets
+        self.mail_patch_set = tables.mail_patch_set
+        self.japanese_mail_patch_set = tables.japanese_mail_patch_set
+        self.single_pokemon_checks_map = tables.single_pokemon_checks_map
+        self.moves_checks_map = tables.moves_checks_map
         self.species_cleaner = self.clean_species_sp
     
+    def get_checks_map(self):
+        """
+        Returns the full trade's checks map.
+        """
+        return GSCChecksTables.get_tables(type(self)).get_checks_map(self.section_sizes)
+    
     def get_path(self, target):
         return self.base_folder + target
     
+    def get_version_data(self):
+        """
+        Returns data which changes whenever the checks' code
+        or data files do, so results validated by older checks
+        can be told apart.
+        """
+        return self.checks_version.to_bytes(4, byteorder='little') + GSCChecksTables.get_tables(type(self)).digest
+    
     def get_utils_class(self):
         return GSCUtils
     
@@ -1104,7 +1204,7 @@ class GSCChecks:
     def apply_checks_to_data(self, checker, data):
         new_data = list(data)
         for j in range(len(checker)):
-            new_data[j] = checker[j](data[j])
+            new_data[j] = checker[j](self, data[j])
         return new_data
 
     def prepare_text_buffer(self):
@@ -1129,13 +1229,6 @@ class GSCChecks:
     def prepare_patch_sets_buffer(self):
         self.curr_patch_set = 0
 
-    def prepare_checks_map(self, data, lengths, functions_list):
-        raw_data_sections = GSCUtilsMisc.divide_data(data, lengths)
-        call_map = [[],[],[],[]]
-        for i in range(len(raw_data_sections)):
-            call_map[i] = GSCUtilsLoaders.prepare_functions_map(raw_data_sections[i], functions_list)
-        return call_map
-    
     @clean_check_sanity_checks
     def clean_nothing(self, val):
         return val
@@ -1,5 +1,5 @@
 from .gsc_trading import GSCTrading
-from .gsc_trading_data_utils import GSCUtilsLoaders, GSCUtilsMisc
+from .gsc_trading_data_utils import GSCUtilsLoaders, GSCUtilsMisc, GSCChecksTables
 
 class GSCJPMailConverter:
     """
@@ -65,7 +65,7 @@ class GSCJPMailConverter:
         ]
         self.mail_conversion_table_jp = GSCUtilsLoaders.prepare_functions_map(GSCUtilsMisc.read_data(self.get_path(self.table_to_jp_path)), self.conversion_functions)
         self.mail_conversion_table_int = GSCUtilsLoaders.prepare_functions_map(GSCUtilsMisc.read_data(self.get_path(self.table_to_int_path)), self.conversion_functions)
-        self.mail_checker = GSCUtilsLoaders.prepare_functions_map(GSCUtilsMisc.read_data(self.get_path(self.mail_jp_checks_path)), checks.check_functions)
+        self.mail_checker = GSCUtilsLoaders.prepare_functions_map(GSCUtilsMisc.read_data(self.get_path(self.mail_jp_checks_path)), GSCChecksTables.get_tables(type(checks)).check_functions)
         
     def get_path(self, target):
         return self.base_folder + target
@@ -158,8 +158,8 @@ class GSCTradingJP(GSCTrading):
     special_sections_sync = [True, True, True, False, False]
     drop_bytes_checks = [[0xA, 0x1B9, 0xC5, 0x181, 0x11D], [next_section, next_section, mail_next_section, no_input, no_input], [0,4,0,0,0]]
     
-    def __init__(self, sending_func, receiving_func, connection, menu, kill_function, pre_sleep):
-        super(GSCTradingJP, self).__init__(sending_func, receiving_func, connection, menu, kill_function, pre_sleep)
+    def __init__(self, sending_func, receiving_func, connection, menu, kill_function, pre_sleep, bulk_swapping_func=None):
+        super(GSCTradingJP, self).__init__(sending_func, receiving_func, connection, menu, kill_function, pre_sleep, bulk_swapping_func=bulk_swapping_func)
         self.jp_mail_converter = GSCJPMailConverter(self.checks)
 
     def get_mail_section_id(self):
@@ -177,7 +177,7 @@ class GSCTradingJP(GSCTrading):
 
     def get_checker(self, index):
         if index != self.get_mail_section_id():
-            return self.checks.checks_map[index]
+            return self.checks.get_checks_map()[index]
         return self.jp_mail_converter.mail_checker
 
     def convert_mail_data(self, data, to_device):
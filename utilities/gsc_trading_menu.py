@@ -11,6 +11,9 @@ class GSCTradingMenu:
     default_server = ["pokemon-gb-online-trades.herokuapp.com", None]
     default_emulator = ["localhost", 8765]
     default_max_level = 100
+    default_pool_species = 0
+    default_pool_eggs = 0
+    default_pacing_profiles = "pacing_profiles.json"
 
     def __init__(self, kill_function, is_emulator=False):
         try:
@@ -24,12 +27,17 @@ class GSCTradingMenu:
         self.japanese = args.japanese
         self.max_level = args.max_level
         self.egg = args.egg
+        self.pool_species = args.pool_species
+        self.pool_eggs = args.pool_eggs
         self.is_emulator = is_emulator
         self.multiboot = False
         if is_emulator:
             self.emulator = [args.emulator_host, args.emulator_port]
         self.do_sanity_checks = args.do_sanity_checks
         self.kill_on_byte_drops = args.kill_on_byte_drops
+        self.adaptive_pacing = args.adaptive_pacing
+        self.pacing_profiles = args.pacing_profiles
+        self.instrumentation = args.instrumentation
         self.verbose = args.verbose
         self.gen = args.gen_number
         self.trade_type = args.trade_type
@@ -229,11 +237,23 @@ class GSCTradingMenu:
         parser.add_argument("-dkb", "--disable_kill_drops",
                             action="store_false", dest="kill_on_byte_drops", default=True,
                             help="don't kill the process for dropped bytes")
+        parser.add_argument("-ap", "--adaptive_pacing",
+                            action="store_true", dest="adaptive_pacing", default=False,
+                            help="learn how fast the device can go, instead of always waiting the default time between two bytes. It may drop bytes while it learns")
+        parser.add_argument("-pp", "--pacing_profiles", dest="pacing_profiles", default = self.default_pacing_profiles,
+                            help="file which stores the pacing learned for each device")
+        parser.add_argument("-in", "--instrumentation",
+                            action="store_true", dest="instrumentation", default=False,
+                            help="measure the time spent waiting on the device and on the network, and print it at the end")
         parser.add_argument("-mlp", "--max_level_pool", dest="max_level", default = self.default_max_level,
                             help="Pool's max level", type=int)
         parser.add_argument("-egp", "--eggify_pool",
                             action="store_true", dest="egg", default=False,
                             help="turns Pool Pokémon into ready-to-hatch eggs")
+        parser.add_argument("-psp", "--pool_species", dest="pool_species", default = self.default_pool_species,
+                            help="only get this species from the Pool, by its index. Any species if 0", type=int)
+        parser.add_argument("-peg", "--pool_eggs", dest="pool_eggs", default = self.default_pool_eggs,
+                            help="0 to get any Pool Pokémon, 1 to never get eggs, 2 to only get eggs", type=int, choices=[0, 1, 2])
         parser.add_argument("-q", "--quiet",
                             action="store_false", dest="verbose", default=True,
                             help="don't print status messages to stdout")
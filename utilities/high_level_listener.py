@@ -1,27 +1,123 @@
-from time import sleep
+import struct
+import threading
+from collections import deque
 from .gsc_trading_strings import GSCTradingStrings
 
 class HighLevelListener:
     """
     Class which handles high level comunications.
+    The frames to send are queued for the websocket's thread, which
+    is woken up as soon as one is available. Readers waiting for data
+    are woken up as soon as it arrives.
+    Unsent frames can be replaced by newer ones of the same kind,
+    so stale data is never sent.
+    Frames can either use the ASCII framing (S/G, 4 characters type,
+    2 bytes length, data) or the binary framing (1 byte opcode,
+    varint length, data). Both are always accepted.
     """
-    SLEEP_TIMER = 0.01
+    RECV_WAIT_TIMER = 0.01
+    MAX_QUEUED_FRAMES = 64
     REQ_INFO_POSITION = 0
     LEN_POSITION = 5
     DATA_POSITION = LEN_POSITION + 2
+    BINARY_SEND_OPCODE = 0x80
+    BINARY_GET_OPCODE = 0xC0
+    BINARY_MAX_TRANSFERS = 0x40
+    ascii_len_struct = struct.Struct(">H")
+    dispatch_tables = {}
     
     def __init__(self):
-        self.to_send = None
+        self.send_queue = deque()
+        self.queued_frames = {}
+        self.send_lock = threading.Condition()
+        self.sender_wakeup = None
+        self.recv_condition = threading.Condition()
         self.on_receive_dict = {}
         self.recv_dict = {}
         self.send_dict = {}
         self.valid_transfers = None
+        self.transfer_opcodes = {}
+        self.dispatch_table = HighLevelListener.get_dispatch_table({})
+        self.binary_framing = False
+        self.mirror_framing = False
+        self.last_received_binary = False
 
-    def prepare_send_data(self, type, data):
-        return bytearray(list((GSCTradingStrings.send_request + type).encode()) + [(len(data) >> 8) & 0xFF, len(data) & 0xFF] + data)
+    def prepare_varint(value):
+        ret = bytearray()
+        while value >= 0x80:
+            ret.append((value & 0x7F) | 0x80)
+            value >>= 7
+        ret.append(value)
+        return ret
     
-    def prepare_get_data(self, type):
-        return bytearray(list((GSCTradingStrings.get_request + type).encode()))
+    def read_varint(data, pos):
+        """
+        Returns the value and the position after it.
+        If the data ends before the value does, returns None.
+        """
+        value = 0
+        shift = 0
+        while pos < len(data):
+            byte = data[pos]
+            value |= (byte & 0x7F) << shift
+            pos += 1
+            if (byte & 0x80) == 0:
+                return value, pos
+            shift += 7
+        return None, None
+    
+    def get_dispatch_table(transfer_opcodes):
+        """
+        Returns a table which maps each possible first byte
+        of a frame to how it's parsed.
+        It's prepared only once for each set of opcodes.
+        """
+        key = tuple(sorted(transfer_opcodes.items()))
+        dispatch_table = HighLevelListener.dispatch_tables.get(key, None)
+        if dispatch_table is None:
+            dispatch_table = [None] * 0x100
+            dispatch_table[ord(GSCTradingStrings.send_request)] = True
+            dispatch_table[ord(GSCTradingStrings.get_request)] = True
+            for transfer, opcode in key:
+                if (opcode < 0) or (opcode >= HighLevelListener.BINARY_MAX_TRANSFERS):
+                    raise ValueError("Invalid opcode for " + transfer + ": " + str(opcode))
+                if dispatch_table[HighLevelListener.BINARY_SEND_OPCODE | opcode] is not None:
+                    raise ValueError("Opcode " + str(opcode) + " is used more than once!")
+                dispatch_table[HighLevelListener.BINARY_SEND_OPCODE | opcode] = (GSCTradingStrings.send_request, transfer)
+                dispatch_table[HighLevelListener.BINARY_GET_OPCODE | opcode] = (GSCTradingStrings.get_request, transfer)
+            HighLevelListener.dispatch_tables[key] = dispatch_table
+        return dispatch_table
+    
+    def set_binary_framing(self, binary_framing):
+        """
+        Sets whether the frames this side sends use the binary framing.
+        """
+        self.binary_framing = binary_framing
+    
+    def set_mirror_framing(self, mirror_framing):
+        """
+        If set, the frames this side sends use the same framing
+        as the last valid frame it received.
+        """
+        self.mirror_framing = mirror_framing
+    
+    def is_binary(self, type, binary):
+        if binary is None:
+            binary = self.binary_framing
+        return binary and (type in self.transfer_opcodes.keys())
+    
+    def prepare_send_header(self, type, data_len, binary=None):
+        if self.is_binary(type, binary):
+            return bytearray([HighLevelListener.BINARY_SEND_OPCODE | self.transfer_opcodes[type]]) + HighLevelListener.prepare_varint(data_len)
+        return bytearray((GSCTradingStrings.send_request + type).encode()) + HighLevelListener.ascii_len_struct.pack(data_len)
+    
+    def prepare_send_data(self, type, data, binary=None):
+        return self.prepare_send_header(type, len(data), binary=binary) + bytearray(data)
+    
+    def prepare_get_data(self, type, binary=None):
+        if self.is_binary(type, binary):
+            return bytearray([HighLevelListener.BINARY_GET_OPCODE | self.transfer_opcodes[type]])
+        return bytearray((GSCTradingStrings.get_request + type).encode())
     
     def reset_dict(self, type, chosen_dict):
         if type in chosen_dict.keys():
@@ -33,18 +129,87 @@ class HighLevelListener:
     def reset_send(self, type):
         self.reset_dict(type, self.send_dict)
     
-    def set_valid_transfers(self, valid_transfers):
+    def set_valid_transfers(self, valid_transfers, transfer_opcodes={}):
+        """
+        Sets the transfers which are accepted. Only the ones with
+        an opcode in transfer_opcodes can use the binary framing.
+        The opcodes are part of the protocol, so both sides
+        must use the same ones.
+        """
         self.valid_transfers = valid_transfers
+        self.transfer_opcodes = transfer_opcodes
+        self.dispatch_table = HighLevelListener.get_dispatch_table(transfer_opcodes)
     
-    def send_data(self, type, data):
+    def set_sender_wakeup(self, wakeup):
         """
-        Sends the data to the other client and prepares the dict's entry
+        Sets the function called, from any thread, when there are
+        frames ready to be sent.
+        """
+        with self.send_lock:
+            self.sender_wakeup = wakeup
+            has_frames = len(self.send_queue) > 0
+        if (wakeup is not None) and has_frames:
+            wakeup()
+    
+    def queue_frame(self, frame, coalesce_key=None, block=True):
+        """
+        Queues a frame to be sent. Returns an event which is set
+        once the frame has been sent.
+        If an unsent frame with the same coalesce_key is queued,
+        it's replaced by this one instead.
+        If block is True, it waits for the queue to have space.
+        """
+        with self.send_lock:
+            entry = None
+            if coalesce_key is not None:
+                entry = self.queued_frames.get(coalesce_key, None)
+            if entry is not None:
+                entry[0] = frame
+            else:
+                if block:
+                    self.send_lock.wait_for(lambda: len(self.send_queue) < HighLevelListener.MAX_QUEUED_FRAMES)
+                entry = [frame, threading.Event()]
+                self.send_queue.append(entry)
+                if coalesce_key is not None:
+                    self.queued_frames[coalesce_key] = entry
+            wakeup = self.sender_wakeup
+        if wakeup is not None:
+            wakeup()
+        return entry[1]
+    
+    def get_frames(self):
+        """
+        Takes all the queued frames, in order.
+        """
+        with self.send_lock:
+            frames = list(self.send_queue)
+            self.send_queue.clear()
+            self.queued_frames.clear()
+            self.send_lock.notify_all()
+        return frames
+    
+    def requeue_frames(self, frames):
+        """
+        Puts back frames which couldn't be sent, i.e. because
+        the connection dropped, so they're the first ones sent
+        once it's back.
+        """
+        with self.send_lock:
+            self.send_queue.extendleft(reversed(frames))
+    
+    def send_data(self, type, data, coalesce=False):
+        """
+        Queues the data for the other client and prepares the dict's entry
         for responding to GETs.
+        It doesn't wait for the data to be sent.
+        If coalesce is True, the data replaces older unsent data
+        of the same type.
         """
         self.send_dict[type] = data
-        self.to_send = self.prepare_send_data(type, data)
-        while self.to_send is not None:
-            sleep(HighLevelListener.SLEEP_TIMER)
+        coalesce_key = None
+        if coalesce:
+            coalesce_key = GSCTradingStrings.send_request + type
+        self.queue_frame(self.prepare_send_data(type, data), coalesce_key=coalesce_key)
     
     def prepare_listener(self, type, listener):
         """
@@ -54,48 +219,82 @@ class HighLevelListener:
     
     def recv_data(self, type, reset=True):
         """
-        Checks if the data has been received. If not, it issues a GET.
+        Checks if the data has been received. If not, it issues a GET
+        and briefly waits for the data to arrive.
         """
-        if not type in self.recv_dict.keys():
-            self.to_send = self.prepare_get_data(type)
-            while self.to_send is not None:
-                sleep(HighLevelListener.SLEEP_TIMER)
-            return None
-        else:
+        with self.recv_condition:
+            received = type in self.recv_dict.keys()
+        if not received:
+            # Queueing may wait for space in the send queue, so it's done
+            # without holding the condition the receive path needs
+            self.queue_frame(self.prepare_get_data(type), coalesce_key=GSCTradingStrings.get_request + type)
+        with self.recv_condition:
+            if not self.recv_condition.wait_for(lambda: type in self.recv_dict.keys(), HighLevelListener.RECV_WAIT_TIMER):
+                return None
             if reset:
                 return self.recv_dict.pop(type)
             return self.recv_dict[type]
     
-    def connection_normal_sender(self, req_type, connection):
+    def connection_normal_sender(self, req_type, connection, binary=False):
         """
         Sends the data, if it's there.
         """
-        connection.send(self.prepare_send_data(req_type, self.send_dict[req_type]))
+        connection.send(self.prepare_send_data(req_type, self.send_dict[req_type], binary=binary))
     
-    def connection_prepare_sender(self, req_type):
+    def connection_prepare_sender(self, req_type, binary=False):
         """
         Prepares the data which will be sent, if it's there.
         """
-        return self.prepare_send_data(req_type, self.send_dict[req_type])
+        return self.prepare_send_data(req_type, self.send_dict[req_type], binary=binary)
     
     def is_received_valid(self, data):
         """
         Returns whether the received data is valid or not.
+        If it's a valid send, it also returns the data's length
+        and position.
         """
+        if (data is None) or isinstance(data, str) or (len(data) == 0):
+            return None
+        parser = self.dispatch_table[data[0]]
+        if parser is None:
+            return None
+        if parser is True:
+            ret = self.is_received_ascii_valid(data)
+        else:
+            ret = self.is_received_binary_valid(data, parser[0], parser[1])
+        if ret is not None:
+            self.last_received_binary = parser is not True
+            if self.mirror_framing:
+                self.binary_framing = self.last_received_binary
+        return ret
+    
+    def is_received_ascii_valid(self, data):
         # Is the data long enough to be a valid request?
-        if (data is not None) and (len(data) >= HighLevelListener.LEN_POSITION):
-            req_info = data[HighLevelListener.REQ_INFO_POSITION:HighLevelListener.REQ_INFO_POSITION+HighLevelListener.LEN_POSITION].decode()
+        if len(data) >= HighLevelListener.LEN_POSITION:
+            try:
+                req_info = data[HighLevelListener.REQ_INFO_POSITION:HighLevelListener.REQ_INFO_POSITION+HighLevelListener.LEN_POSITION].decode()
+            except UnicodeDecodeError:
+                return None
             req_kind = req_info[0]
             req_type = req_info[1:HighLevelListener.LEN_POSITION]
             # If it's a send request, is it long enough to have the data length field?
             if (req_kind == GSCTradingStrings.send_request) and (self.valid_transfers is not None) and (len(data) > HighLevelListener.DATA_POSITION):
-                data_len = (data[HighLevelListener.LEN_POSITION] << 8) + data[HighLevelListener.LEN_POSITION+1]
+                data_len = HighLevelListener.ascii_len_struct.unpack_from(data, HighLevelListener.LEN_POSITION)[0]
                 # If it has a length, is it a valid request? Is its length right? Is the advertised length real?
                 if (len(data) >= (HighLevelListener.DATA_POSITION + data_len)) and (req_type in self.valid_transfers.keys()) and (data_len in self.valid_transfers[req_type]):
-                    return [req_kind, req_type, data_len]
+                    return [req_kind, req_type, data_len, HighLevelListener.DATA_POSITION]
             elif req_kind == GSCTradingStrings.get_request:
                 return [req_kind, req_type]
         return None
+    
+    def is_received_binary_valid(self, data, req_kind, req_type):
+        if req_kind == GSCTradingStrings.get_request:
+            return [req_kind, req_type]
+        data_len, data_pos = HighLevelListener.read_varint(data, 1)
+        # Is the advertised length real? Is it right for the type?
+        if (data_len is not None) and (len(data) >= (data_pos + data_len)) and (data_len in self.valid_transfers[req_type]):
+            return [req_kind, req_type, data_len, data_pos]
+        return None
         
     def process_received_data(self, data, connection, send_data=True, preparer=False):
         """
@@ -113,13 +312,18 @@ class HighLevelListener:
         prepared = None
         if req_kind == GSCTradingStrings.send_request:
             data_len = ret[2]
-            self.recv_dict[req_type] = list(data[HighLevelListener.DATA_POSITION:HighLevelListener.DATA_POSITION+data_len])
+            data_pos = ret[3]
+            with self.recv_condition:
+                self.recv_dict[req_type] = list(memoryview(data)[data_pos:data_pos+data_len])
+                self.recv_condition.notify_all()
             if req_type in self.on_receive_dict.keys():
                 self.on_receive_dict[req_type]()
         elif req_kind == GSCTradingStrings.get_request:
             if req_type in self.send_dict.keys() and send_data:
+                # Answer using the same framing as the request
+                binary = self.last_received_binary
                 if not preparer:
-                    self.connection_normal_sender(req_type, connection)
+                    self.connection_normal_sender(req_type, connection, binary=binary)
                 else:
-                    prepared = self.connection_prepare_sender(req_type)
+                    prepared = self.connection_prepare_sender(req_type, binary=binary)
         return [req_kind, req_type, prepared]
\ No newline at end of file
@@ -0,0 +1,164 @@
+import os
+import json
+from time import monotonic, sleep
+
+class LinkPacingProfiles:
+    """
+    Class which persists the pacing learned for each device.
+    The profiles are stored as a JSON dictionary, keyed by device.
+    """
+    tmp_eop = ".tmp"
+
+    def __init__(self, path):
+        self.path = path
+        self.profiles = self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                profiles = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(profiles, dict):
+            return {}
+        return profiles
+
+    def get(self, name):
+        """
+        Returns the stored period and response of a device, or None.
+        """
+        profile = self.profiles.get(name, None)
+        try:
+            return float(profile["period"]), float(profile["response"])
+        except (TypeError, KeyError, ValueError):
+            return None
+
+    def store(self, name, period, response):
+        self.profiles[name] = {"period": period, "response": response}
+        tmp_path = self.path + self.tmp_eop
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.profiles, f, indent=4, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass
+
+class LinkPacer:
+    """
+    Class which paces the bytes exchanged with the device.
+    It controls the period between the start of two transfers.
+    The period starts from the default delay plus the measured
+    response of the device. It shrinks while the received data
+    stays valid and it backs off when bytes are dropped, not going
+    back below the period which dropped them until enough valid
+    bytes were received since then.
+    The last period known to work is kept in the device's profile,
+    which is written by save_profile, outside of the transfers.
+    """
+    good_streak_len = 0x40
+    drop_decay_streaks = 8
+    drop_decay_factor = 0.8
+    shrink_factor = 0.8
+    backoff_factor = 1.5
+    drop_safety_factor = 1.25
+    min_delay = 0.002
+    max_delay_multiplier = 4
+    response_weight = 0.1
+
+    def __init__(self, default_delay, profile_name, profiles=None, enabled=True):
+        self.default_delay = default_delay
+        self.profile_name = profile_name
+        self.profiles = profiles
+        self.enabled = enabled
+        self.period = None
+        self.response = 0
+        self.drop_period = 0
+        self.good_streak = 0
+        self.good_streaks = 0
+        self.known_period = None
+        self.profile_changed = False
+        self.last_start = monotonic()
+        if enabled and (profiles is not None):
+            profile = profiles.get(profile_name)
+            if profile is not None:
+                self.period, self.response = profile
+                self.period = self.clamp(self.period)
+
+    def clamp(self, period):
+        min_period = max(self.response + self.min_delay, self.drop_period * self.drop_safety_factor)
+        max_period = self.response + (self.default_delay * self.max_delay_multiplier)
+        return min(max(period, min_period), max_period)
+
+    def get_delay(self):
+        """
+        Returns how long to wait between two transfers.
+        """
+        if (not self.enabled) or (self.period is None):
+            return self.default_delay
+        return max(self.period - self.response, self.min_delay)
+
+    def wait(self):
+        """
+        Waits until the device is ready for the next transfer.
+        """
+        if (not self.enabled) or (self.period is None):
+            sleep(self.default_delay)
+            return
+        remaining = self.last_start + self.period - monotonic()
+        if remaining > 0:
+            sleep(remaining)
+
+    def begin_transfer(self):
+        self.last_start = monotonic()
+
+    def end_transfer(self):
+        """
+        Measures how long the device took to respond.
+        """
+        if not self.enabled:
+            return
+        elapsed = monotonic() - self.last_start
+        if self.period is None:
+            self.response = elapsed
+            self.period = self.clamp(self.default_delay + elapsed)
+        else:
+            self.response += (elapsed - self.response) * self.response_weight
+
+    def save_profile(self):
+        """
+        Writes the last period known to work to the device's profile,
+        if it changed. It's slow, so it mustn't be called between transfers.
+        """
+        if (self.profiles is not None) and self.profile_changed:
+            self.profiles.store(self.profile_name, self.known_period, self.response)
+            self.profile_changed = False
+
+    def on_valid(self):
+        """
+        Shrinks the period once enough valid bytes were received.
+        """
+        if (not self.enabled) or (self.period is None):
+            return
+        self.good_streak += 1
+        if self.good_streak >= self.good_streak_len:
+            self.good_streak = 0
+            if self.known_period != self.period:
+                self.known_period = self.period
+                self.profile_changed = True
+            self.good_streaks += 1
+            if self.good_streaks >= self.drop_decay_streaks:
+                # A drop long ago may have been a transient one
+                self.good_streaks = 0
+                self.drop_period *= self.drop_decay_factor
+            self.period = self.clamp(self.period * self.shrink_factor)
+
+    def on_drop(self):
+        """
+        Backs off after bytes were dropped.
+        """
+        if (not self.enabled) or (self.period is None):
+            return
+        self.good_streak = 0
+        self.good_streaks = 0
+        self.drop_period = max(self.drop_period, self.period)
+        self.period = self.clamp(self.period * self.backoff_factor)
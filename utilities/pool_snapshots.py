@@ -0,0 +1,209 @@
+import os
+import hashlib
+import threading
+from time import sleep, monotonic
+
+class PoolStorageBackend:
+    """
+    Class which defines where the Pool's snapshots are stored.
+    Each snapshot is stored with its generation, a counter which
+    grows with each upload, so a server can tell whether the stored
+    snapshot is newer than its local one.
+    """
+
+    def download(self, key):
+        """
+        Returns the stored snapshot and its generation,
+        or None if there isn't one available.
+        """
+        return None
+
+    def upload(self, key, data, generation):
+        """
+        Stores the snapshot. Raises an exception if it fails.
+        """
+        pass
+
+class S3PoolStorage(PoolStorageBackend):
+    """
+    Class which stores the Pool's snapshots inside of an S3 bucket.
+    Without credentials, it behaves as if the bucket was empty,
+    and it doesn't store anything.
+    The generation is stored in the object's metadata.
+    """
+
+    def __init__(self, bucket):
+        import boto3
+        import botocore
+        self.bucket = bucket
+        self.client = boto3.client("s3")
+        self.no_credentials_error = botocore.exceptions.NoCredentialsError
+
+    def download(self, key):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=key)
+        except (self.no_credentials_error, self.client.exceptions.NoSuchKey):
+            return None
+        # Snapshots uploaded before generations were stored count as the oldest
+        return response["Body"].read(), int(response["Metadata"].get("generation", 0))
+
+    def upload(self, key, data, generation):
+        try:
+            self.client.put_object(Bucket=self.bucket, Key=key, Body=bytes(data), Metadata={"generation": str(generation)})
+        except self.no_credentials_error:
+            pass
+
+class LocalPoolStorage(PoolStorageBackend):
+    """
+    Class which stores the Pool's snapshots inside of a local directory.
+    The generation is stored in a file next to the snapshot's one,
+    which is written after it.
+    """
+    tmp_eop = ".tmp"
+    generation_eop = ".generation"
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key)
+
+    def download(self, key):
+        try:
+            with open(self.get_path(key), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        generation = 0
+        try:
+            with open(self.get_path(key) + self.generation_eop, 'r') as f:
+                generation = int(f.read())
+        except (FileNotFoundError, ValueError):
+            pass
+        return data, generation
+
+    def write_file(self, path, data):
+        tmp_path = path + self.tmp_eop
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def upload(self, key, data, generation):
+        self.write_file(self.get_path(key), data)
+        self.write_file(self.get_path(key) + self.generation_eop, str(generation).encode())
+
+class PoolSnapshotFlusher(threading.Thread):
+    """
+    Class which uploads the Pool's snapshots in the background.
+    Changes are collected for upload_delay seconds after the first one,
+    and then all the changed generations are uploaded together.
+    A snapshot is only uploaded if its content differs from the last
+    uploaded one. Failed uploads are retried with exponential backoff.
+    If always_check is True, all the snapshots are checked every
+    upload_delay seconds, for when the changes happen in other processes.
+    """
+    MAX_RETRIES = 5
+    RETRY_BASE_TIMER = 2
+
+    def __init__(self, backend, journals, keys, upload_delay, always_check=False):
+        threading.Thread.__init__(self)
+        self.daemon=True
+        self.backend = backend
+        self.journals = journals
+        self.keys = keys
+        self.upload_delay = upload_delay
+        self.always_check = always_check
+        self.condition = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.dirty_since = [None] * len(keys)
+        self.uploaded_hashes = [None] * len(keys)
+        self.failed_uploads = 0
+
+    def mark_stored(self, gen, digest):
+        """
+        Sets the hash of the generation's stored snapshot,
+        i.e. the one downloaded when the Pool was loaded.
+        If the current snapshot differs from it, or if nothing
+        is stored, it's marked as dirty.
+        """
+        if self.journals[gen] is None:
+            return
+        self.uploaded_hashes[gen] = digest
+        if hashlib.sha256(self.journals[gen].read_snapshot()).digest() != digest:
+            self.mark_dirty(gen)
+
+    def mark_dirty(self, gen):
+        with self.condition:
+            if self.dirty_since[gen] is None:
+                self.dirty_since[gen] = monotonic()
+                self.condition.notify_all()
+
+    def has_dirty(self):
+        for dirty_since in self.dirty_since:
+            if dirty_since is not None:
+                return True
+        return False
+
+    def get_lag(self, gen):
+        """
+        Returns for how many seconds the generation's changes
+        have been waiting to be uploaded.
+        """
+        with self.condition:
+            if self.dirty_since[gen] is None:
+                return 0
+            return monotonic() - self.dirty_since[gen]
+
+    def run(self):
+        while True:
+            if not self.always_check:
+                with self.condition:
+                    self.condition.wait_for(self.has_dirty)
+            sleep(self.upload_delay)
+            self.flush()
+
+    def flush(self):
+        """
+        Uploads the changed generations right away.
+        """
+        with self.flush_lock:
+            for gen in range(len(self.keys)):
+                with self.condition:
+                    dirty_since = self.dirty_since[gen]
+                    self.dirty_since[gen] = None
+                if (dirty_since is None) and (not self.always_check):
+                    continue
+                if not self.upload_snapshot(gen):
+                    with self.condition:
+                        if (self.dirty_since[gen] is None) or ((dirty_since is not None) and (dirty_since < self.dirty_since[gen])):
+                            self.dirty_since[gen] = dirty_since
+                    print("Pool snapshot upload failed for " + self.keys[gen] + ". Changes not uploaded for " + str(int(self.get_lag(gen))) + " seconds.")
+
+    def upload_snapshot(self, gen):
+        """
+        Uploads the generation's snapshot, if it changed.
+        Returns whether the stored snapshot is now up to date.
+        """
+        journal = self.journals[gen]
+        if journal is None:
+            return True
+        data = journal.read_snapshot()
+        digest = hashlib.sha256(data).digest()
+        if digest == self.uploaded_hashes[gen]:
+            return True
+        generation = journal.read_generation() + 1
+        for i in range(self.MAX_RETRIES):
+            try:
+                self.backend.upload(self.keys[gen], data, generation)
+                self.uploaded_hashes[gen] = digest
+                journal.write_generation(generation)
+                return True
+            except Exception as e:
+                self.failed_uploads += 1
+                print("Pool snapshot upload error:", str(e))
+                if i < (self.MAX_RETRIES - 1):
+                    sleep(self.RETRY_BASE_TIMER * (2 ** i))
+        return False
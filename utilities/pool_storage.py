@@ -0,0 +1,350 @@
+import os
+import zlib
+import hashlib
+import mmap
+import threading
+from time import sleep
+
+class PoolJournal:
+    """
+    Class which handles persisting the Pool's changes.
+    It uses a base file made of fixed size records and an append-only
+    log of (slot, record) writes, which is periodically rotated and
+    then removed once the base file is known to be up to date.
+    Each log entry is made of the slot (4 bytes), a CRC32 (4 bytes)
+    and the record. Entries which were only partially written
+    are discarded when replaying the log.
+    The generation of the last uploaded snapshot is kept in
+    its own file, next to the base file.
+    """
+    journal_eop = ".journal"
+    rotated_eop = ".old"
+    generation_eop = ".generation"
+    tmp_eop = ".tmp"
+    slot_len = 4
+    crc_len = 4
+    header_len = slot_len + crc_len
+
+    def __init__(self, base_path, record_len):
+        self.base_path = base_path
+        self.journal_path = base_path + self.journal_eop
+        self.rotated_path = self.journal_path + self.rotated_eop
+        self.generation_path = base_path + self.generation_eop
+        self.record_len = record_len
+        self.entry_len = self.header_len + record_len
+        self.lock = threading.Lock()
+        self.journal_file = None
+        self.flush_base = None
+
+    def prepare_entry(self, slot, record):
+        slot_data = slot.to_bytes(self.slot_len, byteorder='little')
+        record = bytes(record)
+        crc = zlib.crc32(slot_data + record).to_bytes(self.crc_len, byteorder='little')
+        return slot_data + crc + record
+
+    def read_entries(self, path):
+        """
+        Reads the valid entries of a log file.
+        """
+        entries = []
+        valid_len = 0
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return entries
+        while (valid_len + self.entry_len) <= len(data):
+            entry = data[valid_len:valid_len + self.entry_len]
+            slot_data = entry[:self.slot_len]
+            crc = int.from_bytes(entry[self.slot_len:self.header_len], byteorder='little')
+            record = entry[self.header_len:]
+            if zlib.crc32(slot_data + record) != crc:
+                break
+            entries += [(int.from_bytes(slot_data, byteorder='little'), record)]
+            valid_len += self.entry_len
+        return entries
+
+    def apply_entries(self, data, entries):
+        """
+        Applies the given entries to the records' data.
+        """
+        for slot, record in entries:
+            pos = slot * self.record_len
+            if (pos + self.record_len) <= len(data):
+                data[pos:pos + self.record_len] = record
+
+    def remove_logs(self):
+        for path in [self.rotated_path, self.journal_path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def replay(self, data):
+        """
+        Applies all the logged writes to the records' data,
+        starting from the ones of a rotated log which was not removed.
+        The result is written to the base file before removing the logs,
+        so replaying can be safely interrupted at any point.
+        """
+        data = bytearray(data)
+        entries = self.read_entries(self.rotated_path) + self.read_entries(self.journal_path)
+        self.apply_entries(data, entries)
+        with self.lock:
+            self.close()
+            if len(entries) > 0:
+                self.write_base(data)
+            self.remove_logs()
+        return data
+
+    def reset(self, data):
+        """
+        Writes the base file from scratch and empties the log.
+        The log is removed first, so its slots can never be
+        replayed on top of the new base file.
+        """
+        with self.lock:
+            self.close()
+            self.remove_logs()
+            self.write_base(data)
+
+    def set_lock(self, lock):
+        """
+        Replaces the lock, i.e. with one shared between processes
+        which use the same files.
+        """
+        self.lock = lock
+    
+    def get_num_entries(self):
+        """
+        Returns how many entries the log holds, including the ones
+        written by other processes.
+        """
+        try:
+            return int(os.path.getsize(self.journal_path) / self.entry_len)
+        except OSError:
+            return 0
+    
+    def open(self):
+        if self.journal_file is not None:
+            # Another process may have rotated the log
+            try:
+                is_rotated = not os.path.samestat(os.fstat(self.journal_file.fileno()), os.stat(self.journal_path))
+            except FileNotFoundError:
+                is_rotated = True
+            if is_rotated:
+                self.close()
+        if self.journal_file is None:
+            self.journal_file = open(self.journal_path, 'ab', buffering=0)
+
+    def close(self):
+        if self.journal_file is not None:
+            self.journal_file.close()
+            self.journal_file = None
+
+    def append(self, slot, record, apply_write=None):
+        """
+        Logs the write of a single record.
+        The entry is synced to disk before returning, so it survives
+        power losses as well as crashes.
+        If apply_write is provided, it's called once the write is logged.
+        """
+        entry = self.prepare_entry(slot, record)
+        with self.lock:
+            self.open()
+            self.journal_file.write(entry)
+            os.fsync(self.journal_file.fileno())
+            if apply_write is not None:
+                apply_write()
+
+    def write_base(self, data):
+        """
+        Atomically replaces the base file.
+        """
+        tmp_path = self.base_path + self.tmp_eop
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.base_path)
+
+    def read_generation(self):
+        """
+        Returns the generation of the last uploaded snapshot
+        the base file is based on. It's 0 if there isn't one.
+        """
+        try:
+            with open(self.generation_path, 'r') as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def write_generation(self, generation):
+        tmp_path = self.generation_path + self.tmp_eop
+        with open(tmp_path, 'w') as f:
+            f.write(str(generation))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.generation_path)
+
+    def set_base_flusher(self, flush_base):
+        """
+        Sets the function which makes sure the base file
+        contains all the logged writes.
+        """
+        self.flush_base = flush_base
+
+    def read_snapshot(self):
+        """
+        Returns the base file's content, once it's up to date.
+        No write can happen while it's read.
+        """
+        with self.lock:
+            if self.flush_base is not None:
+                self.flush_base()
+            with open(self.base_path, 'rb') as f:
+                return f.read()
+
+    def compact(self):
+        """
+        Rotates the log, so new writes go to an empty one, and then
+        removes the rotated log once the base file is up to date.
+        Only the rotation holds the lock, so writes don't wait
+        for the base file to be flushed.
+        If a rotated log is still being compacted, nothing is done.
+        """
+        with self.lock:
+            if self.get_num_entries() == 0 or self.flush_base is None:
+                return
+            if os.path.exists(self.rotated_path):
+                return
+            self.close()
+            os.replace(self.journal_path, self.rotated_path)
+        # The rotated writes are already applied to the mapped base file
+        self.flush_base()
+        os.remove(self.rotated_path)
+
+class PoolRecordStore:
+    """
+    Class which serves the Pool's records straight from
+    the memory-mapped base file.
+    Records are returned as memoryview slices, and writes are
+    logged to the journal before being applied in place.
+    """
+
+    def __init__(self, journal):
+        self.journal = journal
+        self.record_len = journal.record_len
+        self.base_file = open(journal.base_path, 'r+b')
+        self.size = os.fstat(self.base_file.fileno()).st_size
+        self.map = None
+        self.view = None
+        if self.size > 0:
+            self.map = mmap.mmap(self.base_file.fileno(), self.size)
+            self.view = memoryview(self.map)
+        self.num_records = int(self.size / self.record_len)
+        journal.set_base_flusher(self.flush)
+
+    def __len__(self):
+        return self.num_records
+
+    def get_record(self, index):
+        """
+        Returns the record in the slot, without copying it.
+        """
+        pos = index * self.record_len
+        return self.view[pos:pos + self.record_len]
+
+    def write_record(self, index, record):
+        """
+        Writes the record in the slot.
+        """
+        record = bytes(record)
+        pos = index * self.record_len
+        def apply_write():
+            self.view[pos:pos + self.record_len] = record
+        self.journal.append(index, record, apply_write=apply_write)
+
+    def flush(self):
+        if self.map is not None:
+            self.map.flush()
+
+    def close(self):
+        self.flush()
+        if self.view is not None:
+            self.view.release()
+            self.map.close()
+        self.base_file.close()
+
+class PoolSnapshotCache:
+    """
+    Class which stores the already validated version of a snapshot,
+    so it can be loaded without checking each record again.
+    The cache is keyed by the hash of the snapshot it was validated from.
+    Since validated data is left untouched by the checks, the hash of
+    the validated data is a valid key as well.
+    The cache's version is part of the hashes. It must include
+    the checks' version, so changing the checks invalidates it.
+    """
+    cache_eop = ".cache"
+    tmp_eop = ".tmp"
+    digest_len = hashlib.sha256().digest_size
+    header_len = digest_len * 2
+
+    def __init__(self, base_path, version):
+        self.path = base_path + self.cache_eop
+        self.version = bytes(version)
+
+    def get_key(self, data):
+        return hashlib.sha256(self.version + bytes(data)).digest()
+
+    def load(self, source):
+        """
+        Returns the validated data for source, or None if it's not cached.
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        if len(data) < self.header_len:
+            return None
+        source_key = data[:self.digest_len]
+        data_key = data[self.digest_len:self.header_len]
+        valid_data = data[self.header_len:]
+        # Discard partially written caches
+        if self.get_key(valid_data) != data_key:
+            return None
+        key = self.get_key(source)
+        if (key != source_key) and (key != data_key):
+            return None
+        return bytearray(valid_data)
+
+    def save(self, source, valid_data):
+        """
+        Atomically stores the validated data for source.
+        """
+        tmp_path = self.path + self.tmp_eop
+        with open(tmp_path, 'wb') as f:
+            f.write(self.get_key(source) + self.get_key(valid_data) + bytes(valid_data))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+class PoolJournalCompactor(threading.Thread):
+    """
+    Class which periodically compacts the Pool's journals
+    in the background.
+    """
+    SLEEP_TIMER = 60
+    min_entries = 64
+
+    def __init__(self, journals):
+        threading.Thread.__init__(self)
+        self.daemon=True
+        self.journals = journals
+
+    def run(self):
+        while True:
+            sleep(PoolJournalCompactor.SLEEP_TIMER)
+            for journal in self.journals:
+                if journal is not None and journal.get_num_entries() >= self.min_entries:
+                    journal.compact()
@@ -22,6 +22,7 @@ class RBYTradingClient(GSCTradingClient):
     version_server_transfer = "VES1"
     random_data_transfer = "RAN1"
     need_data_transfer = "ASK1"
+    pool_query_transfer = "PQR1"
     possible_transfers = {
         full_transfer: {0x271}, # Sum of special_sections_len
         single_transfer: {7, 32},
@@ -35,7 +36,25 @@ class RBYTradingClient(GSCTradingClient):
         version_client_transfer : {6}, # Client's version value
         version_server_transfer : {6}, # Server's version value
         random_data_transfer : {10}, # Random values from server
-        need_data_transfer : {1 + 1} # Counter + Whether it needs the other player's data
+        need_data_transfer : {1 + 1}, # Counter + Whether it needs the other player's data
+        pool_query_transfer : {1 + 2 + 1 + 1 + 1 + 1} # Counter + Species + Min Level + Max Level + Egg + Origin Game
+    }
+    # Opcodes of the binary framing. Never reuse or change them
+    binary_opcodes = {
+        full_transfer: 0,
+        single_transfer: 1,
+        pool_transfer: 2,
+        moves_transfer: 3,
+        choice_transfer: 4,
+        accept_transfer: 5,
+        success_transfer: 6,
+        buffered_transfer: 7,
+        negotiation_transfer: 8,
+        version_client_transfer: 9,
+        version_server_transfer: 10,
+        random_data_transfer: 11,
+        need_data_transfer: 12,
+        pool_query_transfer: 13
     }
     
     def __init__(self, trader, connection, verbose, stop_trade, party_reader, base_no_trade = base_folder + "base.bin", base_pool = base_folder + "base_pool.bin"):
@@ -101,8 +120,8 @@ class RBYTrading(GSCTrading):
     decline_trade = 0x61
     accept_trade = 0x62
     
-    def __init__(self, sending_func, receiving_func, connection, menu, kill_function, pre_sleep):
-        super(RBYTrading, self).__init__(sending_func, receiving_func, connection, menu, kill_function, pre_sleep)
+    def __init__(self, sending_func, receiving_func, connection, menu, kill_function, pre_sleep, bulk_swapping_func=None):
+        super(RBYTrading, self).__init__(sending_func, receiving_func, connection, menu, kill_function, pre_sleep, bulk_swapping_func=bulk_swapping_func)
         
     def get_and_init_utils_class(self):
         RBYUtils()
@@ -144,6 +163,7 @@ class RBYTrading(GSCTrading):
             other_client_version = self.attempt_receive(self.comms.get_client_version, 5)
             if other_client_version is not None:
                 self.is_running_compat_3_mode = False
+                self.comms.update_framing([server_version, other_client_version])
         if self.is_running_compat_3_mode:
             random_data, random_data_other, just_sent = self.read_section(0, send_data[0], buffered, just_sent, 0)
         else:
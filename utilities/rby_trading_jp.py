@@ -26,6 +26,6 @@ class RBYTradingJP(RBYTrading):
         end_of_rby_data_pos + (single_text_len * 11): [pokemon_name_len_diff, end_of_line]
     }, {}]
     
-    def __init__(self, sending_func, receiving_func, connection, menu, kill_function, pre_sleep):
-        super(RBYTradingJP, self).__init__(sending_func, receiving_func, connection, menu, kill_function, pre_sleep)
+    def __init__(self, sending_func, receiving_func, connection, menu, kill_function, pre_sleep, bulk_swapping_func=None):
+        super(RBYTradingJP, self).__init__(sending_func, receiving_func, connection, menu, kill_function, pre_sleep, bulk_swapping_func=bulk_swapping_func)
             
@@ -19,6 +19,7 @@ class RSESPTradingClient(GSCTradingClient):
     version_server_transfer = "VES3"
     accept_transfer = ["A3S1", "A3S2"]
     success_transfer = ["S3S1", "S3S2", "S3S3", "S3S4", "S3S5", "S3S6", "S3S7"]
+    pool_query_transfer = "P3SQ"
     possible_transfers = {
         full_transfer: {0x380}, # Total transfer's length - v1.0.0 
         pool_transfer: {1 + 0x95, 1 + 1}, # Counter + Single Pokémon (and mail + version + special ribbons) OR Counter + Fail
@@ -35,6 +36,26 @@ class RSESPTradingClient(GSCTradingClient):
         success_transfer[6] : {1 + 3}, # Counter + Success
         version_client_transfer : {6}, # Client's version value
         version_server_transfer : {6}, # Server's version value
+        pool_query_transfer : {1 + 2 + 1 + 1 + 1 + 1}, # Counter + Species + Min Level + Max Level + Egg + Origin Game
+    }
+    # Opcodes of the binary framing. Never reuse or change them
+    binary_opcodes = {
+        full_transfer: 0,
+        pool_transfer: 1,
+        pool_transfer_out: 2,
+        choice_transfer: 3,
+        accept_transfer[0]: 4,
+        accept_transfer[1]: 5,
+        success_transfer[0]: 6,
+        success_transfer[1]: 7,
+        success_transfer[2]: 8,
+        success_transfer[3]: 9,
+        success_transfer[4]: 10,
+        success_transfer[5]: 11,
+        success_transfer[6]: 12,
+        version_client_transfer: 13,
+        version_server_transfer: 14,
+        pool_query_transfer: 15
     }
     
     def __init__(self, trader, connection, verbose, stop_trade, party_reader, base_no_trade = base_folder + "base.bin", base_pool = base_folder + "base_pool.bin"):
@@ -61,7 +82,7 @@ class RSESPTradingClient(GSCTradingClient):
                 mon = self.party_reader(GSCUtilsMisc.read_data(self.fileBaseTargetName), do_full=False)
                 mon.pokemon += [received_mon[0]]
                 
-                # Handle max level option
+                # Handle max level option, for servers which ignore the query
                 if received_mon[0].get_level() > self.trader.max_level:
                     received_mon[0].set_level(self.trader.max_level)
                 
@@ -167,8 +188,8 @@ class RSESPTrading(GSCTrading):
     decline_trade_value = [decline_trade[0]<<16, decline_trade[1]<<16]
     no_input = 0
     
-    def __init__(self, sending_func, receiving_func, connection, menu, kill_function, pre_sleep):
-        super(RSESPTrading, self).__init__(sending_func, receiving_func, connection, menu, kill_function, pre_sleep)
+    def __init__(self, sending_func, receiving_func, connection, menu, kill_function, pre_sleep, bulk_swapping_func=None):
+        super(RSESPTrading, self).__init__(sending_func, receiving_func, connection, menu, kill_function, pre_sleep, bulk_swapping_func=bulk_swapping_func)
         
     def get_and_init_utils_class(self):
         RSESPUtils()
@@ -625,6 +646,7 @@ class RSESPTrading(GSCTrading):
             # Start interacting with the trading menu
             if self.do_trade(self.comms.get_chosen_mon, close=not valid):
                 break
+        self.instrumentation.print_summary()
 
     def pool_trade(self):
         """
@@ -633,6 +655,8 @@ class RSESPTrading(GSCTrading):
         self.trade_type = GSCTradingStrings.pool_trade_str
         self.reset_trade()
         self.max_level = self.menu.max_level
+        # Only get Pool Pokémon which respect the options
+        self.comms.send_pool_query(species=self.menu.pool_species, max_level=self.max_level, egg=self.menu.pool_eggs)
         while True:
             # Get data from the server and then use it to start the trade
             if self.other_pokemon is None:
@@ -645,7 +669,8 @@ class RSESPTrading(GSCTrading):
             # Start interacting with the trading menu
             if self.do_trade(self.get_first_mon, to_server=True):
                 break
+        self.instrumentation.print_summary()
         
     # Function needed in order to make sure there is enough time for the slave to prepare the next byte.
     def sleep_func(self, multiplier = 1):
-        time.sleep(self.sleep_timer * multiplier)
+        time.sleep(self.pacer.get_delay() * multiplier)
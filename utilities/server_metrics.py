@@ -0,0 +1,131 @@
+import asyncio
+from bisect import bisect_left
+
+class LatencyHistogram:
+    """
+    Class which counts how many observations fall in each bucket.
+    The buckets are in seconds.
+    """
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.BUCKETS, value)] += 1
+        self.sum += value
+
+class ServerMetrics:
+    """
+    Class which collects the server's metrics and renders them
+    in the Prometheus text format.
+    Recording is just a dictionary update. Everything else,
+    including the collectors which read the current state
+    of the server, only runs when the metrics are scraped.
+    Each family declares its label names once, and values are
+    recorded under the tuple of their labels' values.
+    """
+    COUNTER = "counter"
+    GAUGE = "gauge"
+    HISTOGRAM = "histogram"
+
+    def __init__(self):
+        self.families = {}
+        self.collectors = []
+
+    def add_family(self, name, kind, description, label_names=()):
+        self.families[name] = [kind, description, tuple(label_names), {}]
+
+    def add_collector(self, collector):
+        """
+        Adds a function which updates the gauges right before a scrape.
+        """
+        self.collectors += [collector]
+
+    def inc(self, name, labels, value=1):
+        values = self.families[name][3]
+        values[labels] = values.get(labels, 0) + value
+
+    def set(self, name, labels, value):
+        self.families[name][3][labels] = value
+
+    def observe(self, name, labels, value):
+        values = self.families[name][3]
+        histogram = values.get(labels, None)
+        if histogram is None:
+            histogram = LatencyHistogram()
+            values[labels] = histogram
+        histogram.observe(value)
+
+    def format_value(value):
+        if isinstance(value, bytes):
+            value = value.decode("latin-1")
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    def format_labels(label_names, labels, extra=()):
+        pairs = list(zip(label_names, labels)) + list(extra)
+        if len(pairs) == 0:
+            return ""
+        return "{" + ",".join(name + '="' + ServerMetrics.format_value(value) + '"' for name, value in pairs) + "}"
+
+    def render(self):
+        for collector in self.collectors:
+            collector(self)
+        lines = []
+        for name in self.families.keys():
+            kind, description, label_names, values = self.families[name]
+            lines += ["# HELP " + name + " " + description, "# TYPE " + name + " " + kind]
+            for labels in list(values.keys()):
+                value = values[labels]
+                if kind != self.HISTOGRAM:
+                    lines += [name + ServerMetrics.format_labels(label_names, labels) + " " + str(value)]
+                    continue
+                total = 0
+                for i in range(len(LatencyHistogram.BUCKETS)):
+                    total += value.counts[i]
+                    lines += [name + "_bucket" + ServerMetrics.format_labels(label_names, labels, [("le", LatencyHistogram.BUCKETS[i])]) + " " + str(total)]
+                total += value.counts[-1]
+                lines += [name + "_bucket" + ServerMetrics.format_labels(label_names, labels, [("le", "+Inf")]) + " " + str(total)]
+                lines += [name + "_sum" + ServerMetrics.format_labels(label_names, labels) + " " + str(value.sum)]
+                lines += [name + "_count" + ServerMetrics.format_labels(label_names, labels) + " " + str(total)]
+        return "\n".join(lines) + "\n"
+
+class MetricsHTTPServer:
+    """
+    Class which serves the metrics over plain HTTP, on /metrics.
+    """
+    MAX_REQUEST_LEN = 0x2000
+    REQUEST_TIMEOUT = 5
+    metrics_path = "/metrics"
+    content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.server = None
+
+    async def start(self, host, port):
+        self.server = await asyncio.start_server(self.handle, host, port, limit=self.MAX_REQUEST_LEN)
+
+    def prepare_response(self, status, body):
+        body = body.encode()
+        header = "HTTP/1.1 " + status + "\r\nContent-Type: " + self.content_type + "\r\nContent-Length: " + str(len(body)) + "\r\nConnection: close\r\n\r\n"
+        return header.encode() + body
+
+    async def handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.REQUEST_TIMEOUT)
+            request_line = request.split(b"\r\n", 1)[0].decode("latin-1").split(" ")
+            if (len(request_line) >= 2) and (request_line[0] == "GET") and (request_line[1].split("?", 1)[0] == self.metrics_path):
+                writer.write(self.prepare_response("200 OK", self.metrics.render()))
+            else:
+                writer.write(self.prepare_response("404 Not Found", ""))
+            await writer.drain()
+        except Exception as e:
+            pass
+        writer.close()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
@@ -0,0 +1,252 @@
+import os
+import signal
+import threading
+from time import perf_counter
+
+class LatencyHistogram:
+    """
+    Class which collects durations into power of two buckets,
+    starting from one microsecond.
+    """
+    num_buckets = 0x20
+    bar_len = 0x20
+
+    def __init__(self):
+        self.buckets = [0] * self.num_buckets
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, elapsed, count=1):
+        micros = int(elapsed * 1000000)
+        bucket = min(micros.bit_length(), self.num_buckets - 1)
+        self.buckets[bucket] += count
+        self.count += count
+        self.total += elapsed * count
+        self.max = max(self.max, elapsed)
+
+    def get_bucket_limit(self, bucket):
+        """
+        Returns the upper bound of a bucket, in seconds.
+        """
+        return (1 << bucket) / 1000000
+
+    def get_percentile(self, percentile):
+        """
+        Returns the upper bound of the bucket which holds
+        the requested percentile.
+        """
+        target = self.count * percentile
+        seen = 0
+        for i in range(self.num_buckets):
+            seen += self.buckets[i]
+            if (seen > 0) and (seen >= target):
+                return min(self.get_bucket_limit(i), self.max)
+        return self.max
+
+    def get_mean(self):
+        if self.count == 0:
+            return 0
+        return self.total / self.count
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "total_s": self.total,
+            "mean_s": self.get_mean(),
+            "p50_s": self.get_percentile(0.5),
+            "p99_s": self.get_percentile(0.99),
+            "max_s": self.max,
+            "buckets": {self.get_bucket_limit(i): self.buckets[i] for i in range(self.num_buckets) if self.buckets[i] > 0}
+        }
+
+    def get_lines(self):
+        lines = []
+        biggest = max(self.buckets)
+        if biggest == 0:
+            return lines
+        first = min(i for i in range(self.num_buckets) if self.buckets[i] > 0)
+        last = max(i for i in range(self.num_buckets) if self.buckets[i] > 0)
+        for i in range(first, last + 1):
+            bar = "#" * ((self.buckets[i] * self.bar_len + biggest - 1) // biggest)
+            lines += ["  <= " + format_seconds(self.get_bucket_limit(i)).rjust(9) + ": " + str(self.buckets[i]).rjust(8) + " " + bar]
+        return lines
+
+def format_seconds(seconds):
+    if seconds < 0.001:
+        return str(round(seconds * 1000000, 1)) + "us"
+    if seconds < 1:
+        return str(round(seconds * 1000, 2)) + "ms"
+    return str(round(seconds, 3)) + "s"
+
+class DisabledTradingInstrumentation:
+    """
+    Class which is used when the instrumentation is disabled.
+    It doesn't touch the engine, so its only cost is the
+    call to the in-line hooks.
+    """
+    enabled = False
+
+    def install(self, trader):
+        pass
+
+    def count_scheduled(self, is_filler):
+        pass
+
+    def to_dict(self):
+        return None
+
+    def print_summary(self):
+        pass
+
+class TradingInstrumentation(DisabledTradingInstrumentation):
+    """
+    Class which measures where the trading engine spends its time,
+    to tell the device's stalls apart from the network's ones.
+    Once installed, it replaces the engine's hot-path methods with
+    timed ones, on the instance only. Nothing is replaced when
+    the instrumentation is disabled.
+    The device's transfers are timed apart from the pacing waits.
+    The summary is also printed if the process is killed.
+    """
+    enabled = True
+    swap_name = "swap_byte"
+    bulk_swap_name = "bulk_swap_byte"
+    pacing_name = "pacing_wait"
+    force_receive_name = "force_receive"
+    attempt_receive_name = "attempt_receive"
+    recv_data_name = "recv_data"
+    bad_data_name = "act_on_bad_data"
+    filler_name = "no_input_fillers"
+    scheduled_name = "scheduled_transfers"
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.transfer_start = None
+        self.printed_summary = False
+
+    def record(self, name, elapsed, count=1):
+        if name not in self.histograms.keys():
+            self.histograms[name] = LatencyHistogram()
+        self.histograms[name].add(elapsed, count=count)
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def count_scheduled(self, is_filler):
+        """
+        Counts the transfers scheduled by synch_exchange_section_new,
+        and how many of them were no_input fillers instead of data.
+        """
+        self.count(self.scheduled_name)
+        if is_filler:
+            self.count(self.filler_name)
+
+    def wrap_timed(self, target, method_name, name):
+        method = getattr(target, method_name)
+        def timed_method(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.record(name, perf_counter() - start)
+        setattr(target, method_name, timed_method)
+
+    def wrap_counted(self, target, method_name, name):
+        method = getattr(target, method_name)
+        def counted_method(*args, **kwargs):
+            self.count(name)
+            return method(*args, **kwargs)
+        setattr(target, method_name, counted_method)
+
+    def wrap_transfers(self, pacer):
+        """
+        Times only the device's transfers, which the pacer brackets
+        with begin_transfer and end_transfer.
+        """
+        begin_transfer = pacer.begin_transfer
+        end_transfer = pacer.end_transfer
+        def timed_begin_transfer():
+            begin_transfer()
+            self.transfer_start = perf_counter()
+        def timed_end_transfer():
+            if self.transfer_start is not None:
+                self.record(self.swap_name, perf_counter() - self.transfer_start)
+                self.transfer_start = None
+            end_transfer()
+        pacer.begin_transfer = timed_begin_transfer
+        pacer.end_transfer = timed_end_transfer
+
+    def wrap_bulk_swap(self, trader):
+        """
+        Bulk swaps are recorded as the average latency of their bytes.
+        The device times them by itself, so they include its delays.
+        Without bulk support, swap_bytes goes through swap_byte,
+        which already records every byte.
+        """
+        method = trader.swap_bytes
+        def timed_swap_bytes(send_data):
+            if trader.swapBytes is None:
+                return method(send_data)
+            start = perf_counter()
+            try:
+                return method(send_data)
+            finally:
+                if len(send_data) > 0:
+                    self.record(self.bulk_swap_name, (perf_counter() - start) / len(send_data), count=len(send_data))
+        trader.swap_bytes = timed_swap_bytes
+
+    def hook_kill(self):
+        """
+        When the trade is killed, the process exits from the SIGINT
+        handler, so the summary is printed from there before exiting.
+        """
+        if threading.current_thread() is not threading.main_thread():
+            return
+        previous_handler = signal.getsignal(signal.SIGINT)
+        def summary_handler(sig, frame):
+            self.print_summary()
+            if callable(previous_handler):
+                previous_handler(sig, frame)
+            else:
+                signal.signal(signal.SIGINT, previous_handler)
+                os.kill(os.getpid(), signal.SIGINT)
+        signal.signal(signal.SIGINT, summary_handler)
+
+    def install(self, trader):
+        self.wrap_transfers(trader.pacer)
+        self.wrap_timed(trader.pacer, "wait", self.pacing_name)
+        self.wrap_timed(trader, "sleep_func", self.pacing_name)
+        self.wrap_bulk_swap(trader)
+        self.wrap_timed(trader, "force_receive", self.force_receive_name)
+        self.wrap_timed(trader, "attempt_receive", self.attempt_receive_name)
+        if hasattr(trader, "force_receive_multi"):
+            self.wrap_timed(trader, "force_receive_multi", self.force_receive_name)
+        self.wrap_counted(trader, "act_on_bad_data", self.bad_data_name)
+        self.wrap_timed(trader.comms.connection, "recv_data", self.recv_data_name)
+        self.hook_kill()
+
+    def to_dict(self):
+        return {
+            "histograms": {name: self.histograms[name].to_dict() for name in self.histograms.keys()},
+            "counters": dict(self.counters)
+        }
+
+    def get_summary(self):
+        lines = ["Trading instrumentation summary:"]
+        for name in self.histograms.keys():
+            histogram = self.histograms[name]
+            lines += [name + ": x" + str(histogram.count) + ", total: " + format_seconds(histogram.total) +
+                      ", mean: " + format_seconds(histogram.get_mean()) + ", p50: " + format_seconds(histogram.get_percentile(0.5)) +
+                      ", p99: " + format_seconds(histogram.get_percentile(0.99)) + ", max: " + format_seconds(histogram.max)]
+            lines += histogram.get_lines()
+        for name in self.counters.keys():
+            lines += [name + ": " + str(self.counters[name])]
+        return "\n".join(lines)
+
+    def print_summary(self):
+        if self.printed_summary:
+            return
+        self.printed_summary = True
+        print(self.get_summary())
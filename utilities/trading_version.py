@@ -4,8 +4,9 @@ class TradingVersion:
     """
 
     version_major = 4
-    version_minor = 0
+    version_minor = 1
     version_build = 0
+    binary_framing_version = [4, 1, 0]
     
     def read_version_data(data):
         ret = []
@@ -19,4 +20,6 @@ class TradingVersion:
         ret += [TradingVersion.version_minor & 0xFF, (TradingVersion.version_minor >> 8) & 0xFF]
         ret += [TradingVersion.version_build & 0xFF, (TradingVersion.version_build >> 8) & 0xFF]
         return ret
-
+    
+    def supports_binary_framing(version):
+        return (version is not None) and (version >= TradingVersion.binary_framing_version)
@@ -0,0 +1,524 @@
+from .gsc_trading import GSCTrading
+from .gsc_trading_jp import GSCTradingJP, GSCJPMailConverter
+from .gsc_trading_data_utils import GSCUtils, GSCUtilsMisc, GSCUtilsLoaders, GSCTradingData, GSCChecks
+from .rby_trading import RBYTrading
+from .rby_trading_jp import RBYTradingJP
+from .rby_trading_data_utils import RBYUtils, RBYTradingData, RBYChecks
+from .rse_sp_trading import RSESPTrading
+from .rse_sp_trading_data_utils import RSESPUtils, RSESPTradingData, RSESPChecks
+
+class GSCLinkPartner:
+    """
+    Class which plays the game's side of the link cable, so the
+    trading engine can run without any hardware.
+    It plugs into the engine through sendByte and receiveByte.
+    Like the real hardware, what it sends during a transfer is
+    decided before it gets the byte of that transfer.
+    It offers the Pokémon at choice_index num_trades times,
+    then it asks to stop trading.
+    """
+    trading_class = GSCTrading
+    base_folder = "useful_data/gsc/"
+    base_path = "base.bin"
+    no_data = 0
+    no_input = 0xFE
+
+    def __init__(self, num_trades=1, choice_index=0):
+        self.utils_class = self.get_and_init_utils_class()
+        self.checks = self.get_checks()
+        self.num_trades = num_trades
+        self.choice_index = choice_index
+        self.trades_done = 0
+        self.section_ids = self.get_section_ids()
+        data = GSCUtilsLoaders.load_trading_data(self.base_folder + self.base_path, self.trading_class.special_sections_len)
+        self.random_section = data[0]
+        self.own_pokemon = self.read_party(data)
+        self.other_pokemon = None
+        self.recv = self.no_input
+        self.next = self.start_predefined_section(self.trading_class.enter_room_states, self.start_sitting)
+
+    def get_and_init_utils_class(self):
+        GSCUtils()
+        return GSCUtils
+
+    def get_checks(self):
+        return GSCChecks(self.trading_class.special_sections_len, False)
+
+    def party_reader(self, data, data_mail=None):
+        return GSCTradingData(data, data_mail=data_mail)
+
+    def get_section_ids(self):
+        return [0, 1, 2, 3]
+
+    def to_device_section(self, data, index):
+        """
+        Removes the bytes the engine fills in on its own,
+        since the device doesn't send them.
+        """
+        fillers = self.trading_class.fillers[index]
+        ret = []
+        i = 0
+        while i < len(data):
+            if i in fillers.keys():
+                i += fillers[i][0]
+            else:
+                ret += [data[i]]
+                i += 1
+        return ret
+
+    def from_device_section(self, data, index):
+        """
+        Adds back the bytes the engine fills in on its own.
+        """
+        fillers = self.trading_class.fillers[index]
+        ret = []
+        for i in range(len(data)):
+            if len(ret) in fillers.keys():
+                ret += [fillers[len(ret)][1]] * fillers[len(ret)][0]
+            ret += [data[i]]
+        return ret
+
+    def convert_mail_data(self, data, to_device):
+        return data
+
+    def read_party(self, data):
+        """
+        Reads a party from the data sections, as the device would send them.
+        """
+        pokemon_data = data[1][:]
+        self.utils_class.apply_patches(pokemon_data, data[2], self.utils_class)
+        mail_data = data[3][:]
+        self.utils_class.apply_patches(mail_data, mail_data, self.utils_class, is_mail=True)
+        return self.party_reader(pokemon_data, data_mail=mail_data)
+
+    def sendByte(self, byte_to_send, num_bytes):
+        self.recv = self.next
+        self.next = self.state(byte_to_send)
+
+    def receiveByte(self, num_bytes):
+        return self.recv
+
+    def swapBytes(self, data, num_bytes, delay):
+        recv = []
+        for byte_to_send in data:
+            self.sendByte(byte_to_send, num_bytes)
+            recv += [self.receiveByte(num_bytes)]
+        return recv
+
+    def start_predefined_section(self, states_list, next_step):
+        """
+        Answers a fixed section with the values the engine waits for,
+        following it one state at a time.
+        """
+        self.predefined_states = states_list
+        self.predefined_pos = -1
+        self.predefined_next_step = next_step
+        self.state = self.predefined_section_state
+        return self.no_input
+
+    def predefined_section_state(self, byte):
+        states = self.predefined_states
+        if ((self.predefined_pos + 1) < len(states[0])) and (byte == states[0][self.predefined_pos + 1]):
+            self.predefined_pos += 1
+        if self.predefined_pos < 0:
+            return self.no_input
+        if self.predefined_pos == (len(states[0]) - 1):
+            self.predefined_next_step()
+        return min(states[1][self.predefined_pos])
+
+    def start_sitting(self):
+        return self.start_predefined_section(self.trading_class.start_trading_states, self.start_sections)
+
+    def start_sections(self):
+        data = self.own_pokemon.create_trading_data(self.trading_class.special_sections_len)
+        data[0] = self.random_section[:]
+        self.own_data = self.convert_sections(data, True)
+        self.other_data = [[self.no_data] * len(section) for section in self.own_data]
+        self.section_num = 0
+        return self.start_section_wait()
+
+    def convert_sections(self, data, to_device):
+        """
+        Converts the sections between the engine's format and the device's one.
+        """
+        ret = []
+        for i in range(len(self.section_ids)):
+            section = data[i]
+            if self.section_ids[i] == self.trading_class.get_mail_section_id(self.trading_class):
+                section = self.convert_mail_data(section, to_device)
+            elif to_device:
+                section = self.to_device_section(section, self.section_ids[i])
+            else:
+                section = self.from_device_section(section, self.section_ids[i])
+            ret += [section]
+        return ret
+
+    def get_starter(self):
+        return self.trading_class.special_sections_starter[self.section_ids[self.section_num]]
+
+    def start_section_wait(self):
+        self.starters_received = 0
+        self.state = self.section_wait_state
+        return self.get_starter()
+
+    def section_wait_state(self, byte):
+        """
+        Sends the preamble until enough of the engine's one was received.
+        """
+        starter = self.get_starter()
+        if byte == starter:
+            self.starters_received += 1
+        if self.starters_received < self.trading_class.special_sections_preamble_len[self.section_num]:
+            return starter
+        self.section_pos = 0
+        self.recv_pos = 0
+        self.state = self.section_data_state
+        return self.own_data[self.section_num][0]
+
+    def section_data_state(self, byte):
+        """
+        Sends the section one byte at a time. no_input is never valid data,
+        so it's skipped when received. Then it sends what the engine
+        checks for drops.
+        """
+        own_data = self.own_data[self.section_num]
+        other_data = self.other_data[self.section_num]
+        end = len(own_data) + self.trading_class.drop_bytes_checks[2][self.section_ids[self.section_num]]
+        if (self.section_pos > 0) and (byte != self.no_input) and (self.recv_pos < len(other_data)):
+            other_data[self.recv_pos] = byte
+            self.recv_pos += 1
+        self.section_pos += 1
+        if self.section_pos < len(own_data):
+            return own_data[self.section_pos]
+        if self.section_pos < end:
+            return self.no_data
+        if self.section_pos == end:
+            if (self.section_num + 1) < len(self.section_ids):
+                return self.trading_class.special_sections_starter[self.section_ids[self.section_num + 1]]
+            return self.no_input
+        self.section_num += 1
+        if self.section_num < len(self.section_ids):
+            return self.start_section_wait()
+        self.other_pokemon = self.read_party(self.convert_sections(self.other_data, False))
+        return self.start_choice()
+
+    def start_menu_step(self, value, valid_values, next_step):
+        """
+        Sends value until the engine answers with one of valid_values,
+        then acknowledges it like the game does.
+        """
+        self.step_value = value
+        self.step_valid_values = valid_values
+        self.step_next_step = next_step
+        self.state = self.menu_step_state
+        return value
+
+    def menu_step_state(self, byte):
+        if byte in self.step_valid_values:
+            self.peer_value = byte
+            if self.step_value == self.trading_class.stop_trade:
+                self.state = self.left_state
+            elif byte == self.trading_class.stop_trade:
+                self.state = self.closing_state
+                return self.trading_class.stop_trade
+            else:
+                self.state = self.menu_ack_state
+            return self.no_data
+        return self.step_value
+
+    def menu_ack_state(self, byte):
+        if byte == self.no_input:
+            self.state = self.menu_confirm_state
+            return self.no_input
+        return self.no_data
+
+    def menu_confirm_state(self, byte):
+        self.step_next_step()
+        return self.state(byte)
+
+    def closing_state(self, byte):
+        """
+        The trade menu was closed by the engine. Sit again once it asks to.
+        """
+        if byte == self.trading_class.start_trading_states[0][0]:
+            self.start_sitting()
+            return self.state(byte)
+        return self.no_data
+
+    def left_state(self, byte):
+        return self.no_data
+
+    def start_choice(self):
+        choice = self.trading_class.stop_trade
+        if self.trades_done < self.num_trades:
+            choice = self.trading_class.first_trade_index + self.choice_index
+        return self.start_menu_step(choice, self.trading_class.possible_indexes, self.start_accept)
+
+    def start_accept(self):
+        self.other_choice = self.peer_value - self.trading_class.first_trade_index
+        return self.start_menu_step(self.trading_class.accept_trade, set([self.trading_class.accept_trade, self.trading_class.decline_trade]), self.end_accept)
+
+    def end_accept(self):
+        if self.peer_value != self.trading_class.accept_trade:
+            return self.start_choice()
+        self.apply_trade()
+        success_set = self.trading_class.create_success_set(self.trading_class, self.own_pokemon.get_traded_mons(self.other_pokemon))
+        return self.start_menu_step(min(success_set), self.trading_class.success_values, self.end_trade)
+
+    def apply_trade(self):
+        self.own_pokemon.trade_mon(self.other_pokemon, self.choice_index, self.other_choice, self.checks)
+
+    def end_trade(self):
+        self.trades_done += 1
+        return self.start_sitting()
+
+class GSCJPLinkPartner(GSCLinkPartner):
+    """
+    Class which plays the game's side of the link cable
+    for the Japanese second generation games.
+    Its party is the international one, converted when sent.
+    """
+    trading_class = GSCTradingJP
+
+    def __init__(self, num_trades=1, choice_index=0):
+        super(GSCJPLinkPartner, self).__init__(num_trades=num_trades, choice_index=choice_index)
+        self.jp_mail_converter = GSCJPMailConverter(self.checks)
+
+    def get_section_ids(self):
+        return [0, 1, 2, 4]
+
+    def convert_mail_data(self, data, to_device):
+        """
+        Same conversion the engine does, the other way around.
+        """
+        if to_device:
+            self.utils_class.apply_patches(data, data, self.utils_class, is_mail=True)
+            data = self.jp_mail_converter.convert_to_jp(data)
+            self.utils_class.create_patches_data(data, data, self.utils_class, is_mail=True, is_japanese=True)
+        else:
+            self.utils_class.apply_patches(data, data, self.utils_class, is_mail=True, is_japanese=True)
+            data = self.jp_mail_converter.convert_to_int(data)
+            self.utils_class.create_patches_data(data, data, self.utils_class, is_mail=True)
+        return data
+
+class RBYLinkPartner(GSCLinkPartner):
+    """
+    Class which plays the game's side of the link cable
+    for the first generation.
+    """
+    trading_class = RBYTrading
+    base_folder = "useful_data/rby/"
+
+    def get_and_init_utils_class(self):
+        RBYUtils()
+        return RBYUtils
+
+    def get_checks(self):
+        return RBYChecks(self.trading_class.special_sections_len, False)
+
+    def party_reader(self, data, data_mail=None):
+        return RBYTradingData(data, data_mail=data_mail)
+
+    def get_section_ids(self):
+        return [0, 1, 2]
+
+    def read_party(self, data):
+        pokemon_data = data[1][:]
+        self.utils_class.apply_patches(pokemon_data, data[2], self.utils_class)
+        return self.party_reader(pokemon_data)
+
+class RBYJPLinkPartner(RBYLinkPartner):
+    """
+    Class which plays the game's side of the link cable
+    for the Japanese first generation games.
+    Its party is the international one, converted when sent.
+    """
+    trading_class = RBYTradingJP
+
+class RSESPLinkPartner(GSCLinkPartner):
+    """
+    Class which plays the multiboot program's side of the link cable
+    for the third generation. Data goes in 32 bits words.
+    During the setup, it asks for the ranges it still misses and sends
+    what the engine asks for. Once both sides have everything,
+    it enters the trading menu.
+    """
+    trading_class = RSESPTrading
+    base_folder = "useful_data/rse/"
+    base_mons_path = "pool_default_data/pool_mons3.bin"
+    in_menu_control = RSESPTrading.done_control_flag | RSESPTrading.in_party_trading_flag
+
+    def __init__(self, num_trades=1, choice_index=0):
+        self.utils_class = self.get_and_init_utils_class()
+        self.checks = self.get_checks()
+        self.num_trades = num_trades
+        self.choice_index = choice_index
+        self.trades_done = 0
+        data = GSCUtilsLoaders.load_trading_data(self.base_folder + self.base_path, self.trading_class.special_sections_len)
+        self.own_pokemon = self.read_party(data)
+        self.other_pokemon = None
+        self.recv = 0
+        self.next = self.start_setup()
+
+    def get_and_init_utils_class(self):
+        RSESPUtils()
+        return RSESPUtils
+
+    def get_checks(self):
+        return RSESPChecks(self.trading_class.special_sections_len, False)
+
+    def party_reader(self, data, data_mail=None, do_full=True):
+        return RSESPTradingData(data, data_mail=data_mail, do_full=do_full)
+
+    def read_party(self, data):
+        """
+        The base data has no Pokémon in it. Like the Pool client does,
+        insert one into it: the first one of the default Pool.
+        """
+        party = self.party_reader(data[0], do_full=False)
+        mon = self.utils_class.single_mon_from_data(self.checks, GSCUtilsMisc.read_data(self.base_mons_path)[:len(self.checks.single_pokemon_checks_map)])
+        party.pokemon += [mon[0]]
+        return party
+
+    def get_num_words(self):
+        return self.trading_class.special_sections_len[0] >> 1
+
+    def start_setup(self):
+        self.own_data = self.own_pokemon.create_trading_data(self.trading_class.special_sections_len)[0]
+        self.other_data = [0] * self.trading_class.special_sections_len[0]
+        self.completed_data = [False] * self.get_num_words()
+        self.num_uncompleted = self.get_num_words()
+        self.has_all_data = False
+        self.other_has_all_data = False
+        self.send_pos = 0
+        self.send_end = 0
+        self.since_last_useful = self.trading_class.since_last_useful_limit
+        self.state = self.setup_state
+        return self.get_setup_word()
+
+    def setup_state(self, word):
+        control_byte = (word >> 24) & 0xFF
+        if (control_byte & 0xF) >= self.trading_class.asking_data_nybble:
+            if (control_byte & self.trading_class.not_done_control_flag) != 0:
+                self.send_end = min((word >> 12) & 0xFFF, self.get_num_words())
+                self.send_pos = min(word & 0xFFF, self.send_end)
+        elif ((control_byte & self.trading_class.sending_data_control_flag) != 0) and ((control_byte & self.trading_class.in_party_trading_flag) == 0):
+            if (control_byte & self.trading_class.done_control_flag) != 0:
+                self.other_has_all_data = True
+            pos = self.trading_class.get_pos_from_bytes(self.trading_class, word >> 16)
+            if (pos < self.get_num_words()) and not self.has_all_data:
+                self.other_data[pos * 2] = word & 0xFF
+                self.other_data[(pos * 2) + 1] = (word >> 8) & 0xFF
+                if not self.completed_data[pos]:
+                    self.completed_data[pos] = True
+                    self.num_uncompleted -= 1
+                    self.since_last_useful = 0
+                    if self.num_uncompleted == 0:
+                        self.check_other_data()
+        if self.has_all_data and self.other_has_all_data:
+            self.other_pokemon = self.party_reader(self.other_data)
+            return self.start_choice()
+        return self.get_setup_word()
+
+    def check_other_data(self):
+        if RSESPTradingData.are_checksum_valid(RSESPTradingData, self.other_data, self.trading_class.special_sections_len):
+            self.has_all_data = True
+        else:
+            self.completed_data = [False] * self.get_num_words()
+            self.num_uncompleted = self.get_num_words()
+            self.since_last_useful = self.trading_class.since_last_useful_limit
+
+    def get_setup_word(self):
+        """
+        Either asks for the largest missing range or sends the next
+        word of the range the engine asked for.
+        """
+        self.since_last_useful += 1
+        if (not self.has_all_data) and (self.since_last_useful > self.trading_class.since_last_useful_limit):
+            start, end = self.trading_class.find_uncompleted_range(self.trading_class, self.completed_data)
+            self.since_last_useful = 0
+            control_byte = self.trading_class.not_done_control_flag | self.trading_class.asking_data_nybble
+            return (control_byte << 24) | ((end & 0xFFF) << 12) | (start & 0xFFF)
+        control_byte = self.trading_class.not_done_control_flag
+        if self.has_all_data:
+            control_byte = self.trading_class.done_control_flag
+        if self.send_pos >= self.send_end:
+            return control_byte << 24
+        value = self.own_data[self.send_pos * 2] | (self.own_data[(self.send_pos * 2) + 1] << 8)
+        word = ((control_byte | self.trading_class.sending_data_control_flag) << 24) | (self.trading_class.get_bytes_from_pos(self.trading_class, self.send_pos) << 16) | value
+        self.send_pos += 1
+        return word
+
+    def start_menu_step(self, value, valid_values, next_step):
+        self.step_value = (self.in_menu_control << 24) | value
+        self.step_valid_values = valid_values
+        self.step_next_step = next_step
+        self.state = self.menu_step_state
+        return self.step_value
+
+    def menu_step_state(self, word):
+        if ((word >> 24) == self.in_menu_control) and (((word >> 16) & 0xFF) in self.step_valid_values):
+            self.peer_value = word & 0xFFFFFF
+            return self.step_next_step()
+        return self.step_value
+
+    def left_state(self, word):
+        return self.step_value
+
+    def start_choice(self):
+        choice = self.trading_class.stop_trade
+        if self.trades_done < self.num_trades:
+            choice = self.trading_class.first_trade_index + (self.choice_index << 16) + self.own_pokemon.pokemon[self.choice_index].get_species()
+        return self.start_menu_step(choice, self.trading_class.possible_indexes, self.start_accept)
+
+    def start_accept(self):
+        if self.trading_class.is_choice_stop(self.trading_class, self.peer_value) or self.trading_class.is_choice_stop(self.trading_class, self.step_value):
+            self.state = self.left_state
+            return self.step_value
+        self.other_choice = self.trading_class.convert_choice(self.trading_class, self.peer_value)
+        self.num_accepted = 0
+        return self.start_accept_step()
+
+    def start_accept_step(self):
+        accept = self.trading_class.accept_trade[self.num_accepted]
+        value = (accept << 16) | self.own_pokemon.pokemon[self.choice_index].get_species()
+        return self.start_menu_step(value, set([accept, self.trading_class.decline_trade[self.num_accepted]]), self.end_accept_step)
+
+    def end_accept_step(self):
+        if self.trading_class.is_choice_decline(self.trading_class, self.peer_value, self.num_accepted):
+            return self.start_choice()
+        self.num_accepted += 1
+        if self.num_accepted < len(self.trading_class.accept_trade):
+            return self.start_accept_step()
+        self.num_success = 0
+        return self.start_success_step()
+
+    def start_success_step(self):
+        success = self.trading_class.success_trade[self.num_success]
+        value = (success << 16) | self.get_success_data(self.num_success)
+        return self.start_menu_step(value, set([success, self.trading_class.failed_trade]), self.end_success_step)
+
+    def get_success_data(self, num_success):
+        """
+        The game confirms the species and the PID of both Pokémon.
+        """
+        own_mon = self.own_pokemon.pokemon[self.choice_index]
+        other_mon = self.other_pokemon.pokemon[self.other_choice]
+        values = [own_mon.get_species(), own_mon.pid & 0xFFFF, own_mon.pid >> 16, other_mon.get_species(), other_mon.pid & 0xFFFF, other_mon.pid >> 16, 0]
+        return values[num_success]
+
+    def end_success_step(self):
+        self.num_success += 1
+        if self.num_success < len(self.trading_class.success_trade):
+            return self.start_success_step()
+        self.apply_trade()
+        self.trades_done += 1
+        return self.start_setup()
+
+    def apply_trade(self):
+        """
+        The game swaps the Pokémon on its own, without any check.
+        """
+        self.own_pokemon.reorder_party(self.choice_index)
+        self.other_pokemon.reorder_party(self.other_choice)
+        self.own_pokemon.pokemon[self.own_pokemon.get_last_mon_index()] = self.other_pokemon.pokemon[self.other_pokemon.get_last_mon_index()]
@@ -3,7 +3,7 @@
 import asyncio
 import websockets
 import threading
-from time import sleep
+from time import monotonic
 from .gsc_trading_strings import GSCTradingStrings
 from .high_level_listener import HighLevelListener
 
@@ -45,10 +45,14 @@ class PoolTradeRunner (threading.Thread):
 class WebsocketClient:
     """
     Class for connecting to the websocket server.
+    If the connection to a linked peer drops, it's resumed
+    using the token the server sent when linking.
     """
     host = None
     port = None
-    SLEEP_TIMER = 0.01
+    NORMAL_CLOSURE = 1000
+    RESUME_TIMEOUT = 30
+    RESUME_RETRY_TIMER = 1
     
     def __init__(self, host, port, kill_function):
         WebsocketClient.host = host
@@ -64,41 +68,96 @@ class WebsocketClient:
         by registering to a room in the websocket server.
         :param room: Room in which the client registers.
         """
+        link_str = WebsocketClient.ws_base_str + "/link" + str(gen) + "/" +str(room).zfill(5)
         try:
-            async with websockets.connect(WebsocketClient.ws_base_str + "/link" + str(gen) + "/" +str(room).zfill(5), ping_interval=None) as websocket:
+            async with websockets.connect(link_str, ping_interval=None) as websocket:
                 await websocket.send("")
-                data = await websocket.recv()
+                token = WebsocketClient.get_resume_token(await websocket.recv())
                 await WebsocketClient.handler(websocket, other, loop)
+            while WebsocketClient.can_resume(websocket, token):
+                websocket = await WebsocketClient.resume(link_str, token, other, loop)
         except Exception as e:
             print(GSCTradingStrings.websocket_client_error_str, str(e))
-            WebsocketClient.kill_function()
+        WebsocketClient.kill_function()
+    
+    def get_resume_token(data):
+        """
+        The server answers "CLIENT <token>" when linking.
+        """
+        data = data.split(" ")
+        if len(data) < 2:
+            return None
+        return data[1]
+    
+    def can_resume(websocket, token):
+        """
+        A connection the server closed normally can't be resumed.
+        """
+        return (websocket is not None) and (token is not None) and (websocket.close_code != WebsocketClient.NORMAL_CLOSURE)
+    
+    async def resume(link_str, token, other, loop):
+        """
+        Reconnects to the peer, for up to RESUME_TIMEOUT seconds.
+        Returns the resumed websocket, once it's closed, or None
+        if the link couldn't be resumed.
+        """
+        deadline = monotonic() + WebsocketClient.RESUME_TIMEOUT
+        while monotonic() < deadline:
+            await asyncio.sleep(WebsocketClient.RESUME_RETRY_TIMER)
+            try:
+                async with websockets.connect(link_str + "?resume=" + token, ping_interval=None) as websocket:
+                    await websocket.send("")
+                    try:
+                        await websocket.recv()
+                    except websockets.ConnectionClosed:
+                        # The server refused the token
+                        if websocket.close_code == WebsocketClient.NORMAL_CLOSURE:
+                            return None
+                        continue
+                    await WebsocketClient.handler(websocket, other, loop)
+                return websocket
+            except (OSError, asyncio.TimeoutError, websockets.InvalidHandshake, websockets.ConnectionClosed):
+                pass
+        return None
 
     async def consumer_handler(websocket, other):
         async for message in websocket:
             response = other.process_received_data(message, websocket, preparer=True)
             if response[2] is not None:
-                other.to_send = response[2]
-                while other.to_send is not None:
-                    await asyncio.sleep(WebsocketClient.SLEEP_TIMER)
+                other.queue_frame(response[2], block=False)
             
-    async def producer_handler(websocket, other):
-        while True:
-            if other.to_send is not None:
-                await websocket.send(other.to_send)
-                other.to_send = None
-            else:
-                await asyncio.sleep(WebsocketClient.SLEEP_TIMER)
+    async def producer_handler(websocket, other, loop):
+        frames_ready = asyncio.Event()
+        other.set_sender_wakeup(lambda: loop.call_soon_threadsafe(frames_ready.set))
+        try:
+            while True:
+                await frames_ready.wait()
+                frames_ready.clear()
+                frames = other.get_frames()
+                for i in range(len(frames)):
+                    try:
+                        await websocket.send(frames[i][0])
+                    except (websockets.ConnectionClosed, asyncio.CancelledError):
+                        other.requeue_frames(frames[i:])
+                        raise
+                    frames[i][1].set()
+        finally:
+            other.set_sender_wakeup(None)
 
     async def handler(websocket, other, loop):
         consumer_task = loop.create_task(WebsocketClient.consumer_handler(websocket, other))
-        producer_task = loop.create_task(WebsocketClient.producer_handler(websocket, other))
+        producer_task = loop.create_task(WebsocketClient.producer_handler(websocket, other, loop))
         done, pending = await asyncio.wait(
             [consumer_task, producer_task],
             return_when=asyncio.FIRST_COMPLETED,
         )
+        for task in done:
+            task.exception()
         for task in pending:
             task.cancel()
-        WebsocketClient.kill_function()
+        # Makes sure the unsent frames are back in the queue
+        if len(pending) > 0:
+            await asyncio.wait(pending)
 
     async def server_connect(other, loop, gen):
         """
@@ -109,7 +168,7 @@ class WebsocketClient:
                 await WebsocketClient.handler(websocket, other, loop)
         except Exception as e:
             print(GSCTradingStrings.websocket_client_error_str, str(e))
-            WebsocketClient.kill_function()
+        WebsocketClient.kill_function()
     
     def get_peer(self, other, room, gen):
         """
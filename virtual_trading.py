@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+import signal
+import os
+from utilities.websocket_client import PoolTradeRunner, ProxyConnectionRunner
+from utilities.gsc_trading import GSCTrading
+from utilities.gsc_trading_jp import GSCTradingJP
+from utilities.rby_trading import RBYTrading
+from utilities.rse_sp_trading import RSESPTrading
+from utilities.rby_trading_jp import RBYTradingJP
+from utilities.virtual_link_partner import GSCLinkPartner, GSCJPLinkPartner, RBYLinkPartner, RBYJPLinkPartner, RSESPLinkPartner
+from utilities.gsc_trading_menu import GSCTradingMenu
+from utilities.gsc_trading_strings import GSCTradingStrings
+
+class PokeTrader:
+    """
+    Runs the trading engine against a virtual link partner,
+    instead of a real device.
+    """
+    NUM_TRADES = 1
+
+    def __init__(self, menu):
+        if menu.gen == 2:
+            if menu.japanese:
+                self.partner = GSCJPLinkPartner(num_trades=self.NUM_TRADES)
+            else:
+                self.partner = GSCLinkPartner(num_trades=self.NUM_TRADES)
+        elif menu.gen == 3:
+            self.partner = RSESPLinkPartner(num_trades=self.NUM_TRADES)
+        elif menu.gen == 1:
+            if menu.japanese:
+                self.partner = RBYJPLinkPartner(num_trades=self.NUM_TRADES)
+            else:
+                self.partner = RBYLinkPartner(num_trades=self.NUM_TRADES)
+        if menu.trade_type == GSCTradingStrings.two_player_trade_str:
+            self.connection = ProxyConnectionRunner(menu, kill_function)
+        elif menu.trade_type == GSCTradingStrings.pool_trade_str:
+            self.connection = PoolTradeRunner(menu, kill_function)
+
+    def run(self):
+        self.connection.start()
+
+    # Code dependant on this connection method
+    def sendByte(self, byte_to_send, num_bytes):
+        self.partner.sendByte(byte_to_send, num_bytes)
+
+    def receiveByte(self, num_bytes):
+        return self.partner.receiveByte(num_bytes)
+
+    def swapBytes(self, data, num_bytes, delay):
+        return self.partner.swapBytes(data, num_bytes, delay)
+
+def kill_function():
+    os.kill(os.getpid(), signal.SIGINT)
+
+def exit_gracefully():
+    os._exit(1)
+
+def signal_handler(sig, frame):
+    print(GSCTradingStrings.crtlc_str)
+    exit_gracefully()
+
+signal.signal(signal.SIGINT, signal_handler)
+
+def transfer_func(p, menu):
+    if menu.gen == 2:
+        if menu.japanese:
+            trade_c = GSCTradingJP(p.sendByte, p.receiveByte, p.connection, menu, kill_function, True, bulk_swapping_func=p.swapBytes)
+        else:
+            trade_c = GSCTrading(p.sendByte, p.receiveByte, p.connection, menu, kill_function, True, bulk_swapping_func=p.swapBytes)
+    elif menu.gen == 3:
+        trade_c = RSESPTrading(p.sendByte, p.receiveByte, p.connection, menu, kill_function, True, bulk_swapping_func=p.swapBytes)
+    elif menu.gen == 1:
+        if menu.japanese:
+            trade_c = RBYTradingJP(p.sendByte, p.receiveByte, p.connection, menu, kill_function, True, bulk_swapping_func=p.swapBytes)
+        else:
+            trade_c = RBYTrading(p.sendByte, p.receiveByte, p.connection, menu, kill_function, True, bulk_swapping_func=p.swapBytes)
+
+    if menu.trade_type == GSCTradingStrings.two_player_trade_str:
+        trade_c.player_trade(menu.buffered)
+    elif menu.trade_type == GSCTradingStrings.pool_trade_str:
+        trade_c.pool_trade()
+
+menu = GSCTradingMenu(kill_function)
+menu.handle_menu()
+p = PokeTrader(menu)
+p.run()
+transfer_func(p, menu)